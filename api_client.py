@@ -1,21 +1,96 @@
 import os
-import requests
-from typing import Optional, Dict, Any
-import tempfile
+import httpx
+from typing import Optional, Dict, Any, AsyncIterator, Awaitable, Callable, Hashable
+import asyncio
+import hashlib
+import json
+import logging
+import time
 import base64
 from datetime import datetime
 from dotenv import load_dotenv
+from inference_transport import InferenceTransport, CONNECT_TIMEOUT_SECONDS
 
 # Load environment variables
 load_dotenv()
 
-# Try to import Gemini, but don't fail if it's not available
-try:
-    import google.generativeai as genai
-    GEMINI_AVAILABLE = True
-except ImportError:
-    GEMINI_AVAILABLE = False
-    genai = None
+logger = logging.getLogger(__name__)
+
+# Fixed instructions first and the question last, so every text-only
+# request shares the longest possible identical prefix
+GEMINI_MEDICAL_PREAMBLE = """You are a medical AI assistant. Please provide helpful, accurate medical information.
+
+Please provide a comprehensive but concise medical response. If this is a medical question, include relevant information about symptoms, causes, treatments, or recommendations. If you're unsure about something, please indicate that professional medical consultation is recommended.
+
+Question: """
+
+# Sentinel for "Gemini not configured yet"; None means "configured as unavailable"
+_NOT_CONFIGURED = object()
+
+# Gemini finish reasons in the stop_reason vocabulary the inference node uses
+GEMINI_STOP_REASONS = {"STOP": "eos", "MAX_TOKENS": "max_tokens", "SAFETY": "safety",
+                       "RECITATION": "other", "OTHER": "other"}
+# Gemini accepts at most this many stop sequences
+GEMINI_MAX_STOP_SEQUENCES = 5
+
+class GenerationPolicy:
+    """What a route may spend on one reply: a token cap, a latency SLO and stop sequences.
+    
+    The SLO becomes an absolute deadline when the request starts. The
+    inference node receives it as X-Deadline and stops generating once it
+    passes, returning the partial reply; a Gemini stream is cut off at it
+    the same way. Replies report `stop_reason` ("eos", "stop_sequence",
+    "max_tokens", "deadline", ...) and `tokens_generated`.
+    """
+    
+    def __init__(self, max_tokens: int, slo_seconds: Optional[float] = None, stop: tuple = ()):
+        self.max_tokens = max_tokens
+        self.slo_seconds = slo_seconds
+        self.stop = tuple(stop)
+    
+    def deadline(self) -> Optional[float]:
+        return time.time() + self.slo_seconds if self.slo_seconds else None
+
+# Per-route latency budgets. Image analysis runs as a background job, so
+# it can wait longer than someone watching a text reply being typed.
+GENERATION_POLICIES = {
+    "chat": GenerationPolicy(max_tokens=500, slo_seconds=float(os.getenv("CHAT_SLO_SECONDS", "30"))),
+    "guest": GenerationPolicy(max_tokens=300, slo_seconds=float(os.getenv("GUEST_SLO_SECONDS", "20"))),
+    "image": GenerationPolicy(max_tokens=500, slo_seconds=float(os.getenv("IMAGE_SLO_SECONDS", "80"))),
+}
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key onto one in-flight call.
+    
+    The first caller starts the work as a task; callers arriving while it
+    runs await the same task and share its result or exception. The task
+    is shielded, so a caller that goes away (a closed request) doesn't
+    cancel it for the others. Coalescing is per worker process.
+    """
+    
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self.calls = 0
+        self.coalesced = 0
+    
+    def _finished(self, key: Hashable, task: asyncio.Task):
+        self._calls.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # Retrieved, so an error nobody awaited isn't logged
+    
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+    
+    def snapshot(self) -> Dict[str, int]:
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._calls)}
 
 class MedicalAPIClient:
     def __init__(self):
@@ -23,192 +98,286 @@ class MedicalAPIClient:
         self.medical_api_key = os.getenv('MEDICAL_API_KEY')
         self.gemini_api_key = os.getenv('GEMINI_API_KEY')
         
-        print(f"🔗 Medical API URL: {self.medical_api_url}")
-        print(f"🔑 Medical API Key: {'✅ Set' if self.medical_api_key else '❌ Missing'}")
+        logger.info("🔗 Medical API configured", extra={
+            "url": self.medical_api_url, "api_key_set": bool(self.medical_api_key)
+        })
         
+        # Importing the Gemini SDK costs most of a second, so it is deferred
+        # until first use (or warm_up) instead of running at import time
+        self._gemini_model = _NOT_CONFIGURED
+        
+        # A double-clicked send or a retried upload joins the inference
+        # already running instead of starting a second one
+        self.inflight = SingleFlight()
+        
+        # Kept-alive connections to the inference node, shared by every call
+        self.transport = InferenceTransport(self.medical_api_url, self.medical_api_key) if self.medical_api_url else None
+
+    @property
+    def gemini_model(self):
+        if self._gemini_model is _NOT_CONFIGURED:
+            self._gemini_model = self._configure_gemini()
+        return self._gemini_model
+
+    def _configure_gemini(self):
         # Configure Gemini only if available and API key exists
-        if GEMINI_AVAILABLE and self.gemini_api_key and self.gemini_api_key != 'your_gemini_api_key_here':
-            try:
-                genai.configure(api_key=self.gemini_api_key)
-                self.gemini_model = genai.GenerativeModel('gemini-1.5-flash')
-                print("✅ Gemini API configured successfully")
-            except Exception as e:
-                print(f"⚠️ Gemini API configuration failed: {e}")
-                self.gemini_model = None
-        else:
-            self.gemini_model = None
+        if not self.gemini_api_key or self.gemini_api_key == 'your_gemini_api_key_here':
+            return None
+        
+        # Try to import Gemini, but don't fail if it's not available
+        try:
+            import google.generativeai as genai
+        except ImportError:
+            logger.warning("⚠️ google-generativeai not installed, Gemini disabled")
+            return None
+        
+        try:
+            genai.configure(api_key=self.gemini_api_key)
+            model = genai.GenerativeModel('gemini-1.5-flash')
+            logger.info("✅ Gemini API configured")
+            return model
+        except Exception as e:
+            logger.warning("⚠️ Gemini API configuration failed: %s", e)
+            return None
 
-    async def process_message(self, text: str, image_data: Optional[bytes] = None, max_tokens: int = 150) -> Dict[str, Any]:
-        """Process a message with optional image using the medical API or Gemini fallback"""
+    def warm_up(self):
+        """Configure Gemini ahead of the first request (blocking; run it off the event loop)"""
+        self.gemini_model
+
+    async def process_message(self, text: str, image_data: Optional[bytes] = None, max_tokens: int = 150,
+                              user_id: Optional[str] = None,
+                              policy: Optional[GenerationPolicy] = None) -> Dict[str, Any]:
+        """Process a message with optional image using the medical API or Gemini fallback
+        
+        `policy` sets the token cap, deadline and stop sequences (without
+        one, `max_tokens` applies and there is no deadline). Identical
+        requests from the same user (text, image, limits) that overlap
+        share one upstream call; each caller gets its own copy of the
+        result.
+        """
+        policy = policy or GenerationPolicy(max_tokens)
+        key = (
+            user_id,
+            hashlib.sha256(text.encode()).digest(),
+            hashlib.sha256(image_data).digest() if image_data else None,
+            policy.max_tokens,
+            policy.stop,
+        )
+        deadline = policy.deadline()
+        result = await self.inflight.do(key, lambda: self._process_message(text, image_data, policy, deadline))
+        return dict(result)
+
+    async def _process_message(self, text: str, image_data: Optional[bytes], policy: GenerationPolicy,
+                               deadline: Optional[float]) -> Dict[str, Any]:
         try:
             # If image is provided, use the medical API
             if image_data and self.medical_api_url and self.medical_api_key:
-                print(f"🖼️ Processing image + text with medical API")
-                return await self._call_medical_api(text, image_data, max_tokens)
+                return await self._call_medical_api(text, image_data, policy, deadline)
             
             # For text-only requests, use Gemini as fallback
             elif self.gemini_model:
-                print(f"📝 Processing text-only with Gemini API")
-                return await self._call_gemini_api(text, max_tokens)
+                return await self._call_gemini_api(text, policy, deadline)
             
             # If neither API is available, return a mock response
             else:
-                print("⚠️ No APIs available, using mock response")
+                logger.warning("⚠️ No APIs available, using mock response")
                 return self._mock_response(text)
                 
         except Exception as e:
-            print(f"❌ API Error: {e}")
+            logger.error("❌ Inference failed: %s", e)
             # Try Gemini as fallback if medical API fails and we have image
             if image_data and self.gemini_model:
-                print("🔄 Medical API failed, falling back to Gemini for image description...")
+                logger.info("🔄 Medical API failed, falling back to Gemini for image description")
                 fallback_text = f"I received a medical image along with this question: {text}. Please provide medical guidance and analysis based on the question, noting that I cannot see the specific image details."
-                return await self._call_gemini_api(fallback_text, max_tokens)
+                try:
+                    return await self._call_gemini_api(fallback_text, policy, deadline)
+                except Exception as fallback_error:
+                    logger.error("❌ Gemini fallback failed: %s", fallback_error)
             
             return self._mock_response(text, error=str(e))
 
-    async def _call_medical_api(self, text: str, image_data: bytes, max_tokens: int) -> Dict[str, Any]:
-        """Call the medical API with image and text - FIXED FOR TIMEOUTS"""
-        temp_file_path = None
+    def _gemini_config(self, policy: GenerationPolicy) -> Dict[str, Any]:
+        config = {"max_output_tokens": policy.max_tokens}
+        if policy.stop:
+            config["stop_sequences"] = list(policy.stop[:GEMINI_MAX_STOP_SEQUENCES])
+        return config
+
+    async def stream_message(self, text: str, max_tokens: int = 150,
+                             policy: Optional[GenerationPolicy] = None) -> AsyncIterator[str]:
+        """Text-only reply, yielded in chunks as Gemini generates it.
         
-        try:
-            print(f"🚀 Starting medical API call...")
-            print(f"📍 URL: {self.medical_api_url}")
-            print(f"📝 Text: {text[:100]}...")
-            print(f"🖼️ Image size: {len(image_data)} bytes")
-            
-            # Create a temporary file for the image
-            with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
-                temp_file.write(image_data)
-                temp_file_path = temp_file.name
-                print(f"📁 Created temp file: {temp_file_path}")
-            
+        The stream ends early, keeping what was sent, once the policy's
+        deadline passes. Without Gemini (or if it fails before producing
+        anything) the mock response arrives as a single chunk, like
+        process_message would give.
+        """
+        policy = policy or GenerationPolicy(max_tokens)
+        deadline = policy.deadline()
+        streamed = False
+        if self.gemini_model:
             try:
-                # Prepare the request with longer timeouts
-                headers = {
-                    'X-API-Key': self.medical_api_key,
-                    'User-Agent': 'RadiGlow-Frontend/1.0'
-                }
-                
-                data = {
-                    'text': text,
-                    'max_new_tokens': str(max_tokens)  # Ensure it's a string
-                }
-                
-                files = {
-                    'image': ('image.jpg', open(temp_file_path, 'rb'), 'image/jpeg')
-                }
-                
-                print(f"📤 Making request with {max_tokens} max tokens...")
-                
-                # FIXED: Increased timeouts and added retry logic
-                session = requests.Session()
-                session.headers.update(headers)
-                
-                # Configure timeouts: (connect_timeout, read_timeout)
-                timeout = (10, 90)  # 10 seconds to connect, 90 seconds to read
-                
-                response = session.post(
-                    self.medical_api_url,
-                    files=files,
-                    data=data,
-                    timeout=timeout,
-                    stream=False  # Don't stream to avoid partial responses
+                response = await asyncio.wait_for(
+                    self.gemini_model.generate_content_async(
+                        GEMINI_MEDICAL_PREAMBLE + text, generation_config=self._gemini_config(policy), stream=True
+                    ),
+                    deadline - time.time() if deadline else None
                 )
-                
-                print(f"📥 Response received: {response.status_code}")
-                print(f"📊 Response headers: {dict(response.headers)}")
-                
-                if response.status_code == 200:
+                chunks = response.__aiter__()
+                while True:
                     try:
-                        result = response.json()
-                        print(f"✅ Medical API success!")
-                        print(f"🤖 Model: {result.get('model', 'Unknown')}")
-                        print(f"📝 Response length: {len(result.get('response', ''))}")
-                        
-                        return {
-                            'response': result.get('response', 'No response received'),
-                            'model': result.get('model', 'Medical API'),
-                            'timestamp': result.get('timestamp', datetime.now().isoformat()),
-                            'type': 'medical_api'
-                        }
-                    except ValueError as e:
-                        print(f"❌ JSON decode error: {e}")
-                        print(f"Raw response: {response.text[:500]}")
-                        raise Exception(f"Invalid JSON response: {e}")
-                
-                elif response.status_code == 401:
-                    print(f"❌ Authentication failed - check API key")
-                    raise Exception("Authentication failed - invalid API key")
-                
-                elif response.status_code == 422:
-                    print(f"❌ Validation error")
-                    error_text = response.text
-                    raise Exception(f"Validation error: {error_text}")
-                
-                elif response.status_code == 500:
-                    print(f"❌ Server error")
-                    error_text = response.text
-                    raise Exception(f"Server error: {error_text}")
-                
-                else:
-                    error_text = response.text
-                    print(f"❌ Unexpected status {response.status_code}: {error_text}")
-                    raise Exception(f"API returned status {response.status_code}: {error_text}")
-                    
-            finally:
-                # Clean up the temporary file and close files
+                        chunk = await asyncio.wait_for(chunks.__anext__(), deadline - time.time() if deadline else None)
+                    except StopAsyncIteration:
+                        break
+                    if chunk.parts and chunk.text:
+                        streamed = True
+                        yield chunk.text
+                return
+            except asyncio.TimeoutError:
+                logger.info("⏱️ Gemini stream cut off at the deadline", extra={"event": "gemini.deadline"})
+                if streamed:
+                    return
+                yield self._mock_response(text, error="timeout")['response']
+                return
+            except Exception as e:
+                logger.error("❌ Gemini streaming failed: %s", e)
+                if streamed:
+                    return
+                yield self._mock_response(text, error=str(e))['response']
+                return
+        
+        logger.warning("⚠️ No APIs available, using mock response")
+        yield self._mock_response(text)['response']
+
+    async def _call_medical_api(self, text: str, image_data: bytes, policy: GenerationPolicy,
+                                deadline: Optional[float]) -> Dict[str, Any]:
+        """Call the medical API with image and text over the pooled connection"""
+        max_tokens = policy.max_tokens
+        try:
+            started = time.perf_counter()
+            data = {
+                'text': text,
+                'max_new_tokens': str(max_tokens)  # Ensure it's a string
+            }
+            if policy.stop:
+                data['stop'] = json.dumps(list(policy.stop))
+            
+            # The node stops generating at the deadline and replies with what
+            # it has; the read timeout leaves it room to send that back
+            headers = {}
+            timeout = None
+            if deadline is not None:
+                headers['X-Deadline'] = f"{deadline:.3f}"
+                timeout = httpx.Timeout(max(deadline - time.time(), 0) + 5, connect=CONNECT_TIMEOUT_SECONDS)
+            
+            # The image goes straight from memory; no temp file needed
+            files = {
+                'image': ('image.jpg', image_data, 'image/jpeg')
+            }
+            
+            response = await self.transport.post(files=files, data=data, headers=headers,
+                                                 **({'timeout': timeout} if timeout else {}))
+            
+            if response.status_code == 200:
                 try:
-                    files['image'][1].close()
-                except:
-                    pass
+                    result = response.json()
+                    logger.info("✅ Medical API call done", extra={
+                        "event": "medical_api.call",
+                        "seconds": round(time.perf_counter() - started, 3),
+                        "image_bytes": len(image_data),
+                        "max_new_tokens": max_tokens,
+                        "tokens_generated": result.get('tokens_generated'),
+                        "stop_reason": result.get('stop_reason'),
+                        "http_version": response.http_version,
+                    })
                     
-        except requests.exceptions.ConnectTimeout:
-            print(f"❌ Connection timeout to {self.medical_api_url}")
+                    return {
+                        'response': result.get('response', 'No response received'),
+                        'model': result.get('model', 'Medical API'),
+                        'timestamp': result.get('timestamp', datetime.now().isoformat()),
+                        'type': 'medical_api',
+                        'tokens_generated': result.get('tokens_generated'),
+                        'stop_reason': result.get('stop_reason')
+                    }
+                except ValueError as e:
+                    logger.error("❌ Medical API returned invalid JSON: %s", e)
+                    raise Exception(f"Invalid JSON response: {e}")
+            
+            elif response.status_code == 401:
+                logger.error("❌ Medical API authentication failed - check MEDICAL_API_KEY")
+                raise Exception("Authentication failed - invalid API key")
+            
+            elif response.status_code == 422:
+                error_text = response.text
+                logger.error("❌ Medical API validation error: %s", error_text[:200])
+                raise Exception(f"Validation error: {error_text}")
+            
+            elif response.status_code == 500:
+                error_text = response.text
+                logger.error("❌ Medical API server error: %s", error_text[:200])
+                raise Exception(f"Server error: {error_text}")
+            
+            else:
+                error_text = response.text
+                logger.error("❌ Medical API returned status %s: %s", response.status_code, error_text[:200])
+                raise Exception(f"API returned status {response.status_code}: {error_text}")
+                    
+        except httpx.ConnectTimeout:
+            logger.error("❌ Connection timeout to %s", self.medical_api_url)
             raise Exception("Failed to connect to medical API - connection timeout")
             
-        except requests.exceptions.ReadTimeout:
-            print(f"❌ Read timeout from {self.medical_api_url}")
+        except httpx.ReadTimeout:
+            logger.error("❌ Read timeout from %s", self.medical_api_url)
             raise Exception("Medical API is taking too long to respond - please try again")
             
-        except requests.exceptions.ConnectionError as e:
-            print(f"❌ Connection error: {e}")
+        except httpx.TransportError as e:
+            logger.error("❌ Connection error: %s", e)
             raise Exception("Cannot connect to medical API - please check your connection")
             
         except Exception as e:
-            print(f"❌ Medical API call failed: {e}")
+            logger.error("❌ Medical API call failed: %s", e)
             raise Exception(f"Medical API call failed: {e}")
-            
-        finally:
-            # Clean up the temporary file
-            if temp_file_path and os.path.exists(temp_file_path):
-                try:
-                    os.unlink(temp_file_path)
-                    print(f"🗑️ Cleaned up temp file")
-                except Exception as e:
-                    print(f"⚠️ Failed to clean up temp file: {e}")
 
-    async def _call_gemini_api(self, text: str, max_tokens: int) -> Dict[str, Any]:
-        """Call Gemini API for text-only requests"""
+    async def _call_gemini_api(self, text: str, policy: GenerationPolicy,
+                               deadline: Optional[float]) -> Dict[str, Any]:
+        """Call Gemini API for text-only requests
+        
+        The reply is streamed internally so that, if the deadline passes,
+        whatever was generated by then is returned instead of nothing.
+        """
+        medical_prompt = GEMINI_MEDICAL_PREAMBLE + text
+        parts = []
+        finish = {"reason": None, "tokens": 0}
+        
+        async def collect():
+            response = await self.gemini_model.generate_content_async(
+                medical_prompt, generation_config=self._gemini_config(policy), stream=True
+            )
+            async for chunk in response:
+                if chunk.candidates:
+                    candidate = chunk.candidates[0]
+                    finish["reason"] = GEMINI_STOP_REASONS.get(candidate.finish_reason.name, finish["reason"])
+                    finish["tokens"] = max(finish["tokens"], candidate.token_count)
+                if chunk.parts:
+                    parts.append(chunk.text)
+        
         try:
-            # Create a medical-focused prompt
-            medical_prompt = f"""You are a medical AI assistant. Please provide helpful, accurate medical information.
-
-Question: {text}
-
-Please provide a comprehensive but concise medical response. If this is a medical question, include relevant information about symptoms, causes, treatments, or recommendations. If you're unsure about something, please indicate that professional medical consultation is recommended."""
-
-            # Generate response
-            response = self.gemini_model.generate_content(medical_prompt)
-            
-            return {
-                'response': response.text,
-                'model': 'Gemini Flash',
-                'timestamp': datetime.now().isoformat(),
-                'type': 'gemini_api'
-            }
-            
+            await asyncio.wait_for(collect(), deadline - time.time() if deadline else None)
+            stop_reason = finish["reason"]
+        except asyncio.TimeoutError:
+            if not parts:
+                raise Exception("Gemini API call failed: timeout before the first token")
+            stop_reason = "deadline"
         except Exception as e:
             raise Exception(f"Gemini API call failed: {e}")
+        
+        return {
+            'response': "".join(parts),
+            'model': 'Gemini Flash',
+            'timestamp': datetime.now().isoformat(),
+            'type': 'gemini_api',
+            'tokens_generated': finish["tokens"] or None,
+            'stop_reason': stop_reason
+        }
 
     def _mock_response(self, text: str, error: Optional[str] = None) -> Dict[str, Any]:
         """Generate a mock response when APIs are unavailable"""
@@ -226,7 +395,9 @@ Please provide a comprehensive but concise medical response. If this is a medica
             'response': response_text,
             'model': 'System Message',
             'timestamp': datetime.now().isoformat(),
-            'type': 'mock'
+            'type': 'mock',
+            'tokens_generated': None,
+            'stop_reason': None
         }
 
 # Global instance
@@ -0,0 +1,132 @@
+"""Insert and history-read throughput: legacy vs time-ordered chat_messages schema.
+
+Usage:
+    python benchmarks/bench_chat_schema.py --rows 10000000 --chats 500000
+
+Rows are inserted in interleaved order across many chats, the way live
+traffic arrives, with a fixed-size payload standing in for Fernet ciphertext.
+Encryption cost is identical for both schemas and is left out.
+"""
+import argparse
+import base64
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from database.ids import new_id  # noqa: E402
+
+LEGACY_SCHEMA = '''
+CREATE TABLE chat_messages (
+    id TEXT PRIMARY KEY,
+    chat_id TEXT NOT NULL,
+    encrypted_content TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX idx_chat_messages_chat_id ON chat_messages(chat_id);
+'''
+
+CLUSTERED_SCHEMA = '''
+CREATE TABLE chat_messages (
+    chat_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    encrypted_content TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, seq)
+) WITHOUT ROWID;
+CREATE UNIQUE INDEX idx_chat_messages_id ON chat_messages(id);
+'''
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=1000")
+    return conn
+
+
+def legacy_rows(chat_ids, rows, payload, start):
+    for i in range(rows):
+        chat_id = chat_ids[i % len(chat_ids)]
+        created = (start + timedelta(milliseconds=i)).isoformat()
+        yield (base64.urlsafe_b64encode(os.urandom(16)).decode(), chat_id, payload, "user", created)
+
+
+def clustered_rows(chat_ids, rows, payload, start_ms):
+    for i in range(rows):
+        chat_id = chat_ids[i % len(chat_ids)]
+        ts = start_ms + i
+        yield (chat_id, i // len(chat_ids) + 1, new_id(ts), payload, "user", ts)
+
+
+def run(name, schema, insert_sql, history_sql, row_iter, rows, chat_ids, reads, batch):
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        conn = connect(path)
+        conn.executescript(schema)
+
+        started = time.perf_counter()
+        pending = []
+        for row in row_iter:
+            pending.append(row)
+            if len(pending) >= batch:
+                conn.executemany(insert_sql, pending)
+                conn.commit()
+                pending = []
+        if pending:
+            conn.executemany(insert_sql, pending)
+            conn.commit()
+        insert_seconds = time.perf_counter() - started
+
+        sample = random.Random(1).sample(chat_ids, min(reads, len(chat_ids)))
+        started = time.perf_counter()
+        for chat_id in sample:
+            conn.execute(history_sql, (chat_id,)).fetchall()
+        read_seconds = time.perf_counter() - started
+
+        conn.close()
+        size_mb = os.path.getsize(path) / 1e6
+        print(f"{name:10s} insert {rows / insert_seconds:12,.0f} rows/s   "
+              f"history {len(sample) / read_seconds:10,.0f} reads/s   file {size_mb:8,.1f} MB")
+    finally:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--chats", type=int, default=50_000)
+    parser.add_argument("--reads", type=int, default=5_000)
+    parser.add_argument("--batch", type=int, default=1_000, help="rows per insert transaction")
+    args = parser.parse_args()
+
+    # ~180 bytes: a short message after Fernet + base64
+    payload = base64.urlsafe_b64encode(os.urandom(135)).decode()
+    chat_ids = [new_id() for _ in range(args.chats)]
+    start = datetime(2025, 1, 1)
+    start_ms = int(start.timestamp() * 1000)
+
+    print(f"{args.rows:,} messages across {args.chats:,} chats, {args.reads:,} history reads")
+    run("legacy", LEGACY_SCHEMA,
+        "INSERT INTO chat_messages (id, chat_id, encrypted_content, sender, created_at) VALUES (?, ?, ?, ?, ?)",
+        "SELECT encrypted_content, sender, created_at FROM chat_messages WHERE chat_id = ? ORDER BY created_at",
+        legacy_rows(chat_ids, args.rows, payload, start), args.rows, chat_ids, args.reads, args.batch)
+    run("clustered", CLUSTERED_SCHEMA,
+        "INSERT INTO chat_messages (chat_id, seq, id, encrypted_content, sender, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        "SELECT encrypted_content, sender, created_at FROM chat_messages WHERE chat_id = ? ORDER BY seq",
+        clustered_rows(chat_ids, args.rows, payload, start_ms), args.rows, chat_ids, args.reads, args.batch)
+
+
+if __name__ == "__main__":
+    main()
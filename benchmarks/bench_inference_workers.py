@@ -0,0 +1,90 @@
+"""Inference throughput vs. number of forked workers, on a tiny stand-in model.
+
+Usage:
+    python benchmarks/bench_inference_workers.py --workers 1 2 4 8 --requests 64
+
+A small randomly initialised transformer decodes greedily, token by token,
+the way `generate` does, so the numbers show how the digitalocean/ worker
+pool scales with core groups without downloading MedGemma. Needs torch.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "digitalocean"))
+from worker_pool import WorkerPool, split_cores  # noqa: E402
+
+VOCAB = 4096
+
+
+class TinyDecoder(torch.nn.Module):
+    def __init__(self, dim: int, layers: int):
+        super().__init__()
+        self.embed = torch.nn.Embedding(VOCAB, dim)
+        layer = torch.nn.TransformerEncoderLayer(dim, nhead=8, dim_feedforward=dim * 4, batch_first=True)
+        self.blocks = torch.nn.TransformerEncoder(layer, layers)
+        self.head = torch.nn.Linear(dim, VOCAB)
+
+    def forward(self, tokens):
+        mask = torch.nn.Transformer.generate_square_subsequent_mask(tokens.shape[1])
+        return self.head(self.blocks(self.embed(tokens), mask=mask, is_causal=True))
+
+
+model = None
+
+
+def decode(prompt_tokens: int, new_tokens: int) -> int:
+    tokens = torch.randint(0, VOCAB, (1, prompt_tokens))
+    with torch.no_grad():
+        for _ in range(new_tokens):
+            next_token = model(tokens)[:, -1].argmax(-1, keepdim=True)
+            tokens = torch.cat([tokens, next_token], dim=1)
+    return new_tokens
+
+
+async def run(workers: int, requests: int, prompt_tokens: int, new_tokens: int) -> float:
+    pool = WorkerPool(decode, workers, warm_up=lambda: decode(prompt_tokens, 2))
+    await asyncio.to_thread(pool.start, asyncio.get_running_loop())
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*[pool.submit(prompt_tokens, new_tokens) for _ in range(requests)])
+        return time.perf_counter() - started
+    finally:
+        pool.stop()
+
+
+def main():
+    global model
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--prompt-tokens", type=int, default=256)
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--layers", type=int, default=6)
+    args = parser.parse_args()
+
+    # Same recipe as the service: build in a single-threaded parent, then fork
+    torch.set_num_threads(1)
+    torch.manual_seed(0)
+    model = TinyDecoder(args.dim, args.layers).eval()
+
+    cores = len(os.sched_getaffinity(0))
+    print(f"{cores} cores, {args.requests} requests x {args.new_tokens} tokens "
+          f"(prompt {args.prompt_tokens}, dim {args.dim}, {args.layers} layers)")
+    baseline = None
+    for workers in args.workers:
+        groups = split_cores(workers)
+        seconds = asyncio.run(run(workers, args.requests, args.prompt_tokens, args.new_tokens))
+        throughput = args.requests * args.new_tokens / seconds
+        baseline = baseline or throughput
+        print(f"{len(groups):3d} workers x {len(groups[0]):2d} threads   "
+              f"{args.requests / seconds:7.2f} req/s   {throughput:8.1f} tok/s   x{throughput / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Logging overhead per request: print() versus the queued JSON logger.
+
+Usage:
+    python benchmarks/bench_logging.py --requests 50000 [--sink-delay-us 200] [--concurrent-writer]
+
+Each simulated request emits what a /api/chat/send does: two "message
+added" records and one record for the upstream call, with their extra
+fields. Output goes to a line-buffered file; --sink-delay-us makes every
+write block that long, like stdout into a container log pipe that is
+backed up. The numbers are the time the request itself spends logging.
+For the queued logger the writer thread's work is reported separately as
+drain time: in a server it runs in the gaps between requests, so by
+default it starts after the requests are timed; --concurrent-writer runs
+it alongside, where it competes with the requests for the GIL.
+"""
+import argparse
+import logging
+import os
+import queue
+import sys
+import tempfile
+import time
+from logging.handlers import QueueListener
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from structured_logging import (  # noqa: E402
+    BufferedQueueHandler, JsonFormatter, SamplingFilter, skip_unused_record_fields
+)
+
+RECORDS_PER_REQUEST = 3
+
+
+def request_with_print(out, i):
+    print(f"✅ Message added to chat chat-{i}", file=out)
+    print(f"✅ Message added to chat chat-{i}", file=out)
+    print("📥 Response received: 200 (HTTP/1.1) in 1.234s, 87 tokens", file=out)
+
+
+def request_with_logger(logger, i):
+    logger.info("✅ Message added", extra={"event": "chat.message_added", "chat_id": f"chat-{i}"})
+    logger.info("✅ Message added", extra={"event": "chat.message_added", "chat_id": f"chat-{i}"})
+    logger.info("✅ Medical API call done", extra={
+        "event": "medical_api.call", "seconds": 1.234, "image_bytes": 48213,
+        "max_new_tokens": 500, "tokens_generated": 87, "stop_reason": "eos", "http_version": "HTTP/1.1",
+    })
+
+
+def request_below_level(logger, i):
+    logger.debug("Message added", extra={"event": "chat.message_added", "chat_id": f"chat-{i}"})
+    logger.debug("Message added", extra={"event": "chat.message_added", "chat_id": f"chat-{i}"})
+    logger.debug("Medical API call done", extra={"event": "medical_api.call", "seconds": 1.234})
+
+
+class SlowFile:
+    """A file whose every write blocks for `delay` seconds"""
+
+    def __init__(self, out, delay):
+        self.out = out
+        self.delay = delay
+
+    def write(self, text):
+        self.out.write(text)
+        if self.delay:
+            time.sleep(self.delay)
+
+    def flush(self):
+        self.out.flush()
+
+
+def fresh_logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.handlers[:] = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def measure(request, target, requests):
+    started = time.perf_counter()
+    for i in range(requests):
+        request(target, i)
+    return (time.perf_counter() - started) / requests * 1e6
+
+
+def queued(out, sample):
+    output = logging.StreamHandler(out)
+    output.setFormatter(JsonFormatter("bench"))
+    handler = BufferedQueueHandler(queue.SimpleQueue(), max_size=10 ** 7)
+    handler.addFilter(SamplingFilter(sample))
+    return handler, QueueListener(handler.queue, output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50_000)
+    parser.add_argument("--sink-delay-us", type=float, default=0.0, help="time every write to the output blocks")
+    parser.add_argument("--concurrent-writer", action="store_true",
+                        help="run the writer thread while requests are timed")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out = SlowFile(open(os.path.join(tmp, "out.log"), "w", buffering=1), args.sink_delay_us / 1e6)
+        results = [("print()", measure(request_with_print, out, args.requests), None)]
+
+        sync = logging.StreamHandler(out)
+        sync.setFormatter(JsonFormatter("bench"))
+        results.append(("sync JSON handler",
+                        measure(request_with_logger, fresh_logger("bench.sync", sync), args.requests), None))
+
+        skip_unused_record_fields()  # As setup_logging does
+        for name, sample in [("queued JSON", {}), ("queued, messages 1/20", {"chat.message_added": 20})]:
+            handler, listener = queued(out, sample)
+            logger = fresh_logger(f"bench.{len(results)}", handler)
+            if args.concurrent_writer:
+                listener.start()
+            per_request = measure(request_with_logger, logger, args.requests)
+            drain_started = time.perf_counter()
+            if not args.concurrent_writer:
+                listener.start()
+            listener.stop()  # Returns once the queue is empty
+            results.append((name, per_request, time.perf_counter() - drain_started))
+
+        results.append(("below level", measure(request_below_level, fresh_logger("bench.debug", sync),
+                                                args.requests), None))
+        out.out.close()
+
+    print(f"{args.requests} requests, {RECORDS_PER_REQUEST} records each, "
+          f"{args.sink_delay_us:g} us per write, writer {'concurrent' if args.concurrent_writer else 'after'}")
+    print(f"{'logging':24s} {'us/request':>11s} {'drain s':>8s}")
+    for name, per_request, drain in results:
+        print(f"{name:24s} {per_request:11.2f} {f'{drain:.2f}' if drain is not None else '-':>8s}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Bytes per chat message for each storage tier.
+
+Usage:
+    python benchmarks/bench_message_storage.py --chats 2000 --messages 12
+
+Compares, on the same synthetic conversations:
+  text      base64 Fernet token in a TEXT column (the original format)
+  blob      binary Fernet token in a BLOB column
+  deflate   BLOB over dictionary-compressed plaintext (zlib fallback)
+  zstd      BLOB over dictionary-compressed plaintext (needs `zstandard`)
+  archive   one compressed, encrypted pack per chat in chat_archive
+
+Each tier is written to its own SQLite file and VACUUMed, so the numbers
+include page and index overhead, not just payload sizes.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from database import message_codec  # noqa: E402
+from database.ids import new_id  # noqa: E402
+from database.keyring import UserKeyring  # noqa: E402
+
+QUESTIONS = [
+    "I have had a dull pain in my lower back for {n} days, it gets worse when I sit. What could it be?",
+    "My {rel} was told the chest x-ray shows a small opacity in the right lung. Should we be worried?",
+    "What does a white blood cell count of {n}.{m} mean on my blood test?",
+    "Is it normal to feel dizzy after starting a new blood pressure medication?",
+    "Can you explain what the radiology report means by mild degenerative changes?",
+    "Son {n} gündür ateşim var ve boğazım ağrıyor, ne yapmalıyım?",
+    "How long does recovery usually take after a minor knee arthroscopy?",
+]
+ANSWER_SENTENCES = [
+    "Based on what you describe, the most common causes are muscle strain and poor posture.",
+    "An opacity on a chest x-ray can have many causes, including infection, scarring or fluid.",
+    "A value in that range is usually within normal limits, but it should be read with the rest of the panel.",
+    "Dizziness is a known side effect in the first weeks and often settles as your body adjusts.",
+    "Degenerative changes describe normal wear of the joints and discs that comes with age.",
+    "Please seek immediate medical attention if you develop shortness of breath, fever or severe pain.",
+    "Your doctor may recommend a follow-up CT scan to compare with the previous image.",
+    "Rest, hydration and over-the-counter pain relief can help while you wait for your appointment.",
+    "I recommend consulting with a qualified healthcare professional for accurate medical advice and diagnosis.",
+    "This is not a substitute for professional medical advice, diagnosis, or treatment.",
+]
+
+SCHEMA = '''
+CREATE TABLE chat_messages (
+    chat_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    encrypted_content TEXT NOT NULL,
+    key_id INTEGER NOT NULL DEFAULT 1,
+    sender TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, seq)
+) WITHOUT ROWID;
+CREATE UNIQUE INDEX idx_chat_messages_id ON chat_messages(id);
+CREATE TABLE chat_archive (
+    chat_id TEXT PRIMARY KEY,
+    key_id INTEGER NOT NULL,
+    message_count INTEGER NOT NULL,
+    packed BLOB NOT NULL,
+    archived_at INTEGER NOT NULL
+);
+'''
+
+
+def conversations(chats, messages, rng):
+    for _ in range(chats):
+        chat = []
+        for seq in range(1, messages + 1):
+            if seq % 2:
+                text = rng.choice(QUESTIONS).format(n=rng.randint(2, 14), m=rng.randint(0, 9),
+                                                    rel=rng.choice(["mother", "father", "wife"]))
+                sender = "user"
+            else:
+                text = " ".join(rng.sample(ANSWER_SENTENCES, rng.randint(2, 6)))
+                sender = "assistant"
+            chat.append((seq, new_id(), sender, 1_700_000_000_000 + seq, text))
+        yield new_id(), chat
+
+
+def file_bytes(rows, archive_rows=()):
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(path)
+        conn.executescript(SCHEMA)
+        conn.executemany("INSERT INTO chat_messages VALUES (?, ?, ?, ?, 1, ?, ?)", rows)
+        conn.executemany("INSERT INTO chat_archive VALUES (?, 1, ?, ?, 0)", archive_rows)
+        conn.commit()
+        conn.execute("VACUUM")
+        conn.close()
+        return os.path.getsize(path)
+    finally:
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=12, help="messages per chat")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    keyring = UserKeyring("1", "user@example.com", current_id=1)
+    fernet = keyring.fernet(1)
+    data = list(conversations(args.chats, args.messages, random.Random(args.seed)))
+    total = args.chats * args.messages
+    plaintext = sum(len(m[4].encode()) for _, chat in data for m in chat)
+
+    def rows(encode):
+        return [(chat_id, seq, mid, encode(text), sender, created)
+                for chat_id, chat in data for seq, mid, sender, created, text in chat]
+
+    tiers = {
+        "text": rows(lambda text: fernet.encrypt(text.encode()).decode()),
+        "blob": rows(lambda text: base64.urlsafe_b64decode(fernet.encrypt(text.encode()))),
+    }
+    zstandard = message_codec.zstandard
+    message_codec.zstandard = None
+    tiers["deflate"] = rows(lambda text: message_codec.seal(keyring, text)[1])
+    message_codec.zstandard = zstandard
+    if zstandard is not None:
+        tiers["zstd"] = rows(lambda text: message_codec.seal(keyring, text)[1])
+
+    print(f"{args.chats} chats x {args.messages} messages, "
+          f"{plaintext / total:.0f} plaintext bytes per message on average")
+    print(f"{'tier':8s} {'payload B/msg':>14s} {'file B/msg':>11s}")
+    baseline = None
+    for name, tier_rows in tiers.items():
+        payload = sum(len(row[3]) for row in tier_rows) / total
+        on_disk = file_bytes(tier_rows) / total
+        baseline = baseline or on_disk
+        print(f"{name:8s} {payload:14.0f} {on_disk:11.0f}   x{on_disk / baseline:.2f}")
+
+    packs = [(chat_id, len(chat), message_codec.seal(keyring, json.dumps(chat, separators=(',', ':')))[1])
+             for chat_id, chat in data]
+    payload = sum(len(p[2]) for p in packs) / total
+    on_disk = file_bytes([], packs) / total
+    print(f"{'archive':8s} {payload:14.0f} {on_disk:11.0f}   x{on_disk / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
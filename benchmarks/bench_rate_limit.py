@@ -0,0 +1,77 @@
+"""Per-request cost of RateLimitMiddleware.
+
+Usage:
+    python benchmarks/bench_rate_limit.py --requests 200000 --clients 1000
+
+Calls the middleware directly around an ASGI app that does nothing, so the
+numbers are the limiter's own overhead: route lookup, bucket arithmetic
+and, for user-keyed routes, reading the token from the Cookie header. The
+shared tier is measured separately on a throwaway SQLite file.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from database.shared_state import SharedState  # noqa: E402
+from rate_limit import RateLimit, RateLimiter, RateLimitMiddleware  # noqa: E402
+
+
+async def noop_app(scope, receive, send):
+    pass
+
+
+async def noop_send(message):
+    pass
+
+
+def scope(path, client, cookie=None):
+    headers = [(b"host", b"example.com"), (b"user-agent", b"bench")]
+    if cookie:
+        headers.append((b"cookie", cookie.encode()))
+    return {"type": "http", "method": "POST", "path": path, "client": (client, 1234), "headers": headers}
+
+
+async def measure(middleware, scopes, requests):
+    started = time.perf_counter()
+    for i in range(requests):
+        await middleware(scopes[i % len(scopes)], None, noop_send)
+    return (time.perf_counter() - started) / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200_000)
+    parser.add_argument("--clients", type=int, default=1000)
+    args = parser.parse_args()
+
+    huge = 10 ** 9  # Never refuse: measure the allowed path
+    limits = [
+        RateLimit("POST", "/ip", per_minute=huge, burst=huge),
+        RateLimit("POST", "/user", per_minute=huge, burst=huge, key="user"),
+        RateLimit("POST", "/shared", per_minute=huge, burst=huge, shared=True),
+    ]
+    with tempfile.TemporaryDirectory() as data_dir:
+        shared_state = SharedState(os.path.join(data_dir, "shared.db"))
+        shared_state.init_db()
+        limiter = RateLimiter(limits, subject=lambda token: (token, time.time() + 3600),
+                              shared_state=shared_state)
+        middleware = RateLimitMiddleware(noop_app, limiter)
+        bare = [scope("/none", f"10.0.{i // 256}.{i % 256}") for i in range(args.clients)]
+        by_ip = [scope("/ip", f"10.0.{i // 256}.{i % 256}") for i in range(args.clients)]
+        by_user = [scope("/user", "10.0.0.1", f"theme=dark; token=user{i}") for i in range(args.clients)]
+        shared = [scope("/shared", f"10.0.{i // 256}.{i % 256}") for i in range(args.clients)]
+
+        print(f"{args.clients} clients")
+        print(f"{'route':14s} {'us/request':>11s}")
+        for name, scopes, requests in [("unlimited", bare, args.requests), ("ip bucket", by_ip, args.requests),
+                                       ("user bucket", by_user, args.requests),
+                                       ("shared bucket", shared, max(args.requests // 100, 100))]:
+            print(f"{name:14s} {asyncio.run(measure(middleware, scopes, requests)):11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Greedy vs. speculative (assisted) decoding: tokens/s and exact output equality.
+
+Usage:
+    python benchmarks/bench_speculative.py \\
+        --target HuggingFaceTB/SmolLM2-360M-Instruct \\
+        --draft HuggingFaceTB/SmolLM2-135M-Instruct --draft-tokens 5
+
+Any causal LM pair that shares a tokenizer works, including local paths.
+The draft path goes through the same digitalocean/speculative.py code the
+inference service uses, so the acceptance numbers match what /stats reports.
+Needs torch and transformers.
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "digitalocean"))
+from speculative import SpeculativeDecoder, generate  # noqa: E402
+
+PROMPTS = [
+    "What are the common causes of chest pain in young adults?",
+    "Explain the difference between benign and malignant tumours.",
+    "What does an elevated white blood cell count usually indicate?",
+    "Describe the typical histopathological features of adenocarcinoma.",
+    "How is type 2 diabetes diagnosed and managed?",
+    "What are the warning signs of a stroke?",
+]
+
+
+def tokenize(tokenizer, prompt):
+    messages = [{"role": "user", "content": prompt}]
+    if tokenizer.chat_template:
+        return tokenizer.apply_chat_template(
+            messages, add_generation_prompt=True, return_dict=True, return_tensors="pt"
+        )
+    return tokenizer(prompt, return_tensors="pt")
+
+
+def timed(model, inputs, kwargs, draft=None):
+    started = time.perf_counter()
+    outputs = generate(model, dict(inputs), kwargs, draft)
+    seconds = time.perf_counter() - started
+    return outputs[0, inputs["input_ids"].shape[-1]:], seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", required=True)
+    parser.add_argument("--draft", required=True)
+    parser.add_argument("--draft-tokens", type=int, default=5)
+    parser.add_argument("--max-new-tokens", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    tokenizer = AutoTokenizer.from_pretrained(args.target)
+    target = AutoModelForCausalLM.from_pretrained(args.target, torch_dtype=torch.float32).eval()
+    draft_model = AutoModelForCausalLM.from_pretrained(args.draft, torch_dtype=torch.float32).eval()
+    draft = SpeculativeDecoder(draft_model, tokenizer, draft_tokens=args.draft_tokens)
+    draft.stats.attach(target, draft_model)
+
+    kwargs = {
+        "max_new_tokens": args.max_new_tokens,
+        "do_sample": False,
+        "pad_token_id": tokenizer.pad_token_id or tokenizer.eos_token_id,
+        "use_cache": True,
+    }
+
+    # One untimed pass each so lazy initialisation doesn't skew the first prompt
+    warm = tokenize(tokenizer, "Hello")
+    with torch.no_grad():
+        generate(target, dict(warm), dict(kwargs, max_new_tokens=4))
+        generate(target, dict(warm), dict(kwargs, max_new_tokens=4), draft)
+    draft.stats.reset()
+
+    plain_tokens = plain_seconds = spec_tokens = spec_seconds = 0
+    mismatches = 0
+    print(f"target {args.target}, draft {args.draft}, {args.draft_tokens} draft tokens per step")
+    with torch.no_grad():
+        for prompt in PROMPTS:
+            inputs = tokenize(tokenizer, prompt)
+            plain, t_plain = timed(target, inputs, kwargs)
+            spec, t_spec = timed(target, inputs, kwargs, draft)
+            same = torch.equal(plain, spec)
+            mismatches += not same
+            plain_tokens += len(plain)
+            plain_seconds += t_plain
+            spec_tokens += len(spec)
+            spec_seconds += t_spec
+            print(f"  {len(plain):4d} tok  greedy {len(plain) / t_plain:6.1f} tok/s  "
+                  f"speculative {len(spec) / t_spec:6.1f} tok/s  {'identical' if same else 'DIFFERENT'}")
+
+    stats = draft.stats.as_dict()
+    print(f"greedy      {plain_tokens / plain_seconds:6.1f} tok/s")
+    print(f"speculative {spec_tokens / spec_seconds:6.1f} tok/s  "
+          f"(x{(spec_tokens / spec_seconds) / (plain_tokens / plain_seconds):.2f}, "
+          f"acceptance {stats['acceptance_rate']}, {stats['tokens_per_step']} tokens per target pass)")
+    print(f"outputs identical for {len(PROMPTS) - mismatches}/{len(PROMPTS)} prompts")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Cold-start time of the web app: module import plus lifespan startup.
+
+Usage:
+    python benchmarks/bench_startup.py --runs 5 --target-ms 1500
+
+Each run is a fresh interpreter against a throwaway data directory, like a
+new worker booting. Exits non-zero when the median exceeds --target-ms, so
+it can gate a deploy.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+PROBE = '''
+import asyncio, json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def boot():
+    async with main.lifespan(main.app):
+        return time.perf_counter()
+
+ready = asyncio.run(boot())
+print(json.dumps({"import_ms": (imported - started) * 1000, "ready_ms": (ready - started) * 1000}))
+'''
+
+
+def run_once(data_dir):
+    env = dict(os.environ, DATABASE_PATH=data_dir)
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=ROOT, env=env,
+        capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--target-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    samples = []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as data_dir:
+            samples.append(run_once(data_dir))
+
+    import_ms = statistics.median(s["import_ms"] for s in samples)
+    ready_ms = statistics.median(s["ready_ms"] for s in samples)
+    print(f"median over {args.runs} runs: import {import_ms:.0f} ms, ready to serve {ready_ms:.0f} ms")
+
+    if args.target_ms is not None and ready_ms > args.target_ms:
+        print(f"❌ startup {ready_ms:.0f} ms exceeds target {args.target_ms:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""/ws/chat load test: connections per worker, memory per connection, reply latency.
+
+Usage:
+    python benchmarks/bench_ws_chat.py --connections 1000 --messages 3
+
+Starts one uvicorn worker on a throwaway data directory, registers a user,
+opens the requested number of sockets in waves and reads the worker's RSS
+after each wave. Then every connection sends messages concurrently and
+the time to the final "done" frame is measured. Without GEMINI_API_KEY the
+reply is the mock response, so the numbers describe the channel and the
+database, not the model. Raise `ulimit -n` above the connection count.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import websockets
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+def rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+METRICS_TOKEN = "bench-metrics"
+
+
+def http(base, path, body=None, cookie=None):
+    request = urllib.request.Request(
+        base + path,
+        data=json.dumps(body).encode() if body is not None else None,
+        headers={"Content-Type": "application/json", "X-Metrics-Token": METRICS_TOKEN,
+                 **({"Cookie": cookie} if cookie else {})},
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.headers, json.loads(response.read())
+
+
+def wait_until_up(base, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            http(base, "/api/guest/usage")
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit("server did not start")
+
+
+async def open_socket(url, cookie):
+    socket = await websockets.connect(url, additional_headers={"Cookie": cookie}, max_size=None)
+    ready = json.loads(await socket.recv())
+    assert ready["type"] == "ready", ready
+    return socket
+
+
+async def converse(socket, messages):
+    latencies = []
+    chat_id = None
+    for i in range(messages):
+        started = time.perf_counter()
+        await socket.send(json.dumps({"type": "send", "ref": i, "message": f"load test question {i}",
+                                      "chat_id": chat_id}))
+        while True:
+            frame = json.loads(await socket.recv())
+            if frame["type"] == "error":
+                raise RuntimeError(frame["detail"])
+            if frame["type"] == "done":
+                chat_id = frame["chat_id"]
+                break
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def run(args, base, pid, cookie):
+    url = base.replace("http", "ws", 1) + "/ws/chat"
+    baseline = rss_kb(pid)
+    sockets = []
+    print(f"worker pid {pid}, idle RSS {baseline / 1024:.1f} MB")
+    while len(sockets) < args.connections:
+        wave = min(args.wave, args.connections - len(sockets))
+        sockets += await asyncio.gather(*[open_socket(url, cookie) for _ in range(wave)])
+        await asyncio.sleep(0.5)
+        rss = rss_kb(pid)
+        print(f"  {len(sockets):6d} open   RSS {rss / 1024:7.1f} MB   "
+              f"{(rss - baseline) / len(sockets):6.1f} KB per connection")
+    _, metrics = http(base, "/api/metrics/ws")
+    print(f"worker reports {metrics['connections']} open connections")
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[converse(s, args.messages) for s in sockets])
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency for result in results for latency in result)
+    print(f"{len(latencies)} round trips in {elapsed:.1f}s ({len(latencies) / elapsed:.0f} msg/s)   "
+          f"p50 {statistics.median(latencies) * 1000:.0f} ms   "
+          f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f} ms")
+    print(f"RSS after traffic {rss_kb(pid) / 1024:.1f} MB")
+    await asyncio.gather(*[s.close() for s in sockets])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--wave", type=int, default=100, help="sockets opened per wave")
+    parser.add_argument("--messages", type=int, default=2, help="messages sent per connection")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    base = f"http://127.0.0.1:{args.port}"
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = dict(os.environ, DATABASE_PATH=data_dir, GEMINI_API_KEY="", METRICS_TOKEN=METRICS_TOKEN)
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_until_up(base)
+            http(base, "/api/register", {"name": "Load", "email": "load@example.com", "password": "load-test"})
+            headers, _ = http(base, "/api/login", {"email": "load@example.com", "password": "load-test"})
+            cookie = headers["set-cookie"].split(";")[0]
+            asyncio.run(run(args, base, server.pid, cookie))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
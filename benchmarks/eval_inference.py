@@ -0,0 +1,422 @@
+"""Replay a request corpus through the inference path and compare the reports.
+
+Usage:
+    # Against a running node; --pid (local node) adds its peak RSS
+    python benchmarks/eval_inference.py run --corpus corpus.jsonl \\
+        --url http://localhost:8001/inference --api-key $API_KEY --out baseline.json
+    # In this process, through load_model and the node's generate path
+    MODEL_DTYPE=bfloat16 python benchmarks/eval_inference.py run --corpus corpus.jsonl \\
+        --model path/to/small-model --out candidate.json
+    # Exits 1 past the slowdown or memory thresholds, or if any answer changed
+    python benchmarks/eval_inference.py compare baseline.json candidate.json
+
+The corpus is JSON lines of {"id", "text", "image", "max_new_tokens",
+"stop"}, `image` being a path relative to the corpus file; `--synthetic N`
+generates N requests with drawn images instead. Decoding is greedy, so
+the same model and code give the same answers, and a dtype, batching or
+fallback change that alters them shows up as a diff. Each request records
+latency, time to first token, tokens/s, stop reason and the answer; the
+summary adds percentiles and peak RSS. In-process mode needs torch and
+transformers; both modes need Pillow for --synthetic.
+"""
+import argparse
+import difflib
+import hashlib
+import io
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+REPORT_VERSION = 1
+
+QUESTIONS = [
+    "Describe the findings in this image.",
+    "Is there anything abnormal in this image?",
+    "What tissue type is shown here?",
+    "Summarise this image for a referring physician.",
+]
+
+
+def synthetic_corpus(count: int, max_new_tokens: int):
+    from PIL import Image, ImageDraw
+
+    corpus = []
+    for i in range(count):
+        size = 224 + 96 * (i % 4)
+        image = Image.new("RGB", (size, size), color=(40 + (13 * i) % 200, 90, 140))
+        draw = ImageDraw.Draw(image)
+        right = size // 2 + (8 * i) % (size // 4)
+        draw.ellipse([size // 4, size // 4, right, 3 * size // 4], fill=(220, 200, 180))
+        png = io.BytesIO()
+        image.save(png, format="PNG")
+        corpus.append({"id": f"synthetic-{i}", "text": QUESTIONS[i % len(QUESTIONS)],
+                       "image": png.getvalue(), "max_new_tokens": max_new_tokens, "stop": []})
+    return corpus
+
+
+def load_corpus(path: str, max_new_tokens: int):
+    base = os.path.dirname(os.path.abspath(path))
+    corpus = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            with open(os.path.join(base, entry["image"]), "rb") as image:
+                image_data = image.read()
+            corpus.append({"id": str(entry.get("id", number)), "text": entry["text"], "image": image_data,
+                           "max_new_tokens": int(entry.get("max_new_tokens", max_new_tokens)),
+                           "stop": list(entry.get("stop", []))})
+    return corpus
+
+
+def corpus_digest(corpus) -> str:
+    digest = hashlib.sha256()
+    for item in corpus:
+        digest.update(json.dumps([item["id"], item["text"], item["max_new_tokens"], item["stop"]]).encode())
+        digest.update(hashlib.sha256(item["image"]).digest())
+    return digest.hexdigest()[:16]
+
+
+class HttpTarget:
+    """POSTs each request to /inference the way the web app does"""
+
+    def __init__(self, url: str, api_key: str, pid=None, timeout: float = 300):
+        import httpx
+
+        self.url = url
+        self.pid = pid
+        self.client = httpx.Client(headers={"X-API-Key": api_key}, timeout=timeout)
+
+    def describe(self):
+        return {"mode": "http", "url": self.url}
+
+    def generate(self, item):
+        data = {"text": item["text"], "max_new_tokens": str(item["max_new_tokens"])}
+        if item["stop"]:
+            data["stop"] = json.dumps(item["stop"])
+        response = self.client.post(self.url, data=data, files={"image": ("image", item["image"])})
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+        result = response.json()
+        return {
+            "answer": result["response"],
+            "tokens": result.get("tokens_generated"),
+            "stop_reason": result.get("stop_reason"),
+            "first_token_s": seconds(result.get("first_token_ms")),
+            "generation_s": seconds(result.get("generation_ms")),
+        }
+
+    def peak_rss_mb(self):
+        """Peak RSS of the node process and its inference workers"""
+        if not self.pid:
+            return None
+        return sum(peak_rss_kb(pid) for pid in process_tree(self.pid)) / 1024
+
+
+class LocalTarget:
+    """Loads the model with the node's own loader and generates in this process"""
+
+    def __init__(self, model_name: str, prefix_cache: bool):
+        sys.path.insert(0, os.path.join(ROOT, "digitalocean"))
+        from generation import PromptCache, generate_response
+        from model_loader import MODEL_DTYPE, load_model, warm_up
+
+        self.model_name = model_name
+        self.system_prompt = os.getenv("SYSTEM_PROMPT", "")
+        self.dtype = MODEL_DTYPE
+        started = time.perf_counter()
+        self.model, self.processor, self.device = load_model(model_name, os.getenv("HF_TOKEN"))
+        self.load_s = time.perf_counter() - started
+        self.cache = (PromptCache(self.model, self.processor, self.device, self.system_prompt)
+                      if prefix_cache else None)
+        self._generate_response = generate_response
+        warm_up(self._run)
+
+    def describe(self):
+        return {"mode": "local", "model": self.model_name, "dtype": self.dtype, "device": self.device,
+                "prefix_cache": self.cache is not None, "load_s": round(self.load_s, 2)}
+
+    def _run(self, text, image, max_new_tokens, stop=()):
+        if self.cache is not None:
+            return self.cache.generate(text, image, max_new_tokens, stop)
+        return self._generate_response(self.model, self.processor, self.device, text, image,
+                                       max_new_tokens, self.system_prompt, None, stop)
+
+    def generate(self, item):
+        from PIL import Image
+
+        image = Image.open(io.BytesIO(item["image"])).convert("RGB")
+        result = self._run(item["text"], image, item["max_new_tokens"], tuple(item["stop"]))
+        return {
+            "answer": result.text,
+            "tokens": result.tokens_generated,
+            "stop_reason": result.stop_reason,
+            "first_token_s": result.first_token_seconds,
+            "generation_s": result.generation_seconds,
+        }
+
+    def peak_rss_mb(self):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def seconds(milliseconds):
+    return milliseconds / 1000 if milliseconds is not None else None
+
+
+def process_tree(pid: int):
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            for child in f.read().split():
+                pids += process_tree(int(child))
+    except OSError:
+        pass
+    return pids
+
+
+def peak_rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(values, fraction):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def rounded(value, digits=4):
+    return round(value, digits) if value is not None else None
+
+
+def measure(target, item, run: int):
+    record = {"id": item["id"], "run": run}
+    started = time.perf_counter()
+    try:
+        result = target.generate(item)
+    except Exception as e:
+        record["error"] = str(e)
+        return record
+    latency = time.perf_counter() - started
+    tokens = result["tokens"]
+    generation = result["generation_s"] or latency
+    first_token = result["first_token_s"]
+    record.update({
+        "latency_s": rounded(latency),
+        "first_token_s": rounded(first_token),
+        "generation_s": rounded(result["generation_s"]),
+        "tokens": tokens,
+        "tokens_per_s": rounded(tokens / generation, 2) if tokens else None,
+        # Steady-state decoding speed, without the prefill before the first token
+        "decode_tokens_per_s": (rounded((tokens - 1) / (generation - first_token), 2)
+                                if tokens and tokens > 1 and first_token is not None
+                                and generation > first_token else None),
+        "stop_reason": result["stop_reason"],
+        "answer": result["answer"],
+    })
+    return record
+
+
+def summarize(records, peak_rss_mb):
+    ok = [r for r in records if "error" not in r]
+    latencies = [r["latency_s"] for r in ok]
+    first_tokens = [r["first_token_s"] for r in ok]
+    answers = {}
+    for r in ok:
+        answers.setdefault(r["id"], set()).add(r["answer"])
+    total_tokens = sum(r["tokens"] or 0 for r in ok)
+    total_generation = sum(r["generation_s"] or r["latency_s"] for r in ok)
+    stop_reasons = {}
+    for r in ok:
+        stop_reasons[r["stop_reason"]] = stop_reasons.get(r["stop_reason"], 0) + 1
+    return {
+        "requests": len(records),
+        "errors": len(records) - len(ok),
+        "latency_s": {"mean": rounded(statistics.mean(latencies)) if latencies else None,
+                      "p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95),
+                      "max": max(latencies, default=None)},
+        "first_token_s": {"p50": percentile(first_tokens, 0.5), "p95": percentile(first_tokens, 0.95)},
+        "tokens_per_s": rounded(total_tokens / total_generation, 2) if total_generation else None,
+        "decode_tokens_per_s": percentile([r["decode_tokens_per_s"] for r in ok], 0.5),
+        "tokens": total_tokens,
+        "stop_reasons": stop_reasons,
+        "peak_rss_mb": rounded(peak_rss_mb, 1),
+        # Greedy decoding should answer a repeated request identically
+        "unstable_ids": sorted(i for i, seen in answers.items() if len(seen) > 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    if args.synthetic:
+        corpus, source = synthetic_corpus(args.synthetic, args.max_new_tokens), f"synthetic:{args.synthetic}"
+    elif args.corpus:
+        corpus, source = load_corpus(args.corpus, args.max_new_tokens), args.corpus
+    else:
+        raise SystemExit("give --corpus or --synthetic")
+    if args.limit:
+        corpus = corpus[:args.limit]
+
+    if args.url:
+        target = HttpTarget(args.url, args.api_key or os.getenv("API_KEY", ""), args.pid)
+    elif args.model:
+        target = LocalTarget(args.model, not args.no_prefix_cache)
+    else:
+        raise SystemExit("give --url or --model")
+
+    for item in corpus[:args.warmup]:
+        measure(target, item, run=-1)
+
+    records = []
+    for repeat in range(args.repeat):
+        for item in corpus:
+            record = measure(target, item, repeat)
+            records.append(record)
+            if "error" in record:
+                print(f"  {item['id']:24s} ERROR {record['error']}")
+            else:
+                print(f"  {item['id']:24s} {record['latency_s']:8.3f}s  {record['tokens'] or 0:4d} tok  "
+                      f"{record['tokens_per_s'] or 0:7.1f} tok/s  {record['stop_reason']}")
+
+    report = {
+        "version": REPORT_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "label": args.label,
+        "commit": git_commit(),
+        "target": target.describe(),
+        "settings": {name: os.getenv(name) for name in
+                     ("MODEL_DTYPE", "SERVE_WORKERS", "TORCH_THREADS", "PREFIX_CACHE", "DRAFT_MODEL_NAME")},
+        "corpus": {"source": source, "requests": len(corpus), "digest": corpus_digest(corpus),
+                   "repeat": args.repeat},
+        "summary": summarize(records, target.peak_rss_mb()),
+        "requests": records,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    summary = report["summary"]
+    rss = f", peak RSS {summary['peak_rss_mb']} MB" if summary["peak_rss_mb"] is not None else ""
+    print(f"{summary['requests']} requests, {summary['errors']} errors, p50 {summary['latency_s']['p50']}s, "
+          f"p95 {summary['latency_s']['p95']}s, {summary['tokens_per_s']} tok/s{rss} -> {args.out}")
+    return 1 if summary["errors"] else 0
+
+
+def change(before, after):
+    if before is None or after is None or not before:
+        return None
+    return (after - before) / before
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline["corpus"]["digest"] != candidate["corpus"]["digest"]:
+        print("⚠️ The reports were made from different corpora; only shared ids are compared")
+
+    rows = [
+        ("latency p50 (s)", baseline["summary"]["latency_s"]["p50"], candidate["summary"]["latency_s"]["p50"], 1),
+        ("latency p95 (s)", baseline["summary"]["latency_s"]["p95"], candidate["summary"]["latency_s"]["p95"], 1),
+        ("first token p50 (s)", baseline["summary"]["first_token_s"]["p50"],
+         candidate["summary"]["first_token_s"]["p50"], 1),
+        ("tokens/s", baseline["summary"]["tokens_per_s"], candidate["summary"]["tokens_per_s"], -1),
+        ("decode tokens/s p50", baseline["summary"]["decode_tokens_per_s"],
+         candidate["summary"]["decode_tokens_per_s"], -1),
+        ("peak RSS (MB)", baseline["summary"]["peak_rss_mb"], candidate["summary"]["peak_rss_mb"], 1),
+    ]
+    regressions = []
+    print(f"{'metric':22s} {'baseline':>10s} {'candidate':>10s} {'change':>8s}")
+    for name, before, after, worse_when in rows:
+        delta = change(before, after)
+        print(f"{name:22s} {before if before is not None else '-':>10} {after if after is not None else '-':>10} "
+              f"{f'{delta:+.1%}' if delta is not None else '-':>8s}")
+        limit = args.max_rss_growth if name == "peak RSS (MB)" else args.max_slowdown
+        if delta is not None and delta * worse_when > limit:
+            regressions.append(f"{name} {delta:+.1%}")
+
+    def answers(report):
+        # The first run of each id; repeats are checked within a report
+        first = {}
+        for record in report["requests"]:
+            if "error" not in record:
+                first.setdefault(record["id"], record["answer"])
+        return first
+
+    before, after = answers(baseline), answers(candidate)
+    shared = [i for i in before if i in after]
+    changed = [i for i in shared if before[i] != after[i]]
+    print(f"answers identical for {len(shared) - len(changed)}/{len(shared)} requests")
+    for i in changed[:args.show_diffs]:
+        similarity = difflib.SequenceMatcher(None, before[i], after[i]).ratio()
+        print(f"--- {i} (similarity {similarity:.2f})")
+        for line in list(difflib.unified_diff(before[i].splitlines(), after[i].splitlines(),
+                                              "baseline", "candidate", lineterm=""))[2:22]:
+            print(f"    {line}")
+    unstable = candidate["summary"]["unstable_ids"]
+    if unstable:
+        print(f"⚠️ Answers changed between repeats in the candidate: {', '.join(unstable)}")
+
+    if regressions:
+        print(f"❌ Worse than baseline: {'; '.join(regressions)}")
+    if changed and not args.allow_answer_changes:
+        print(f"❌ {len(changed)} answers changed")
+    failed = regressions or (changed and not args.allow_answer_changes) or candidate["summary"]["errors"]
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="replay a corpus and write a report")
+    run_parser.add_argument("--corpus", help="JSON lines of requests")
+    run_parser.add_argument("--synthetic", type=int, default=0, help="generate this many requests instead")
+    run_parser.add_argument("--limit", type=int, default=0)
+    run_parser.add_argument("--url", help="the node's /inference endpoint")
+    run_parser.add_argument("--api-key", help="defaults to $API_KEY")
+    run_parser.add_argument("--pid", type=int, help="local node pid, for its peak RSS")
+    run_parser.add_argument("--model", help="model name or path to load in this process")
+    run_parser.add_argument("--no-prefix-cache", action="store_true")
+    run_parser.add_argument("--max-new-tokens", type=int, default=64)
+    run_parser.add_argument("--warmup", type=int, default=1, help="untimed requests first")
+    run_parser.add_argument("--repeat", type=int, default=1)
+    run_parser.add_argument("--label", default="")
+    run_parser.add_argument("--out", default="eval_report.json")
+
+    compare_parser = commands.add_parser("compare", help="compare a candidate report with a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--max-slowdown", type=float, default=0.10,
+                                help="fail when latency or throughput is this much worse")
+    compare_parser.add_argument("--max-rss-growth", type=float, default=0.10,
+                                help="fail when peak RSS grows this much")
+    compare_parser.add_argument("--allow-answer-changes", action="store_true")
+    compare_parser.add_argument("--show-diffs", type=int, default=5)
+
+    args = parser.parse_args()
+    sys.exit(run(args) if args.command == "run" else compare(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import hashlib
+import hmac
+import re
+
+# Words are indexed case-insensitively; one-letter tokens are too common to be useful
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+MIN_TOKEN_LENGTH = 2
+
+# 16 bytes of HMAC-SHA256 keeps collisions negligible at half the index size
+TOKEN_BYTES = 16
+
+
+def tokenize(text: str) -> set:
+    """Split text into the distinct, normalized words that get indexed"""
+    return {
+        word for word in TOKEN_PATTERN.findall(text.casefold())
+        if len(word) >= MIN_TOKEN_LENGTH
+    }
+
+
+def derive_index_key(user_key: bytes) -> bytes:
+    """Derive the per-user HMAC key for search tokens from the chat key.
+
+    Kept separate from the encryption key so a leaked index never helps
+    decrypt messages.
+    """
+    return hmac.new(user_key, b"radiglow-search-index-v1", hashlib.sha256).digest()
+
+
+def blind_token(word: str, index_key: bytes) -> bytes:
+    return hmac.new(index_key, word.encode(), hashlib.sha256).digest()[:TOKEN_BYTES]
+
+
+def blind_tokens(text: str, index_key: bytes) -> list:
+    """Keyed hashes of every indexed word in text; the plaintext never leaves memory"""
+    return [blind_token(word, index_key) for word in tokenize(text)]
@@ -1,63 +1,73 @@
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-import base64
+from cryptography.fernet import InvalidToken
 import os
 import sqlite3
 import json
-from datetime import datetime
-from pathlib import Path
+import logging
+from datetime import datetime, timezone
+from database.ids import new_id, now_ms, ms_to_iso, ISO_TO_MS_SQL
+from database.blind_index import tokenize, blind_token, blind_tokens
+from database.keyring import UserKeyring, derive_key, CURRENT_KEY_ID
+from database.message_codec import seal, unseal
+from database.migrations import Migration, MigrationRunner
+from database.paths import get_data_dir
+from collections import OrderedDict
+import threading
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Bump when the export record layout changes; imports refuse newer versions
+EXPORT_FORMAT_VERSION = 1
+
+# Chats untouched for this long are packed into chat_archive
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+
+# Deletion tombstones are kept this long; a client that last synced before
+# the newest one pruned gets the full chat list instead of a diff
+TOMBSTONE_RETENTION_DAYS = int(os.getenv("TOMBSTONE_RETENTION_DAYS", "30"))
+
+# Messages decrypted and indexed per write transaction when a user's
+# search index is first built
+SEARCH_INDEX_BATCH_SIZE = 500
+
+# Chat ids per statement in bulk deletes, well under SQLite's variable limit
+DELETE_BATCH_SIZE = 500
+
+# Users whose chat list is kept in memory per worker process
+CHAT_LIST_CACHE_USERS = 1024
 
 class ChatDB:
     def __init__(self, db_path=None):
-        if db_path is None:
-            # FIXED: Use persistent database path that survives restarts
-            self.db_path = self._get_persistent_db_path()
-        else:
-            self.db_path = db_path
-        self.init_db()
-        self.user_keys = {}  # Store user encryption keys in memory
-
-    def _get_persistent_db_path(self):
-        """Get persistent database path that survives server restarts"""
-        # Try multiple persistent locations in order of preference
-        possible_paths = [
-            "/opt/render/project/src/data",  # Render persistent storage
-            "/tmp/data",                     # Fallback for development
-            "./data",                       # Local fallback
-        ]
-        
-        # Create the first available directory
-        for path in possible_paths:
-            try:
-                data_dir = Path(path)
-                data_dir.mkdir(parents=True, exist_ok=True)
-                
-                # Test if we can write to this directory
-                test_file = data_dir / "test_write.tmp"
-                test_file.write_text("test")
-                test_file.unlink()
-                
-                db_path = data_dir / "radiglow_chats.db"
-                print(f"✅ Using persistent chat database path: {db_path.absolute()}")
-                return str(db_path)
-                
-            except Exception as e:
-                print(f"❌ Cannot use chat path {path}: {e}")
-                continue
-        
-        # Ultimate fallback - current directory
-        db_path = Path("radiglow_chats.db")
-        print(f"⚠️  Using fallback chat database path: {db_path.absolute()}")
-        return str(db_path)
+        # Nothing touches the filesystem until first use; the app lifespan
+        # calls init_db once at startup
+        self._db_path = db_path
+        self._initialized = False
+        self._init_lock = threading.Lock()
+        self.legacy_sessions_pending = False
+        self.legacy_messages_pending = False
+        self.migrations = MigrationRunner(self.get_connection, self._schema_migrations(), "Chat database")
+        # Store user encryption keys in memory. This is a per-process memo of a
+        # deterministic derivation, so each worker rebuilding it is safe; keys
+        # are deliberately never written to the shared state store.
+        self.user_keys = {}
+        # user_id -> (list version, chats); validated against the stored
+        # version on every read, so writes from other workers are seen
+        self._chat_list_cache = OrderedDict()
+        self._chat_list_lock = threading.Lock()
 
-    def get_connection(self):
+    @property
+    def db_path(self) -> str:
+        # FIXED: Use persistent database path that survives restarts
+        if self._db_path is None:
+            self._db_path = str(get_data_dir() / "radiglow_chats.db")
+        return self._db_path
+
+    def get_connection(self, check_same_thread: bool = True):
         """Get database connection with proper settings"""
-        conn = sqlite3.connect(self.db_path, timeout=30.0)
+        conn = sqlite3.connect(self.db_path, timeout=30.0, check_same_thread=check_same_thread)
         conn.row_factory = sqlite3.Row
         
-        # Enable WAL mode for better concurrency and crash recovery
-        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL mode is persistent in the database file, so init_db sets it once
         conn.execute("PRAGMA synchronous=NORMAL")
         conn.execute("PRAGMA cache_size=1000")
         conn.execute("PRAGMA temp_store=memory")
@@ -65,228 +75,1154 @@ class ChatDB:
         return conn
 
     def init_db(self):
-        """Initialize chat database with proper error handling"""
+        """Apply pending schema migrations and start any data backfills; idempotent"""
+        with self._init_lock:
+            if self._initialized:
+                return
+            self._init_db()
+            self._initialized = True
+    
+    def _init_db(self):
         try:
             conn = self.get_connection()
-            c = conn.cursor()
-            
-            # Create tables
-            c.execute('''
-            CREATE TABLE IF NOT EXISTS chat_sessions (
-                id TEXT PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                title TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL
-            )''')
-            
-            c.execute('''
-            CREATE TABLE IF NOT EXISTS chat_messages (
-                id TEXT PRIMARY KEY,
-                chat_id TEXT NOT NULL,
-                encrypted_content TEXT NOT NULL,
-                sender TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY (chat_id) REFERENCES chat_sessions(id)
-            )''')
-            
-            # Create indexes for better performance
-            c.execute('''
-                CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_id 
-                ON chat_sessions(user_id)
-            ''')
-            
-            c.execute('''
-                CREATE INDEX IF NOT EXISTS idx_chat_messages_chat_id 
-                ON chat_messages(chat_id)
-            ''')
-            
-            c.execute('''
-                CREATE INDEX IF NOT EXISTS idx_chat_sessions_updated_at 
-                ON chat_sessions(updated_at DESC)
-            ''')
-            
-            conn.commit()
+            # Only takes effect on a new, empty file; older files are
+            # converted by the maintenance scheduler
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            # Enable WAL mode for better concurrency and crash recovery
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.close()
             
-            # Check existing data to confirm persistence
-            c.execute("SELECT COUNT(*) as count FROM chat_sessions")
-            chat_count = c.fetchone()['count']
+            self.migrations.run()
+            pending = self.migrations.pending_backfills()
+            self.legacy_sessions_pending = 2 in pending
+            self.legacy_messages_pending = 3 in pending
             
-            c.execute("SELECT COUNT(*) as count FROM chat_messages")
-            message_count = c.fetchone()['count']
+            # Metadata only: a COUNT(*) here would scan every table on each boot
+            conn = self.get_connection()
+            c = conn.cursor()
+            c.execute("SELECT COALESCE(MAX(rowid), 0) FROM chat_sessions")
+            chat_high_water = c.fetchone()[0]
+            c.execute("PRAGMA page_count")
+            page_count = c.fetchone()[0]
+            c.execute("PRAGMA page_size")
+            page_size = c.fetchone()[0]
+            conn.close()
             
-            print(f"✅ Chat database initialized successfully")
-            print(f"📊 Existing chats: {chat_count}")
-            print(f"📊 Existing messages: {message_count}")
+            logger.info(f"✅ Chat database initialized successfully (schema v{self.migrations.current_version()})")
+            logger.info(f"📊 Chat sessions created: {chat_high_water}")
+            logger.info(f"📊 Database size: {page_count * page_size / 1e6:.1f} MB")
             
-            conn.close()
+            if self.migrations.start_backfills():
+                logger.info(f"🔄 Chat data backfills running in background: {pending}")
             
         except Exception as e:
-            print(f"❌ Chat database initialization error: {e}")
+            logger.error(f"❌ Chat database initialization error: {e}")
             raise
     
-    def generate_user_key(self, user_id: str, password: str) -> bytes:
-        """Generate a unique encryption key for each user"""
-        salt = user_id.encode()
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
+    def _schema_migrations(self) -> list:
+        return [
+            Migration(1, "chat_sessions", apply=self._create_sessions),
+            Migration(2, "session_epoch_timestamps", apply=self._add_session_timestamps,
+                      backfill=self._backfill_session_timestamps,
+                      on_complete=lambda: setattr(self, 'legacy_sessions_pending', False)),
+            Migration(3, "clustered_messages", apply=self._create_clustered_messages,
+                      backfill=self._backfill_clustered_messages,
+                      on_complete=lambda: setattr(self, 'legacy_messages_pending', False)),
+            Migration(4, "search_index", apply=self._create_search_index),
+            Migration(5, "message_key_ids", apply=self._add_message_key_ids),
+            Migration(6, "chat_archive", apply=self._create_archive),
+            Migration(7, "chat_list_versions", apply=self._create_chat_list_versions),
+            Migration(8, "cascade_chat_deletes", apply=self._create_delete_cascade),
+            Migration(9, "tombstone_retention", apply=self._add_tombstone_retention),
+            Migration(10, "inference_jobs", apply=self._create_inference_jobs),
+            Migration(11, "fair_share_jobs", apply=self._add_job_fair_share),
+        ]
+    
+    def _create_sessions(self, c):
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )''')
+        
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_id 
+            ON chat_sessions(user_id)
+        ''')
+    
+    def _add_session_timestamps(self, c):
+        # Epoch-ms timestamps for sessions; the ISO TEXT columns are kept
+        # (and still written) because SQLite cannot drop NOT NULL columns
+        c.execute("PRAGMA table_info(chat_sessions)")
+        if 'updated_ts' not in {row['name'] for row in c.fetchall()}:
+            c.execute("ALTER TABLE chat_sessions ADD COLUMN created_ts INTEGER")
+            c.execute("ALTER TABLE chat_sessions ADD COLUMN updated_ts INTEGER")
+        
+        # Nothing orders by the TEXT column any more
+        c.execute("DROP INDEX IF EXISTS idx_chat_sessions_updated_at")
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_updated 
+            ON chat_sessions(user_id, updated_ts DESC)
+        ''')
+    
+    def _backfill_session_timestamps(self, c, cursor, batch_size):
+        # Walk the rowid so each batch is a range seek, never a rescan
+        last_rowid = int(cursor or 0)
+        c.execute(
+            'SELECT rowid FROM chat_sessions WHERE rowid > ? ORDER BY rowid LIMIT ?',
+            (last_rowid, batch_size)
         )
-        key = base64.urlsafe_b64encode(kdf.derive(password.encode()))
-        return key
+        rowids = [row[0] for row in c.fetchall()]
+        if not rowids:
+            return None, 0
+        rows = self._backfill_sessions(c, 'rowid BETWEEN ? AND ?', (rowids[0], rowids[-1]))
+        return str(rowids[-1]), rows
+    
+    def _create_clustered_messages(self, c):
+        # Databases created before time-ordered ids keep their random-id
+        # message table aside; the backfill moves it over chat by chat
+        c.execute("PRAGMA table_info(chat_messages)")
+        message_columns = {row['name'] for row in c.fetchall()}
+        if message_columns and 'seq' not in message_columns:
+            c.execute("ALTER TABLE chat_messages RENAME TO chat_messages_legacy")
+        
+        # Messages are clustered by (chat_id, seq): a chat's history is one
+        # contiguous range of the table and is read back already in order
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            chat_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            id TEXT NOT NULL,
+            encrypted_content TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, seq),
+            FOREIGN KEY (chat_id) REFERENCES chat_sessions(id)
+        ) WITHOUT ROWID''')
+        
+        c.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_messages_id 
+            ON chat_messages(id)
+        ''')
+    
+    def _backfill_clustered_messages(self, c, cursor, batch_size):
+        # The legacy table shrinks as chats move, so it is its own progress
+        # marker; the cursor just counts migrated messages
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages_legacy'")
+        if not c.fetchone():
+            return None, 0
+        
+        c.execute('SELECT DISTINCT chat_id FROM chat_messages_legacy LIMIT ?', (max(batch_size // 10, 1),))
+        chat_ids = [row[0] for row in c.fetchall()]
+        if not chat_ids:
+            c.execute('DROP TABLE chat_messages_legacy')
+            return None, 0
+        
+        moved = self._migrate_chats(c, chat_ids)
+        return str(int(cursor or 0) + moved), moved
+    
+    def _create_search_index(self, c):
+        # Blind search index: keyed hashes of message words, clustered by
+        # (user_id, token) so a lookup is a single range scan
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS chat_search_index (
+            user_id TEXT NOT NULL,
+            token BLOB NOT NULL,
+            chat_id TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            PRIMARY KEY (user_id, token, message_id)
+        ) WITHOUT ROWID''')
+        
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_search_index_chat_id 
+            ON chat_search_index(chat_id)
+        ''')
+        
+        # Users whose messages written before the index existed are backfilled
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS chat_search_state (
+            user_id TEXT PRIMARY KEY,
+            indexed_at TEXT NOT NULL
+        )''')
+    
+    def _add_message_key_ids(self, c):
+        # Every message written so far used the original key (id 1)
+        c.execute("PRAGMA table_info(chat_messages)")
+        if 'key_id' not in {row['name'] for row in c.fetchall()}:
+            c.execute("ALTER TABLE chat_messages ADD COLUMN key_id INTEGER NOT NULL DEFAULT 1")
+        
+        # Progress of re-encrypting messages to a new key, one row per target
+        # key id; the lease keeps a single worker process doing the work
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS key_rotation (
+            target_key_id INTEGER PRIMARY KEY,
+            cursor_chat_id TEXT NOT NULL DEFAULT '',
+            cursor_seq INTEGER NOT NULL DEFAULT 0,
+            rows_done INTEGER NOT NULL DEFAULT 0,
+            rows_failed INTEGER NOT NULL DEFAULT 0,
+            started_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            lease_until INTEGER NOT NULL DEFAULT 0
+        )''')
+    
+    def _create_archive(self, c):
+        # Cold chats are packed into one compressed, encrypted row each and
+        # their messages leave chat_messages. Packs can be large, so this is
+        # a rowid table (WITHOUT ROWID suits small rows only).
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS chat_archive (
+            chat_id TEXT PRIMARY KEY,
+            key_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            packed BLOB NOT NULL,
+            archived_at INTEGER NOT NULL
+        )''')
+        
+        c.execute("PRAGMA table_info(chat_sessions)")
+        if 'archived_at' not in {row['name'] for row in c.fetchall()}:
+            c.execute("ALTER TABLE chat_sessions ADD COLUMN archived_at INTEGER")
+        # Only live chats are candidates, so archived ones drop out of the index
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_sessions_cold 
+            ON chat_sessions(updated_ts) WHERE archived_at IS NULL
+        ''')
+        
+        c.execute("PRAGMA table_info(key_rotation)")
+        if 'archive_cursor' not in {row['name'] for row in c.fetchall()}:
+            c.execute("ALTER TABLE key_rotation ADD COLUMN archive_cursor TEXT NOT NULL DEFAULT ''")
+    
+    def _create_chat_list_versions(self, c):
+        # Each user's chat list has a version, bumped in the same transaction
+        # as every change to it; sessions record the version that last
+        # touched them and deletions leave a tombstone, so "what changed
+        # since v" is a range scan of either
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS chat_list_versions (
+            user_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID''')
+        
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS chat_tombstones (
+            user_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            chat_id TEXT NOT NULL,
+            PRIMARY KEY (user_id, version, chat_id)
+        ) WITHOUT ROWID''')
+        
+        c.execute("PRAGMA table_info(chat_sessions)")
+        if 'version' not in {row['name'] for row in c.fetchall()}:
+            c.execute("ALTER TABLE chat_sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_version 
+            ON chat_sessions(user_id, version)
+        ''')
+        
+        # Covering index for the list query: the rows come straight from the
+        # index in order, without visiting the table
+        c.execute("DROP INDEX IF EXISTS idx_chat_sessions_user_updated")
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_list 
+            ON chat_sessions(user_id, updated_ts DESC, id, title, created_ts)
+        ''')
+    
+    def _create_delete_cascade(self, c):
+        # Deleting a session takes everything under it along. Adding ON
+        # DELETE CASCADE to chat_messages would mean copying the table, and
+        # foreign keys are never switched on here; a trigger gives the same
+        # cascade and also covers the search index and archive, which have
+        # no foreign key to cascade through.
+        c.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_sessions_delete_cascade
+        AFTER DELETE ON chat_sessions
+        BEGIN
+            DELETE FROM chat_messages WHERE chat_id = OLD.id;
+            DELETE FROM chat_search_index WHERE chat_id = OLD.id;
+            DELETE FROM chat_archive WHERE chat_id = OLD.id;
+        END''')
+
+    def _add_tombstone_retention(self, c):
+        # Tombstones record when they were written so old ones can be pruned;
+        # the list version remembers the newest version pruned, since diffs
+        # from before it are no longer complete. Existing tombstones count
+        # as old.
+        c.execute("PRAGMA table_info(chat_tombstones)")
+        if 'deleted_ts' not in {row['name'] for row in c.fetchall()}:
+            c.execute("ALTER TABLE chat_tombstones ADD COLUMN deleted_ts INTEGER NOT NULL DEFAULT 0")
+        c.execute("PRAGMA table_info(chat_list_versions)")
+        if 'pruned_version' not in {row['name'] for row in c.fetchall()}:
+            c.execute("ALTER TABLE chat_list_versions ADD COLUMN pruned_version INTEGER NOT NULL DEFAULT 0")
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_tombstones_deleted
+            ON chat_tombstones(deleted_ts)
+        ''')
+    
+    def _create_inference_jobs(self, c):
+        # The background image analysis queue (job_queue.py). Databases
+        # from before migrations covered it already have the table.
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS inference_jobs (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            idempotency_key TEXT,
+            status TEXT NOT NULL,
+            prompt TEXT,
+            image BLOB,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            claimed_by TEXT,
+            lease_expires_at REAL,
+            created_at REAL NOT NULL,
+            finished_at REAL
+        )''')
+        c.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_inference_jobs_idempotency
+            ON inference_jobs(user_id, idempotency_key) WHERE idempotency_key IS NOT NULL
+        ''')
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_inference_jobs_status_created
+            ON inference_jobs(status, created_at)
+        ''')
+    
+    def _add_job_fair_share(self, c):
+        # Weighted fair queuing across users: per-user weight and concurrency
+        # limit, the job's virtual finish tag, and when it started running
+        c.execute("PRAGMA table_info(inference_jobs)")
+        existing = {row['name'] for row in c.fetchall()}
+        for name, declaration in [
+            ("weight", "REAL NOT NULL DEFAULT 1.0"),
+            ("max_concurrent", "INTEGER NOT NULL DEFAULT 1"),
+            ("fair_tag", "REAL NOT NULL DEFAULT 0"),
+            ("started_at", "REAL"),
+        ]:
+            if name not in existing:
+                c.execute(f"ALTER TABLE inference_jobs ADD COLUMN {name} {declaration}")
+        # Replaces an index that also ordered by a priority column
+        c.execute("DROP INDEX IF EXISTS idx_inference_jobs_fair")
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_inference_jobs_queue
+            ON inference_jobs(status, fair_tag)
+        ''')
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_inference_jobs_user_status
+            ON inference_jobs(user_id, status)
+        ''')
+    
+    def _bump_list_version(self, c, user_id: str) -> int:
+        """Advance the user's chat list version (inside the caller's write transaction)"""
+        c.execute('''
+        INSERT INTO chat_list_versions (user_id, version) VALUES (?, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1
+        ''', (user_id,))
+        c.execute('SELECT version FROM chat_list_versions WHERE user_id = ?', (user_id,))
+        return c.fetchone()[0]
+    
+    def _list_version(self, c, user_id: str) -> int:
+        c.execute('SELECT version FROM chat_list_versions WHERE user_id = ?', (user_id,))
+        row = c.fetchone()
+        return row[0] if row else 0
+    
+    def generate_user_key(self, user_id: str, password: str, key_id: int = 1) -> bytes:
+        """Generate a unique encryption key for each user and key version"""
+        return derive_key(user_id, password, key_id)
 
-    def get_user_key(self, user_id: str, password: str) -> bytes:
-        """Get or create user's encryption key"""
+    def get_user_key(self, user_id: str, password: str) -> UserKeyring:
+        """Get or create user's keyring (every key version, derived on demand)"""
         if user_id not in self.user_keys:
-            self.user_keys[user_id] = self.generate_user_key(user_id, password)
+            self.user_keys[user_id] = UserKeyring(user_id, password, CURRENT_KEY_ID)
         return self.user_keys[user_id]
 
-    def encrypt_message(self, message: str, user_key: bytes) -> str:
-        """Encrypt a message using user's key"""
-        f = Fernet(user_key)
-        return f.encrypt(message.encode()).decode()
+    def encrypt_message(self, message: str, user_key: UserKeyring) -> tuple:
+        """Compress and encrypt a message with the user's current key; returns (key_id, BLOB)"""
+        return seal(user_key, message)
 
-    def decrypt_message(self, encrypted_message: str, user_key: bytes) -> str:
-        """Decrypt a message using user's key"""
+    def decrypt_message(self, encrypted_message, user_key: UserKeyring, key_id: int = None) -> str:
+        """Decrypt a message with the key version it was written with"""
         try:
-            f = Fernet(user_key)
-            return f.decrypt(encrypted_message.encode()).decode()
-        except:
+            return unseal(user_key, encrypted_message, key_id)
+        except (InvalidToken, ValueError):
             return "***Message Encrypted***"
 
-    def create_chat(self, user_id: str, title: str) -> str:
+    def create_chat(self, user_id: str, title: str, chat_id: Optional[str] = None) -> str:
+        """Create an empty chat; `chat_id` (from new_id) when the caller needed it earlier"""
         try:
             conn = self.get_connection()
             c = conn.cursor()
             
-            chat_id = base64.urlsafe_b64encode(os.urandom(16)).decode()
-            now = datetime.utcnow().isoformat()
+            now = now_ms()
+            chat_id = chat_id or new_id(now)
+            now_iso = ms_to_iso(now)
             
+            c.execute("BEGIN IMMEDIATE")
+            version = self._bump_list_version(c, user_id)
             c.execute('''
-            INSERT INTO chat_sessions (id, user_id, title, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (chat_id, user_id, title, now, now))
+            INSERT INTO chat_sessions (id, user_id, title, created_at, updated_at, created_ts, updated_ts, version)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (chat_id, user_id, title, now_iso, now_iso, now, now, version))
             
             conn.commit()
             conn.close()
             
-            print(f"✅ Chat created: {chat_id} for user {user_id}")
+            logger.info("✅ Chat created", extra={"event": "chat.created", "chat_id": chat_id, "user_id": user_id})
             return chat_id
             
         except Exception as e:
-            print(f"❌ Chat creation error: {e}")
+            logger.error(f"❌ Chat creation error: {e}")
             raise
     
-    def add_message(self, chat_id: str, content: str, sender: str, user_id: str, user_key: bytes) -> str:
+    def add_message(self, chat_id: str, content: str, sender: str, user_id: str, user_key: UserKeyring) -> str:
         try:
             conn = self.get_connection()
             c = conn.cursor()
             
-            message_id = base64.urlsafe_b64encode(os.urandom(16)).decode()
-            encrypted_content = self.encrypt_message(content, user_key)
-            now = datetime.utcnow().isoformat()
+            key_id, encrypted_content = self.encrypt_message(content, user_key)
+            
+            # Take the write lock up front so the next seq is read and used atomically
+            c.execute("BEGIN IMMEDIATE")
+            self._ensure_chats_migrated(c, [chat_id])
+            self._restore_chat(c, chat_id, user_key)
+            
+            now = now_ms()
+            message_id = new_id(now)
+            c.execute('SELECT COALESCE(MAX(seq), 0) + 1 FROM chat_messages WHERE chat_id = ?', (chat_id,))
+            seq = c.fetchone()[0]
             
             c.execute('''
-            INSERT INTO chat_messages (id, chat_id, encrypted_content, sender, created_at)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (message_id, chat_id, encrypted_content, sender, now))
+            INSERT INTO chat_messages (chat_id, seq, id, encrypted_content, key_id, sender, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (chat_id, seq, message_id, encrypted_content, key_id, sender, now))
+            
+            c.execute(
+                'UPDATE chat_sessions SET updated_at = ?, updated_ts = ?, version = ? WHERE id = ?',
+                (ms_to_iso(now), now, self._bump_list_version(c, user_id), chat_id)
+            )
             
-            c.execute('UPDATE chat_sessions SET updated_at = ? WHERE id = ?', (now, chat_id))
+            self._index_message(c, user_id, chat_id, message_id, content, user_key)
             
             conn.commit()
             conn.close()
             
-            print(f"✅ Message added to chat {chat_id}")
+            logger.info("✅ Message added", extra={"event": "chat.message_added", "chat_id": chat_id})
             return message_id
             
         except Exception as e:
-            print(f"❌ Add message error: {e}")
+            logger.error(f"❌ Add message error: {e}")
             raise
     
-    def get_chat_history(self, chat_id: str, user_key: bytes) -> list:
+    def get_chat_history(self, chat_id: str, user_key: UserKeyring) -> list:
         try:
             conn = self.get_connection()
             c = conn.cursor()
             
+            if self.legacy_messages_pending:
+                c.execute("BEGIN IMMEDIATE")
+                self._ensure_chats_migrated(c, [chat_id])
+                conn.commit()
+            
+            # Primary key order is (chat_id, seq): a range scan, no sort
             c.execute('''
-            SELECT encrypted_content, sender, created_at 
+            SELECT encrypted_content, sender, created_at, key_id 
             FROM chat_messages 
             WHERE chat_id = ? 
-            ORDER BY created_at
+            ORDER BY seq
             ''', (chat_id,))
             
             messages = []
             for row in c.fetchall():
                 messages.append({
-                    'content': self.decrypt_message(row[0], user_key),
+                    'content': self.decrypt_message(row[0], user_key, row[3]),
                     'sender': row[1],
-                    'created_at': row[2]
+                    'created_at': ms_to_iso(row[2])
                 })
             
+            # An archived chat has no rows left in chat_messages
+            if not messages:
+                messages = [
+                    {'content': content, 'sender': sender, 'created_at': ms_to_iso(created_at)}
+                    for _, _, sender, created_at, content in self._read_archive(c, chat_id, user_key)
+                ]
+            
             conn.close()
             return messages
             
         except Exception as e:
-            print(f"❌ Get chat history error: {e}")
+            logger.error(f"❌ Get chat history error: {e}")
             return []
 
     def get_user_chats(self, user_id: str) -> list:
+        return self.get_user_chats_versioned(user_id)[1]
+    
+    def get_user_chats_versioned(self, user_id: str) -> tuple:
+        """The user's chats, newest first, with the list version they reflect.
+        
+        Served from the in-memory cache while the stored version hasn't moved.
+        """
         try:
             conn = self.get_connection()
             c = conn.cursor()
             
+            if self.legacy_sessions_pending:
+                self._backfill_sessions(c, 'user_id = ?', (user_id,))
+                conn.commit()
+            
+            # One snapshot for the version and the rows it describes
+            c.execute("BEGIN")
+            version = self._list_version(c, user_id)
+            with self._chat_list_lock:
+                cached = self._chat_list_cache.get(user_id)
+                if cached and cached[0] == version:
+                    self._chat_list_cache.move_to_end(user_id)
+                    conn.rollback()
+                    conn.close()
+                    return version, list(cached[1])
+            
             c.execute('''
-            SELECT id, title, created_at, updated_at 
+            SELECT id, title, created_ts, updated_ts 
             FROM chat_sessions 
             WHERE user_id = ? 
-            ORDER BY updated_at DESC
+            ORDER BY updated_ts DESC
             ''', (user_id,))
+            chats = [self._chat_row(row) for row in c.fetchall()]
+            conn.rollback()
+            conn.close()
             
-            chats = []
-            for row in c.fetchall():
-                chats.append({
-                    'id': row[0],
-                    'title': row[1],
-                    'created_at': row[2],
-                    'updated_at': row[3]
-                })
+            if not self.legacy_sessions_pending:
+                with self._chat_list_lock:
+                    self._chat_list_cache[user_id] = (version, chats)
+                    self._chat_list_cache.move_to_end(user_id)
+                    while len(self._chat_list_cache) > CHAT_LIST_CACHE_USERS:
+                        self._chat_list_cache.popitem(last=False)
+            return version, list(chats)
             
+        except Exception as e:
+            logger.error(f"❌ Get user chats error: {e}")
+            return 0, []
+    
+    def get_user_chat_changes(self, user_id: str, since: int) -> dict:
+        """Chats changed and deleted after list version `since`.
+        
+        If `since` is ahead of the stored version (the client saw a database
+        that was since replaced), or behind the tombstones still kept
+        (deletions it would miss were pruned), the full list comes back
+        with reset=True.
+        """
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute("BEGIN")
+            c.execute('SELECT version, pruned_version FROM chat_list_versions WHERE user_id = ?', (user_id,))
+            version, pruned_version = c.fetchone() or (0, 0)
+            if pruned_version <= since <= version:
+                c.execute('''
+                SELECT id, title, created_ts, updated_ts 
+                FROM chat_sessions 
+                WHERE user_id = ? AND version > ?
+                ORDER BY updated_ts DESC
+                ''', (user_id, since))
+                changed = [self._chat_row(row) for row in c.fetchall()]
+                c.execute(
+                    'SELECT chat_id FROM chat_tombstones WHERE user_id = ? AND version > ?',
+                    (user_id, since)
+                )
+                deleted = [row[0] for row in c.fetchall()]
+                return {'version': version, 'reset': False, 'changed': changed, 'deleted': deleted}
+        finally:
+            conn.rollback()
+            conn.close()
+        
+        version, chats = self.get_user_chats_versioned(user_id)
+        return {'version': version, 'reset': True, 'changed': chats, 'deleted': []}
+    
+    def _chat_row(self, row) -> dict:
+        return {
+            'id': row[0],
+            'title': row[1],
+            'created_at': ms_to_iso(row[2]),
+            'updated_at': ms_to_iso(row[3])
+        }
+    
+    def is_chat_owner(self, chat_id: str, user_id: str) -> bool:
+        """Check that a chat exists and belongs to the user"""
+        try:
+            conn = self.get_connection()
+            c = conn.cursor()
+            c.execute('SELECT user_id FROM chat_sessions WHERE id = ?', (chat_id,))
+            result = c.fetchone()
             conn.close()
-            return chats
+            return bool(result) and result[0] == user_id
             
         except Exception as e:
-            print(f"❌ Get user chats error: {e}")
-            return []
+            logger.error(f"❌ Chat owner check error: {e}")
+            return False
     
     def delete_chat(self, chat_id: str, user_id: str) -> bool:
         """Delete a chat and all its messages"""
+        return bool(self.delete_chats(user_id, [chat_id]))
+    
+    def delete_chats(self, user_id: str, chat_ids: list = None) -> list:
+        """Delete several of the user's chats, or all of them when `chat_ids` is None
+        
+        One write transaction: the sessions go in batched DELETEs and the
+        cascade trigger removes their messages, search tokens and archive
+        packs. Ids that don't exist or belong to someone else are skipped.
+        Returns the ids actually deleted.
+        """
         try:
             conn = self.get_connection()
+            try:
+                c = conn.cursor()
+                c.execute("BEGIN IMMEDIATE")
+                if chat_ids is None:
+                    c.execute('SELECT id FROM chat_sessions WHERE user_id = ?', (user_id,))
+                    owned = [row[0] for row in c.fetchall()]
+                else:
+                    owned = []
+                    wanted = list(dict.fromkeys(chat_ids))
+                    for start in range(0, len(wanted), DELETE_BATCH_SIZE):
+                        batch = wanted[start:start + DELETE_BATCH_SIZE]
+                        c.execute(f'''
+                        SELECT id FROM chat_sessions
+                        WHERE user_id = ? AND id IN ({','.join('?' * len(batch))})
+                        ''', (user_id, *batch))
+                        owned += [row[0] for row in c.fetchall()]
+                if not owned:
+                    conn.rollback()
+                    logger.error(f"❌ Delete chats: nothing to delete for user {user_id}")
+                    return []
+                
+                for start in range(0, len(owned), DELETE_BATCH_SIZE):
+                    batch = owned[start:start + DELETE_BATCH_SIZE]
+                    # Legacy rows aren't reached by the trigger; move them first
+                    self._ensure_chats_migrated(c, batch)
+                    c.execute(
+                        f"DELETE FROM chat_sessions WHERE id IN ({','.join('?' * len(batch))})", batch
+                    )
+                
+                version = self._bump_list_version(c, user_id)
+                now = now_ms()
+                c.executemany(
+                    'INSERT INTO chat_tombstones (user_id, version, chat_id, deleted_ts) VALUES (?, ?, ?, ?)',
+                    [(user_id, version, chat_id, now) for chat_id in owned]
+                )
+                conn.commit()
+            finally:
+                conn.close()
+            
+            logger.info(f"✅ Chats deleted: {len(owned)} for user {user_id}")
+            return owned
+            
+        except Exception as e:
+            logger.error(f"❌ Delete chats error: {e}")
+            return []
+
+    def _index_message(self, c, user_id: str, chat_id: str, message_id: str, content: str, user_key: UserKeyring):
+        """Add a message's blind tokens to the search index (inside the caller's transaction)"""
+        index_key = user_key.index_key
+        c.executemany('''
+        INSERT OR IGNORE INTO chat_search_index (user_id, token, chat_id, message_id)
+        VALUES (?, ?, ?, ?)
+        ''', [(user_id, token, chat_id, message_id) for token in blind_tokens(content, index_key)])
+
+    def export_user_chats(self, user_id: str, user_key: UserKeyring, batch_size: int = 500):
+        """Yield a user's chats as NDJSON text, one chunk per batch of rows.
+        
+        Rows are pulled from open cursors with fetchmany and decrypted a batch
+        at a time, so memory stays flat however large the history is. The
+        whole export reads from one snapshot. Consumers may resume the
+        generator from a different thread than the one that started it.
+        """
+        conn = self.get_connection(check_same_thread=False)
+        try:
             c = conn.cursor()
+            if self.legacy_sessions_pending or self.legacy_messages_pending:
+                c.execute("BEGIN IMMEDIATE")
+                self._ensure_user_migrated(c, user_id)
+                conn.commit()
             
-            # First check if the chat belongs to the user
-            c.execute('SELECT user_id FROM chat_sessions WHERE id = ?', (chat_id,))
-            result = c.fetchone()
+            c.execute("BEGIN")
+            yield json.dumps({
+                'type': 'archive',
+                'version': EXPORT_FORMAT_VERSION,
+                'exported_at': ms_to_iso(now_ms())
+            }) + '\n'
             
-            if not result or result[0] != user_id:
-                print(f"❌ Delete chat failed: Chat {chat_id} not found or not owned by user {user_id}")
-                return False
+            sessions = conn.cursor()
+            sessions.execute('''
+            SELECT id, title, created_ts, updated_ts
+            FROM chat_sessions
+            WHERE user_id = ?
+            ORDER BY created_ts, id
+            ''', (user_id,))
+            messages = conn.cursor()
+            while True:
+                chats = sessions.fetchmany(batch_size)
+                if not chats:
+                    break
+                for chat_id, title, created_ts, updated_ts in chats:
+                    yield json.dumps({
+                        'type': 'chat',
+                        'id': chat_id,
+                        'title': title,
+                        'created_at': ms_to_iso(created_ts),
+                        'updated_at': ms_to_iso(updated_ts)
+                    }) + '\n'
+                    
+                    messages.execute('''
+                    SELECT id, encrypted_content, sender, created_at, key_id
+                    FROM chat_messages
+                    WHERE chat_id = ?
+                    ORDER BY seq
+                    ''', (chat_id,))
+                    first = True
+                    while True:
+                        rows = messages.fetchmany(batch_size)
+                        if not rows:
+                            if first:
+                                yield ''.join(json.dumps({
+                                    'type': 'message',
+                                    'chat_id': chat_id,
+                                    'id': message_id,
+                                    'sender': sender,
+                                    'content': content,
+                                    'created_at': ms_to_iso(created_at)
+                                }) + '\n' for _, message_id, sender, created_at, content
+                                    in self._read_archive(conn.cursor(), chat_id, user_key))
+                            break
+                        first = False
+                        yield ''.join(json.dumps({
+                            'type': 'message',
+                            'chat_id': chat_id,
+                            'id': message_id,
+                            'sender': sender,
+                            'content': self.decrypt_message(encrypted_content, user_key, key_id),
+                            'created_at': ms_to_iso(created_at)
+                        }) + '\n' for message_id, encrypted_content, sender, created_at, key_id in rows)
+            conn.rollback()
+        finally:
+            conn.close()
+
+    def ensure_search_index(self, user_id: str, user_key: UserKeyring, batch_size: int = SEARCH_INDEX_BATCH_SIZE):
+        """Index a user's messages written before search existed (runs once per user).
+        
+        Messages are read `batch_size` at a time, chat by chat, and each
+        batch is decrypted and indexed in its own short write transaction,
+        so a long history neither sits in memory at once nor holds the
+        write lock. Blocking: callers on the event loop run it in a thread.
+        """
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('SELECT 1 FROM chat_search_state WHERE user_id = ?', (user_id,))
+            if c.fetchone():
+                return
             
-            # Delete messages first (due to foreign key)
-            c.execute('DELETE FROM chat_messages WHERE chat_id = ?', (chat_id,))
-            messages_deleted = c.rowcount
+            if self.legacy_sessions_pending or self.legacy_messages_pending:
+                c.execute("BEGIN IMMEDIATE")
+                self._ensure_user_migrated(c, user_id)
+                conn.commit()
+            c.execute('SELECT id FROM chat_sessions WHERE user_id = ?', (user_id,))
+            chat_ids = [row[0] for row in c.fetchall()]
             
-            # Delete the chat session
-            c.execute('DELETE FROM chat_sessions WHERE id = ?', (chat_id,))
+            indexed = 0
+            for chat_id in chat_ids:
+                last_seq = 0
+                while True:
+                    c.execute('''
+                    SELECT seq, id, encrypted_content, key_id FROM chat_messages
+                    WHERE chat_id = ? AND seq > ?
+                    ORDER BY seq
+                    LIMIT ?
+                    ''', (chat_id, last_seq, batch_size))
+                    rows = c.fetchall()
+                    if not rows:
+                        break
+                    last_seq = rows[-1][0]
+                    batch = []
+                    for _, message_id, encrypted_content, key_id in rows:
+                        try:
+                            batch.append((message_id, unseal(user_key, encrypted_content, key_id)))
+                        except Exception:
+                            continue  # Unreadable with this key; nothing to index
+                    c.execute("BEGIN IMMEDIATE")
+                    for message_id, content in batch:
+                        self._index_message(c, user_id, chat_id, message_id, content, user_key)
+                    conn.commit()
+                    indexed += len(batch)
+                    if len(rows) < batch_size:
+                        break
+                
+                archived = self._read_archive(c, chat_id, user_key)
+                if archived:
+                    c.execute("BEGIN IMMEDIATE")
+                    for _, message_id, _, _, content in archived:
+                        self._index_message(c, user_id, chat_id, message_id, content, user_key)
+                    conn.commit()
+                    indexed += len(archived)
             
+            c.execute(
+                'INSERT OR REPLACE INTO chat_search_state (user_id, indexed_at) VALUES (?, ?)',
+                (user_id, datetime.utcnow().isoformat())
+            )
             conn.commit()
+            logger.info(f"✅ Search index built for user {user_id} ({indexed} messages)")
+        finally:
             conn.close()
+
+    def search_messages(self, user_id: str, user_key: UserKeyring, query: str, limit: int = 20) -> list:
+        """Find the user's messages containing every word of the query.
+        
+        The index is queried with keyed hashes only; just the matching
+        messages are decrypted to build snippets.
+        """
+        words = tokenize(query)
+        if not words:
+            return []
+        
+        try:
+            self.ensure_search_index(user_id, user_key)
             
-            print(f"✅ Chat deleted: {chat_id} ({messages_deleted} messages)")
-            return True
+            index_key = user_key.index_key
+            tokens = [blind_token(word, index_key) for word in words]
+            placeholders = ','.join('?' * len(tokens))
+            
+            conn = self.get_connection()
+            c = conn.cursor()
+            
+            if self.legacy_sessions_pending or self.legacy_messages_pending:
+                c.execute("BEGIN IMMEDIATE")
+                self._ensure_user_migrated(c, user_id)
+                conn.commit()
+            
+            c.execute(f'''
+            SELECT hits.message_id, hits.chat_id, s.title, m.encrypted_content, m.sender, m.created_at, m.key_id
+            FROM (
+                SELECT message_id, MIN(chat_id) AS chat_id FROM chat_search_index
+                WHERE user_id = ? AND token IN ({placeholders})
+                GROUP BY message_id
+                HAVING COUNT(*) = ?
+            ) hits
+            JOIN chat_sessions s ON s.id = hits.chat_id
+            LEFT JOIN chat_messages m ON m.id = hits.message_id
+            ORDER BY COALESCE(m.created_at, s.updated_ts) DESC
+            LIMIT ?
+            ''', (user_id, *tokens, len(tokens), limit))
+            
+            results = []
+            archives = {}
+            for row in c.fetchall():
+                if row[3] is not None:
+                    content, sender, created_at = self.decrypt_message(row[3], user_key, row[6]), row[4], row[5]
+                else:
+                    # Hit in an archived chat: unpack it once for all its hits
+                    if row[1] not in archives:
+                        archives[row[1]] = {
+                            message_id: (sender, created_at, content)
+                            for _, message_id, sender, created_at, content
+                            in self._read_archive(conn.cursor(), row[1], user_key)
+                        }
+                    if row[0] not in archives[row[1]]:
+                        continue
+                    sender, created_at, content = archives[row[1]][row[0]]
+                results.append({
+                    'chat_id': row[1],
+                    'title': row[2],
+                    'message_id': row[0],
+                    'content': content,
+                    'sender': sender,
+                    'created_at': ms_to_iso(created_at)
+                })
+            
+            conn.close()
+            return results
             
         except Exception as e:
-            print(f"❌ Delete chat error: {e}")
-            return False
\ No newline at end of file
+            logger.error(f"❌ Search messages error: {e}")
+            return []
+
+    def _read_archive(self, c, chat_id: str, user_key: UserKeyring) -> list:
+        """Messages of an archived chat as (seq, id, sender, created_at, content); [] if not archived"""
+        c.execute('SELECT key_id, packed FROM chat_archive WHERE chat_id = ?', (chat_id,))
+        row = c.fetchone()
+        if not row:
+            return []
+        try:
+            return [tuple(message) for message in json.loads(unseal(user_key, row[1], row[0]))]
+        except (InvalidToken, ValueError):
+            logger.error(f"❌ Archived chat {chat_id} could not be unpacked")
+            return []
+
+    def _restore_chat(self, c, chat_id: str, user_key: UserKeyring):
+        """Move an archived chat back into chat_messages before it is written to (caller holds the write lock)"""
+        c.execute('SELECT key_id, packed FROM chat_archive WHERE chat_id = ?', (chat_id,))
+        row = c.fetchone()
+        if not row:
+            # Nothing packed (the chat was archived empty, or isn't archived)
+            c.execute('UPDATE chat_sessions SET archived_at = NULL WHERE id = ? AND archived_at IS NOT NULL',
+                      (chat_id,))
+            return
+        # Raises rather than dropping messages that can't be read
+        messages = json.loads(unseal(user_key, row[1], row[0]))
+        rows = []
+        for seq, message_id, sender, created_at, content in messages:
+            key_id, encrypted_content = self.encrypt_message(content, user_key)
+            rows.append((chat_id, seq, message_id, encrypted_content, key_id, sender, created_at))
+        c.executemany('''
+        INSERT INTO chat_messages (chat_id, seq, id, encrypted_content, key_id, sender, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        c.execute('DELETE FROM chat_archive WHERE chat_id = ?', (chat_id,))
+        c.execute('UPDATE chat_sessions SET archived_at = NULL WHERE id = ?', (chat_id,))
+
+    def archive_cold_chats(self, key_material, inactive_days: int = ARCHIVE_AFTER_DAYS,
+                           limit: int = 100, after: Optional[Tuple[int, str]] = None
+                           ) -> Tuple[int, Optional[Tuple[int, str]]]:
+        """Pack up to `limit` chats untouched for `inactive_days` into chat_archive.
+        
+        Messages are read and packed outside the write lock; the swap is one
+        short transaction that is skipped if the chat changed meanwhile.
+        `key_material(user_id)` supplies what the user's key is derived from.
+        Candidates are paged by (updated_ts, id): pass the returned cursor
+        as `after` for the next page, so chats that can't be archived are
+        not looked at again in the same pass. Returns the number of chats
+        archived and the cursor, which is None once no candidates are left.
+        """
+        cutoff = now_ms() - inactive_days * 86_400_000
+        after_ts, after_id = after or (-1, '')
+        conn = self.get_connection()
+        archived = 0
+        try:
+            c = conn.cursor()
+            c.execute('''
+            SELECT id, user_id, updated_ts FROM chat_sessions
+            WHERE archived_at IS NULL AND updated_ts < ? AND (updated_ts, id) > (?, ?)
+            ORDER BY updated_ts, id
+            LIMIT ?
+            ''', (cutoff, after_ts, after_id, limit))
+            candidates = c.fetchall()
+            cursor = (candidates[-1][2], candidates[-1][0]) if len(candidates) == limit else None
+            
+            for chat_id, user_id, updated_ts in candidates:
+                material = key_material(user_id)
+                if not material:
+                    continue
+                user_key = self.get_user_key(user_id, material)
+                c.execute('''
+                SELECT seq, id, sender, created_at, encrypted_content, key_id
+                FROM chat_messages WHERE chat_id = ? ORDER BY seq
+                ''', (chat_id,))
+                try:
+                    messages = [
+                        (seq, message_id, sender, created_at, unseal(user_key, encrypted_content, key_id))
+                        for seq, message_id, sender, created_at, encrypted_content, key_id in c.fetchall()
+                    ]
+                except (InvalidToken, ValueError):
+                    continue  # Never archive what we can't read back
+                key_id, packed = seal(user_key, json.dumps(messages, separators=(',', ':')))
+                
+                c.execute("BEGIN IMMEDIATE")
+                c.execute(
+                    'SELECT 1 FROM chat_sessions WHERE id = ? AND updated_ts = ? AND archived_at IS NULL',
+                    (chat_id, updated_ts)
+                )
+                if not c.fetchone():
+                    conn.rollback()
+                    continue
+                now = now_ms()
+                if messages:
+                    c.execute('''
+                    INSERT INTO chat_archive (chat_id, key_id, message_count, packed, archived_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ''', (chat_id, key_id, len(messages), packed, now))
+                    c.execute('DELETE FROM chat_messages WHERE chat_id = ?', (chat_id,))
+                c.execute('UPDATE chat_sessions SET archived_at = ? WHERE id = ?', (now, chat_id))
+                conn.commit()
+                archived += 1
+            
+            if archived:
+                # Freed pages are reused by new rows; checkpoint so the WAL
+                # doesn't keep the moved messages around
+                c.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            return archived, cursor
+        finally:
+            conn.close()
+
+    def prune_tombstones(self, retention_days: int = TOMBSTONE_RETENTION_DAYS) -> int:
+        """Drop deletion tombstones older than `retention_days`; returns how many.
+
+        Each affected user's pruned_version moves up to the newest version
+        dropped, so get_user_chat_changes answers older clients with a reset.
+        """
+        cutoff = now_ms() - retention_days * 86_400_000
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            c.execute('''
+            UPDATE chat_list_versions
+            SET pruned_version = MAX(pruned_version, (
+                SELECT MAX(version) FROM chat_tombstones t
+                WHERE t.user_id = chat_list_versions.user_id AND t.deleted_ts < ?
+            ))
+            WHERE user_id IN (SELECT user_id FROM chat_tombstones WHERE deleted_ts < ?)
+            ''', (cutoff, cutoff))
+            c.execute('DELETE FROM chat_tombstones WHERE deleted_ts < ?', (cutoff,))
+            pruned = c.rowcount
+            conn.commit()
+            return pruned
+        finally:
+            conn.close()
+
+    def import_chats(self, user_id: str, user_key: UserKeyring) -> "ChatImport":
+        """Start importing an exported archive into the user's account"""
+        return ChatImport(self, user_id, user_key)
+
+    def _backfill_sessions(self, c, where: str, params: tuple) -> int:
+        """Fill epoch-ms timestamps for legacy sessions matching `where`"""
+        c.execute(f'''
+        UPDATE chat_sessions
+        SET created_ts = {ISO_TO_MS_SQL.format(column='created_at')},
+            updated_ts = {ISO_TO_MS_SQL.format(column='updated_at')}
+        WHERE updated_ts IS NULL AND {where}
+        ''', params)
+        return c.rowcount
+
+    def _migrate_chats(self, c, chat_ids: list) -> int:
+        """Move whole chats from the legacy message table (caller holds the write lock)
+        
+        Messages get seq numbers in their original created_at order, after any
+        already in the new table, and keep their original ids.
+        """
+        placeholders = ','.join('?' * len(chat_ids))
+        c.execute(f'''
+        INSERT INTO chat_messages (chat_id, seq, id, encrypted_content, sender, created_at)
+        SELECT l.chat_id,
+               COALESCE((SELECT MAX(m.seq) FROM chat_messages m WHERE m.chat_id = l.chat_id), 0)
+                   + ROW_NUMBER() OVER (PARTITION BY l.chat_id ORDER BY l.created_at, l.rowid),
+               l.id, l.encrypted_content, l.sender, {ISO_TO_MS_SQL.format(column='l.created_at')}
+        FROM chat_messages_legacy l
+        WHERE l.chat_id IN ({placeholders})
+        ''', chat_ids)
+        moved = c.rowcount
+        c.execute(f'DELETE FROM chat_messages_legacy WHERE chat_id IN ({placeholders})', chat_ids)
+        return moved
+
+    def _ensure_chats_migrated(self, c, chat_ids: list):
+        """Migrate chats on demand before they are read or written"""
+        if not self.legacy_messages_pending or not chat_ids:
+            return
+        try:
+            self._migrate_chats(c, chat_ids)
+        except sqlite3.OperationalError as e:
+            if 'no such table' not in str(e):
+                raise
+            # Another worker process finished the migration and dropped the table
+            self.legacy_messages_pending = False
+
+    def _ensure_user_migrated(self, c, user_id: str):
+        if self.legacy_sessions_pending:
+            self._backfill_sessions(c, 'user_id = ?', (user_id,))
+        if self.legacy_messages_pending:
+            c.execute('SELECT id FROM chat_sessions WHERE user_id = ?', (user_id,))
+            self._ensure_chats_migrated(c, [row[0] for row in c.fetchall()])
+
+
+class ChatImport:
+    """Writes the records of an exported archive in batches.
+    
+    Each `write` is one transaction with `executemany` inserts, so a large
+    archive never holds the write lock for long. Chats and messages get new
+    ids (importing twice gives two copies, never a clash with existing
+    rows); messages keep their order and timestamps and are indexed for
+    search.
+    """
+    
+    def __init__(self, chat_db: ChatDB, user_id: str, user_key: UserKeyring):
+        self.chat_db = chat_db
+        self.user_id = user_id
+        self.user_key = user_key
+        self.index_key = user_key.index_key
+        self.chat_ids = {}  # archive chat id -> new chat id
+        self.next_seq = {}
+        self.chats = 0
+        self.messages = 0
+        self.skipped = 0
+    
+    def write(self, records: list):
+        sessions = []
+        messages = []
+        index_rows = []
+        touched = {}
+        for record in records:
+            kind = record.get('type')
+            if kind == 'chat' and record.get('id') not in self.chat_ids:
+                created = _iso_to_ms(record.get('created_at'))
+                updated = _iso_to_ms(record.get('updated_at'), created)
+                chat_id = new_id(created)
+                self.chat_ids[record.get('id')] = chat_id
+                self.next_seq[chat_id] = 1
+                sessions.append((
+                    chat_id, self.user_id, str(record.get('title') or 'Imported chat')[:200],
+                    ms_to_iso(created), ms_to_iso(updated), created, updated
+                ))
+            elif kind == 'message' and record.get('chat_id') in self.chat_ids \
+                    and isinstance(record.get('content'), str) and record.get('sender') in ('user', 'assistant'):
+                chat_id = self.chat_ids[record['chat_id']]
+                created = _iso_to_ms(record.get('created_at'))
+                message_id = new_id(created)
+                seq = self.next_seq[chat_id]
+                self.next_seq[chat_id] = seq + 1
+                key_id, encrypted_content = self.chat_db.encrypt_message(record['content'], self.user_key)
+                messages.append((chat_id, seq, message_id, encrypted_content, key_id, record['sender'], created))
+                index_rows.extend(
+                    (self.user_id, token, chat_id, message_id)
+                    for token in blind_tokens(record['content'], self.index_key)
+                )
+                touched[chat_id] = max(touched.get(chat_id, 0), created)
+            elif kind != 'archive':
+                self.skipped += 1
+        
+        if not sessions and not messages:
+            return
+        conn = self.chat_db.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            version = self.chat_db._bump_list_version(c, self.user_id)
+            c.executemany('''
+            INSERT INTO chat_sessions (id, user_id, title, created_at, updated_at, created_ts, updated_ts, version)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [session + (version,) for session in sessions])
+            c.executemany('''
+            INSERT INTO chat_messages (chat_id, seq, id, encrypted_content, key_id, sender, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', messages)
+            c.executemany('''
+            INSERT OR IGNORE INTO chat_search_index (user_id, token, chat_id, message_id)
+            VALUES (?, ?, ?, ?)
+            ''', index_rows)
+            c.executemany(
+                'UPDATE chat_sessions SET updated_at = ?, updated_ts = ?, version = ? WHERE id = ? AND updated_ts < ?',
+                [(ms_to_iso(ts), ts, version, chat_id, ts) for chat_id, ts in touched.items()]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        self.chats += len(sessions)
+        self.messages += len(messages)
+    
+    def summary(self) -> dict:
+        return {'chats': self.chats, 'messages': self.messages, 'skipped': self.skipped}
+
+
+def _iso_to_ms(value, default: int = None) -> int:
+    """Parse an exported naive-UTC ISO timestamp; unreadable values fall back to `default` or now"""
+    try:
+        return int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp() * 1000)
+    except (TypeError, ValueError):
+        return default if default is not None else now_ms()
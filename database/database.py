@@ -4,57 +4,43 @@ import uuid
 from datetime import datetime
 from typing import Optional, List, Dict
 import json
+import logging
 from passlib.context import CryptContext
 import os
-from pathlib import Path
+from database.migrations import Migration, MigrationRunner
+from database.paths import get_data_dir
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Image analysis limits for users whose quota columns are NULL
+DEFAULT_MAX_CONCURRENT_JOBS = int(os.getenv("DEFAULT_MAX_CONCURRENT_JOBS", "1"))
+DEFAULT_JOBS_PER_HOUR = int(os.getenv("DEFAULT_JOBS_PER_HOUR", "20"))
+DEFAULT_SCHEDULER_WEIGHT = float(os.getenv("DEFAULT_SCHEDULER_WEIGHT", "1.0"))
 
 class Database:
     pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-    def __init__(self):
-        # FIXED: Use persistent database path that survives restarts
-        self.db_path = self._get_persistent_db_path()
-        self.init_db()
+    def __init__(self, db_path=None):
+        # Nothing touches the filesystem until first use, so importing this
+        # module is free; the app lifespan calls init_db once at startup
+        self._db_path = db_path
+        self._initialized = False
+        self._init_lock = threading.Lock()
+        self.migrations = MigrationRunner(self.get_connection, self._schema_migrations(), "User database")
     
-    def _get_persistent_db_path(self):
-        """Get persistent database path that survives server restarts"""
-        # Try multiple persistent locations in order of preference
-        possible_paths = [
-            "/opt/render/project/src/data",  # Render persistent storage
-            "/tmp/data",                     # Fallback for development
-            "./data",                       # Local fallback
-        ]
-        
-        # Create the first available directory
-        for path in possible_paths:
-            try:
-                data_dir = Path(path)
-                data_dir.mkdir(parents=True, exist_ok=True)
-                
-                # Test if we can write to this directory
-                test_file = data_dir / "test_write.tmp"
-                test_file.write_text("test")
-                test_file.unlink()
-                
-                db_path = data_dir / "radiglow_users.db"
-                print(f"✅ Using persistent database path: {db_path.absolute()}")
-                return str(db_path)
-                
-            except Exception as e:
-                print(f"❌ Cannot use path {path}: {e}")
-                continue
-        
-        # Ultimate fallback - current directory
-        db_path = Path("radiglow_users.db")
-        print(f"⚠️  Using fallback database path: {db_path.absolute()}")
-        return str(db_path)
+    @property
+    def db_path(self) -> str:
+        # FIXED: Use persistent database path that survives restarts
+        if self._db_path is None:
+            self._db_path = str(get_data_dir() / "radiglow_users.db")
+        return self._db_path
     
     def get_connection(self):
         conn = sqlite3.connect(self.db_path, timeout=30.0)
         conn.row_factory = sqlite3.Row  # This enables column access by name
         
-        # Enable WAL mode for better concurrency and crash recovery
-        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL mode is persistent in the database file, so init_db sets it once
         conn.execute("PRAGMA synchronous=NORMAL")
         conn.execute("PRAGMA cache_size=1000")
         conn.execute("PRAGMA temp_store=memory")
@@ -62,54 +48,81 @@ class Database:
         return conn
     
     def init_db(self):
-        """Initialize database with proper error handling"""
+        """Apply pending schema migrations; safe to call more than once"""
+        with self._init_lock:
+            if self._initialized:
+                return
+            self._init_db()
+            self._initialized = True
+    
+    def _init_db(self):
         try:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            
-            # Create only user and guest usage tables
-            cursor.executescript('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    email TEXT UNIQUE NOT NULL,
-                    name TEXT NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-
-                CREATE TABLE IF NOT EXISTS guest_usage (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    ip_address TEXT NOT NULL,
-                    date TEXT NOT NULL,
-                    usage_count INTEGER DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(ip_address, date)
-                );
-                
-                -- Create indexes for better performance
-                CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
-                CREATE INDEX IF NOT EXISTS idx_guest_usage_ip_date ON guest_usage(ip_address, date);
-            ''')
-            
-            conn.commit()
-            
-            # Check existing data to confirm persistence
-            cursor.execute("SELECT COUNT(*) as count FROM users")
-            user_count = cursor.fetchone()['count']
-            
-            cursor.execute("SELECT COUNT(*) as count FROM guest_usage")
-            usage_count = cursor.fetchone()['count']
+            # Only takes effect on a new, empty file; older files are
+            # converted by the maintenance scheduler
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            # Enable WAL mode for better concurrency and crash recovery
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.close()
             
-            print(f"✅ Database initialized successfully")
-            print(f"📊 Existing users: {user_count}")
-            print(f"📊 Guest usage records: {usage_count}")
+            self.migrations.run()
             
+            # AUTOINCREMENT high-water marks come from sqlite_sequence, so
+            # startup no longer scans users and guest_usage with COUNT(*)
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT name, seq FROM sqlite_sequence")
+            sequences = {row['name']: row['seq'] for row in cursor.fetchall()}
             conn.close()
             
+            logger.info(f"✅ Database initialized successfully (schema v{self.migrations.current_version()})")
+            logger.info(f"📊 Users registered: {sequences.get('users', 0)}")
+            logger.info(f"📊 Guest usage records created: {sequences.get('guest_usage', 0)}")
+            
         except Exception as e:
-            print(f"❌ Database initialization error: {e}")
+            logger.error(f"❌ Database initialization error: {e}")
             raise
     
+    def _schema_migrations(self) -> list:
+        return [
+            Migration(1, "users_and_guest_usage", apply=self._create_base_tables),
+            Migration(2, "user_quotas", apply=self._add_quota_columns),
+        ]
+    
+    def _create_base_tables(self, cursor):
+        # Create only user and guest usage tables
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email TEXT UNIQUE NOT NULL,
+                name TEXT NOT NULL,
+                password_hash TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS guest_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ip_address TEXT NOT NULL,
+                date TEXT NOT NULL,
+                usage_count INTEGER DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(ip_address, date)
+            )
+        ''')
+        
+        # Create indexes for better performance
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_guest_usage_ip_date ON guest_usage(ip_address, date)")
+    
+    def _add_quota_columns(self, cursor):
+        # NULL means "use the DEFAULT_* value", so defaults can change
+        # without rewriting every row
+        cursor.execute("ALTER TABLE users ADD COLUMN max_concurrent_jobs INTEGER")
+        cursor.execute("ALTER TABLE users ADD COLUMN jobs_per_hour INTEGER")
+        cursor.execute("ALTER TABLE users ADD COLUMN scheduler_weight REAL")
+    
     def hash_password(self, password: str) -> str:
         """Hash password using SHA-256"""
         return hashlib.sha256(password.encode()).hexdigest()
@@ -122,7 +135,7 @@ class Database:
             # Check if email already exists
             if self.get_user_by_email(email):
                 conn.close()
-                print(f"❌ User creation failed: Email {email} already exists")
+                logger.warning("⚠️ User creation failed: email already registered", extra={"event": "user.exists"})
                 return None
             
             # Hash password before storing
@@ -137,11 +150,11 @@ class Database:
             user_id = cursor.lastrowid
             conn.close()
             
-            print(f"✅ User created successfully: {email} (ID: {user_id})")
+            logger.info("✅ User created", extra={"event": "user.created", "user_id": user_id})
             return self.get_user_by_email(email)
             
         except Exception as e:
-            print(f"❌ User creation error: {e}")
+            logger.error(f"❌ User creation error: {e}")
             return None
 
     def authenticate_user(self, email: str, password: str) -> Optional[Dict]:
@@ -158,18 +171,18 @@ class Database:
             conn.close()
             
             if user and self.pwd_context.verify(password, user["password_hash"]):
-                print(f"✅ Authentication successful: {email}")
+                logger.info("✅ Authentication successful", extra={"event": "auth.login", "user_id": user["id"]})
                 return {
                     "id": user["id"],
                     "email": user["email"],
                     "name": user["name"]
                 }
             else:
-                print(f"❌ Authentication failed: {email}")
+                logger.warning("⚠️ Authentication failed", extra={"event": "auth.failed"})
                 return None
                 
         except Exception as e:
-            print(f"❌ Authentication error: {e}")
+            logger.error(f"❌ Authentication error: {e}")
             return None
     
     def get_user_by_email(self, email: str) -> Optional[Dict]:
@@ -196,9 +209,65 @@ class Database:
             return None
             
         except Exception as e:
-            print(f"❌ Get user error: {e}")
+            logger.error(f"❌ Get user error: {e}")
+            return None
+    
+    def get_user_by_id(self, user_id: int) -> Optional[Dict]:
+        """Get user by id"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                "SELECT id, email, name, created_at FROM users WHERE id = ?",
+                (user_id,)
+            )
+            
+            user = cursor.fetchone()
+            conn.close()
+            
+            if user:
+                return {
+                    "id": user["id"],
+                    "email": user["email"],
+                    "name": user["name"],
+                    "created_at": user["created_at"]
+                }
+            return None
+            
+        except Exception as e:
+            logger.error(f"❌ Get user error: {e}")
             return None
     
+    def get_user_limits(self, user_id: int) -> Dict:
+        """Effective image analysis quota and scheduling weight for a user"""
+        conn = self.get_connection()
+        row = conn.execute(
+            "SELECT max_concurrent_jobs, jobs_per_hour, scheduler_weight FROM users WHERE id = ?",
+            (user_id,)
+        ).fetchone()
+        conn.close()
+        
+        def pick(column, default):
+            return row[column] if row and row[column] is not None else default
+        
+        return {
+            "max_concurrent_jobs": pick("max_concurrent_jobs", DEFAULT_MAX_CONCURRENT_JOBS),
+            "jobs_per_hour": pick("jobs_per_hour", DEFAULT_JOBS_PER_HOUR),
+            "scheduler_weight": pick("scheduler_weight", DEFAULT_SCHEDULER_WEIGHT),
+        }
+    
+    def set_user_limits(self, user_id: int, max_concurrent_jobs: Optional[int] = None,
+                        jobs_per_hour: Optional[int] = None, scheduler_weight: Optional[float] = None):
+        """Override a user's limits; None resets a limit to the default"""
+        conn = self.get_connection()
+        conn.execute(
+            "UPDATE users SET max_concurrent_jobs = ?, jobs_per_hour = ?, scheduler_weight = ? WHERE id = ?",
+            (max_concurrent_jobs, jobs_per_hour, scheduler_weight, user_id)
+        )
+        conn.commit()
+        conn.close()
+    
     def get_guest_usage(self, ip_address: str, date: str) -> int:
         """Get guest usage count for today"""
         try:
@@ -216,44 +285,39 @@ class Database:
             return result["usage_count"] if result else 0
             
         except Exception as e:
-            print(f"❌ Get guest usage error: {e}")
+            logger.error(f"❌ Get guest usage error: {e}")
             return 0
     
     def increment_guest_usage(self, ip_address: str, date: str) -> int:
-        """Increment guest usage count"""
+        """Atomically increment guest usage count and return the new value
+        
+        Several worker processes may serve the same guest at once, so the
+        increment and the read-back happen inside one write transaction.
+        """
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            # Try to update existing record
+            cursor.execute("BEGIN IMMEDIATE")
             cursor.execute(
-                "UPDATE guest_usage SET usage_count = usage_count + 1 WHERE ip_address = ? AND date = ?",
+                """INSERT INTO guest_usage (ip_address, date, usage_count) VALUES (?, ?, 1)
+                   ON CONFLICT(ip_address, date) DO UPDATE SET usage_count = usage_count + 1""",
                 (ip_address, date)
             )
-            
-            if cursor.rowcount == 0:
-                # No existing record, create new one
-                cursor.execute(
-                    "INSERT INTO guest_usage (ip_address, date, usage_count) VALUES (?, ?, 1)",
-                    (ip_address, date)
-                )
-                new_count = 1
-            else:
-                # Get updated count
-                cursor.execute(
-                    "SELECT usage_count FROM guest_usage WHERE ip_address = ? AND date = ?",
-                    (ip_address, date)
-                )
-                new_count = cursor.fetchone()["usage_count"]
+            cursor.execute(
+                "SELECT usage_count FROM guest_usage WHERE ip_address = ? AND date = ?",
+                (ip_address, date)
+            )
+            new_count = cursor.fetchone()["usage_count"]
             
             conn.commit()
             conn.close()
             
-            print(f"📊 Guest usage incremented: {ip_address} = {new_count}/3")
+            logger.info("📊 Guest usage incremented", extra={"event": "guest.usage", "count": new_count})
             return new_count
             
         except Exception as e:
-            print(f"❌ Increment guest usage error: {e}")
+            logger.error(f"❌ Increment guest usage error: {e}")
             return 1
 
 # Global database instance
@@ -0,0 +1,37 @@
+import os
+import time
+from datetime import datetime
+
+# Crockford base32: sorts the same as the numbers it encodes
+_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
+
+def now_ms() -> int:
+    """Current time as integer milliseconds since the epoch"""
+    return time.time_ns() // 1_000_000
+
+
+def new_id(timestamp_ms: int = None) -> str:
+    """Generate a 26-character, time-ordered id (ULID layout).
+
+    48 bits of millisecond timestamp followed by 80 random bits, so ids
+    created later sort later and inserts append to the end of the B-tree
+    instead of landing on random pages.
+    """
+    if timestamp_ms is None:
+        timestamp_ms = now_ms()
+    value = (timestamp_ms << 80) | int.from_bytes(os.urandom(10), "big")
+    chars = []
+    for _ in range(26):
+        chars.append(_ALPHABET[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+
+def ms_to_iso(timestamp_ms: int) -> str:
+    """Render an epoch-ms timestamp in the naive UTC ISO format the API has always used"""
+    return datetime.utcfromtimestamp(timestamp_ms / 1000).isoformat()
+
+
+# SQL expression converting a legacy ISO-8601 TEXT column to epoch milliseconds
+ISO_TO_MS_SQL = "CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER)"
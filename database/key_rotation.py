@@ -0,0 +1,249 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Optional, Tuple
+
+from cryptography.fernet import InvalidToken
+
+from database.ids import now_ms
+from database.keyring import CURRENT_KEY_ID
+from database.message_codec import seal, unseal
+
+logger = logging.getLogger(__name__)
+
+
+class KeyRotation:
+    """Re-encrypts chat messages still under an older key version.
+
+    Messages are walked in primary-key order, (chat_id, seq), one batch at
+    a time, then archived chats in chat_id order. Each batch is decrypted
+    and re-encrypted without holding the write lock; only the UPDATEs and
+    the saved cursor share one short transaction, so live requests keep
+    writing between batches. A restart resumes from the saved cursor. Rows
+    still in the pre-compression TEXT format come out compressed, as BLOBs.
+
+    Deriving a user's key needs their key material (the login email), which
+    `key_material(user_id)` looks up; rows of users it returns None for are
+    left as they are and counted as failed. Only one worker process holds
+    the lease on the job at a time.
+    """
+
+    def __init__(self, chat_db, key_material: Callable[[str], Optional[str]],
+                 target_key_id: int = CURRENT_KEY_ID, batch_size: int = 500,
+                 pause: float = 0.05, lease_seconds: int = 60):
+        self.chat_db = chat_db
+        self.key_material = key_material
+        self.target_key_id = target_key_id
+        self.batch_size = batch_size
+        self.pause = pause
+        self.lease_ms = lease_seconds * 1000
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.rows_total: Optional[int] = None
+        self.rows_per_second: Optional[float] = None
+        self._materials: Dict[str, Optional[str]] = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _claim(self, c) -> Optional[tuple]:
+        """Take or renew the lease (caller holds the write lock); returns the state row"""
+        now = now_ms()
+        c.execute('''
+        INSERT OR IGNORE INTO key_rotation (target_key_id, started_at, updated_at)
+        VALUES (?, ?, ?)
+        ''', (self.target_key_id, now, now))
+        c.execute('''
+        UPDATE key_rotation SET owner = ?, lease_until = ?
+        WHERE target_key_id = ? AND done = 0
+          AND (owner IS NULL OR owner = ? OR lease_until < ?)
+        ''', (self.owner, now + self.lease_ms, self.target_key_id, self.owner, now))
+        if c.rowcount == 0:
+            return None
+        c.execute('''
+        SELECT cursor_chat_id, cursor_seq, archive_cursor FROM key_rotation WHERE target_key_id = ?
+        ''', (self.target_key_id,))
+        return tuple(c.fetchone())
+
+    def _keyring(self, user_id: str):
+        if user_id not in self._materials:
+            self._materials[user_id] = self.key_material(user_id)
+        material = self._materials[user_id]
+        return self.chat_db.get_user_key(user_id, material) if material else None
+
+    def _reencrypt(self, user_id: str, stored, key_id: int) -> Optional[bytes]:
+        """The row re-sealed under the target key, or None if it can't be read"""
+        keyring = self._keyring(user_id)
+        if keyring is None or keyring.current_id != self.target_key_id:
+            return None
+        try:
+            return seal(keyring, unseal(keyring, stored, key_id))[1]
+        except (InvalidToken, ValueError):
+            return None
+
+    def run_batch(self) -> Tuple[bool, int]:
+        """Rotate one batch; returns (finished, rows rotated).
+
+        `finished` is also True when another process holds the lease.
+        """
+        conn = self.chat_db.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            state = self._claim(c)
+            conn.commit()
+            if state is None:
+                return True, 0
+            cursor_chat_id, cursor_seq, archive_cursor = state
+
+            c.execute('''
+            SELECT m.chat_id, m.seq, m.encrypted_content, m.key_id, s.user_id
+            FROM chat_messages m JOIN chat_sessions s ON s.id = m.chat_id
+            WHERE (m.chat_id, m.seq) > (?, ?) AND m.key_id != ?
+            ORDER BY m.chat_id, m.seq
+            LIMIT ?
+            ''', (cursor_chat_id, cursor_seq, self.target_key_id, self.batch_size))
+            rows = c.fetchall()
+            archived = []
+            if not rows:
+                c.execute('''
+                SELECT a.chat_id, a.packed, a.key_id, s.user_id
+                FROM chat_archive a JOIN chat_sessions s ON s.id = a.chat_id
+                WHERE a.chat_id > ? AND a.key_id != ?
+                ORDER BY a.chat_id
+                LIMIT ?
+                ''', (archive_cursor, self.target_key_id, max(self.batch_size // 10, 1)))
+                archived = c.fetchall()
+            conn.commit()  # End the read snapshot before re-encrypting
+
+            updates = []
+            for chat_id, seq, encrypted_content, key_id, user_id in rows:
+                rotated = self._reencrypt(user_id, encrypted_content, key_id)
+                if rotated is not None:
+                    updates.append((rotated, self.target_key_id, chat_id, seq, key_id))
+            archive_updates = []
+            for chat_id, packed, key_id, user_id in archived:
+                rotated = self._reencrypt(user_id, packed, key_id)
+                if rotated is not None:
+                    archive_updates.append((rotated, self.target_key_id, chat_id, key_id))
+            failed = len(rows) + len(archived) - len(updates) - len(archive_updates)
+
+            c.execute("BEGIN IMMEDIATE")
+            if self._claim(c) is None:
+                conn.rollback()
+                return True, 0
+            # Matching on the old key id makes a stale batch a no-op
+            c.executemany('''
+            UPDATE chat_messages SET encrypted_content = ?, key_id = ?
+            WHERE chat_id = ? AND seq = ? AND key_id = ?
+            ''', updates)
+            c.executemany('''
+            UPDATE chat_archive SET packed = ?, key_id = ?
+            WHERE chat_id = ? AND key_id = ?
+            ''', archive_updates)
+            if rows:
+                cursor_chat_id, cursor_seq = rows[-1][0], rows[-1][1]
+            if archived:
+                archive_cursor = archived[-1][0]
+            finished = not rows and not archived
+            c.execute('''
+            UPDATE key_rotation
+            SET cursor_chat_id = ?, cursor_seq = ?, archive_cursor = ?, rows_done = rows_done + ?,
+                rows_failed = rows_failed + ?, updated_at = ?, done = ?,
+                owner = CASE WHEN ? THEN NULL ELSE owner END
+            WHERE target_key_id = ?
+            ''', (cursor_chat_id, cursor_seq, archive_cursor, len(updates) + len(archive_updates),
+                  failed, now_ms(), 1 if finished else 0, finished, self.target_key_id))
+            conn.commit()
+            return finished, len(updates) + len(archive_updates)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def run(self, report_every: float = 10.0):
+        """Rotate batches until every message uses the target key or stop() is called"""
+        conn = self.chat_db.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('SELECT rows_done FROM key_rotation WHERE target_key_id = ?', (self.target_key_id,))
+            row = c.fetchone()
+            c.execute('''
+            SELECT (SELECT COUNT(*) FROM chat_messages WHERE key_id != ?)
+                 + (SELECT COUNT(*) FROM chat_archive WHERE key_id != ?)
+            ''', (self.target_key_id, self.target_key_id))
+            self.rows_total = (row[0] if row else 0) + c.fetchone()[0]
+        finally:
+            conn.close()
+
+        started = last_report = time.time()
+        rotated = 0
+        try:
+            while not self._stop.is_set():
+                finished, rows = self.run_batch()
+                rotated += rows
+                self.rows_per_second = rotated / max(time.time() - started, 1e-6)
+                if finished:
+                    break
+                if time.time() - last_report >= report_every:
+                    last_report = time.time()
+                    progress = self.progress()
+                    logger.info(f"🔄 Chat key rotation: {progress['rows_done']}/{progress['rows_total']} rows "
+                                f"({self.rows_per_second:.0f} rows/s)")
+                # Let live requests take the write lock between batches
+                time.sleep(self.pause)
+        except Exception as e:
+            logger.error(f"❌ Chat key rotation stopped, will resume on next start: {e}")
+            return
+
+        if rotated:
+            elapsed = max(time.time() - started, 1e-6)
+            logger.info(f"✅ Chat key rotation to key {self.target_key_id}: {rotated} rows "
+                        f"in {elapsed:.1f}s ({rotated / elapsed:.0f} rows/s)")
+
+    def pending(self) -> bool:
+        conn = self.chat_db.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('SELECT done FROM key_rotation WHERE target_key_id = ?', (self.target_key_id,))
+            row = c.fetchone()
+            return not (row and row[0])
+        finally:
+            conn.close()
+
+    def start(self) -> bool:
+        """Run the rotation on a daemon thread; returns False if it already finished"""
+        if not self.pending():
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def progress(self) -> dict:
+        conn = self.chat_db.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('''
+            SELECT rows_done, rows_failed, started_at, updated_at, done, owner
+            FROM key_rotation WHERE target_key_id = ?
+            ''', (self.target_key_id,))
+            row = c.fetchone()
+        finally:
+            conn.close()
+
+        rows_done = row[0] if row else 0
+        return {
+            "target_key_id": self.target_key_id,
+            "rows_done": rows_done,
+            "rows_failed": row[1] if row else 0,
+            "rows_total": self.rows_total,
+            "percent": round(100 * rows_done / self.rows_total, 1) if self.rows_total else None,
+            "rows_per_second": round(self.rows_per_second, 1) if self.rows_per_second is not None else None,
+            "done": bool(row and row[4]),
+            "running_here": bool(row and row[5] == self.owner),
+        }
@@ -0,0 +1,86 @@
+import base64
+import os
+from typing import Callable, Dict, Optional, Tuple
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+from database.blind_index import derive_index_key
+
+# Key id -> PBKDF2-SHA256 iterations. Ids are stored with every message, so
+# an entry must never be changed or removed while rows still use it; new
+# key parameters get a new id.
+KEY_VERSIONS = {
+    1: 100_000,
+    2: 600_000,
+}
+
+# Key new messages are encrypted with; raising it starts a re-encryption
+CURRENT_KEY_ID = int(os.getenv("CHAT_KEY_ID", "1"))
+
+# The search index stays keyed on the first key, so rotating the message
+# key never requires re-indexing
+INDEX_KEY_ID = 1
+
+
+def derive_key(user_id: str, material: str, key_id: int) -> bytes:
+    """Derive a user's Fernet key for one key version; the user id is the salt"""
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=user_id.encode(),
+        iterations=KEY_VERSIONS[key_id],
+    )
+    return base64.urlsafe_b64encode(kdf.derive(material.encode()))
+
+
+class UserKeyring:
+    """All versions of one user's chat key.
+
+    Keys are derived on first use, so a user whose messages all use the
+    current key never pays for the older derivations. Decryption tries the
+    key recorded with the message first and then every other version, like
+    `MultiFernet`.
+    """
+
+    def __init__(self, user_id: str, material: str, current_id: int = CURRENT_KEY_ID,
+                 derive: Callable[[str, str, int], bytes] = derive_key):
+        if current_id not in KEY_VERSIONS:
+            raise ValueError(f"Unknown chat key id {current_id}")
+        self.user_id = user_id
+        self.current_id = current_id
+        self._material = material
+        self._derive = derive
+        self._fernets: Dict[int, Fernet] = {}
+        self._index_key: Optional[bytes] = None
+
+    def key(self, key_id: int) -> bytes:
+        return self._derive(self.user_id, self._material, key_id)
+
+    def fernet(self, key_id: int) -> Fernet:
+        if key_id not in self._fernets:
+            self._fernets[key_id] = Fernet(self.key(key_id))
+        return self._fernets[key_id]
+
+    @property
+    def index_key(self) -> bytes:
+        if self._index_key is None:
+            self._index_key = derive_index_key(self.key(INDEX_KEY_ID))
+        return self._index_key
+
+    def encrypt(self, data: bytes) -> Tuple[int, bytes]:
+        """Encrypt with the current key; returns (key id, token)"""
+        return self.current_id, self.fernet(self.current_id).encrypt(data)
+
+    def decrypt(self, token, key_id: Optional[int] = None) -> bytes:
+        """Decrypt a token, raising InvalidToken if no key version opens it"""
+        order = [key_id] if key_id in KEY_VERSIONS else []
+        order += [k for k in sorted(KEY_VERSIONS, reverse=True) if k != key_id]
+        # Only derive the fallbacks when the recorded key fails
+        try:
+            return self.fernet(order[0]).decrypt(token)
+        except InvalidToken:
+            if len(order) == 1:
+                raise
+        return MultiFernet([self.fernet(k) for k in order[1:]]).decrypt(token)
@@ -0,0 +1,237 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# How often the scheduler wakes up; also the window that must pass without
+# a commit for a database to count as quiet
+MAINTENANCE_TICK_SECONDS = float(os.getenv("MAINTENANCE_TICK_SECONDS", "30"))
+
+CHECKPOINT_EVERY_SECONDS = 60
+PURGE_EVERY_SECONDS = 300
+VACUUM_EVERY_SECONDS = 300
+OPTIMIZE_EVERY_SECONDS = 6 * 3600
+
+# Free pages a file may keep before incremental vacuum hands them back, and
+# the most it hands back in one run (both in pages)
+VACUUM_MIN_FREE_PAGES = 256
+VACUUM_PAGES_PER_RUN = 2048
+
+# Files created before auto_vacuum was set need one full VACUUM to switch
+# over; it rewrites the whole file, so only files up to this size get it
+AUTO_VACUUM_CONVERT_MAX_BYTES = int(os.getenv("AUTO_VACUUM_CONVERT_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Rows ANALYZE samples per index, so refreshing statistics stays cheap
+ANALYSIS_LIMIT = 400
+
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+
+def file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class MaintenanceTask:
+    """One periodic job; `database` names the file it needs to be quiet"""
+
+    def __init__(self, name: str, run: Callable[[], object], every: float,
+                 database: Optional[str] = None, quiet_only: bool = False):
+        self.name = name
+        self.run = run
+        self.every = every
+        self.database = database
+        self.quiet_only = quiet_only
+        self.last_run = time.time()
+        self.last_result = None
+        self.last_error: Optional[str] = None
+        self.last_seconds: Optional[float] = None
+        self.runs = 0
+
+
+class MaintenanceScheduler:
+    """Keeps the SQLite files small and their WAL short, on one daemon thread.
+
+    Every registered file gets three tasks:
+      vacuum      PRAGMA incremental_vacuum, so deleted rows' pages go back
+                  to the filesystem instead of sitting on the freelist
+      optimize    refresh the query planner statistics
+      checkpoint  PRAGMA wal_checkpoint(TRUNCATE), resetting the WAL file
+    These only run while the file is quiet: no connection, in any process,
+    has committed to it since the previous tick (PRAGMA data_version is
+    unchanged). A store whose rows expire also passes `purge`, which
+    deletes them; it is registered ahead of vacuum, so a pass frees the
+    rows before vacuum returns their pages. Other periodic jobs are added
+    with `add_task`.
+
+    A due task is claimed through `elect(name, ttl)`, so with several
+    worker processes only one of them runs it per interval.
+    """
+
+    def __init__(self, elect: Optional[Callable[[str, float], bool]] = None,
+                 tick: float = MAINTENANCE_TICK_SECONDS):
+        self.elect = elect
+        self.tick = tick
+        self.tasks = []
+        self._databases: Dict[str, object] = {}
+        self._probes: Dict[str, sqlite3.Connection] = {}
+        self._data_versions: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_database(self, name: str, store, purge: Optional[Callable[[], object]] = None):
+        """Maintain `store.db_path` (read lazily, after the store is initialized)"""
+        self._databases[name] = store
+        if purge is not None:
+            self.add_task(f"{name}:purge", purge, PURGE_EVERY_SECONDS, database=name)
+        self.add_task(f"{name}:vacuum", lambda: self._vacuum(name), VACUUM_EVERY_SECONDS,
+                      database=name, quiet_only=True)
+        self.add_task(f"{name}:optimize", lambda: self._optimize(name), OPTIMIZE_EVERY_SECONDS,
+                      database=name, quiet_only=True)
+        self.add_task(f"{name}:checkpoint", lambda: self._checkpoint(name), CHECKPOINT_EVERY_SECONDS,
+                      database=name, quiet_only=True)
+
+    def add_task(self, name: str, run: Callable[[], object], every: float,
+                 database: Optional[str] = None, quiet_only: bool = False):
+        self.tasks.append(MaintenanceTask(name, run, every, database, quiet_only))
+
+    def _connection(self, name: str) -> sqlite3.Connection:
+        # Held for the life of the thread: data_version only means something
+        # when compared on the same connection
+        if name not in self._probes:
+            # Short timeout: maintenance gives way to live traffic
+            self._probes[name] = sqlite3.connect(self._databases[name].db_path, timeout=1.0,
+                                                 isolation_level=None, check_same_thread=False)
+        return self._probes[name]
+
+    def _is_quiet(self, name: str) -> bool:
+        version = self._connection(name).execute("PRAGMA data_version").fetchone()[0]
+        previous = self._data_versions.get(name)
+        self._data_versions[name] = version
+        return previous == version
+
+    def _vacuum(self, name: str) -> Optional[dict]:
+        conn = self._connection(name)
+        mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free < VACUUM_MIN_FREE_PAGES:
+            return None
+        if mode == 0:
+            path = self._databases[name].db_path
+            if file_size(path) > AUTO_VACUUM_CONVERT_MAX_BYTES:
+                return {"skipped": "auto_vacuum is off and the file is too large to convert"}
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            logger.info(f"🧹 {name} database converted to incremental auto-vacuum")
+            return {"converted": True, "pages_freed": free}
+        if mode != 2:
+            return None  # Full auto-vacuum already frees pages on every commit
+        # The pragma frees a page per step, and execute() only takes the
+        # first step; executescript runs it to completion
+        conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_RUN});")
+        return {"pages_freed": free - conn.execute("PRAGMA freelist_count").fetchone()[0]}
+
+    def _checkpoint(self, name: str) -> Optional[dict]:
+        wal_bytes = file_size(self._databases[name].db_path + "-wal")
+        if not wal_bytes:
+            return None
+        busy, frames, checkpointed = self._connection(name).execute(
+            "PRAGMA wal_checkpoint(TRUNCATE)"
+        ).fetchone()
+        return {"busy": bool(busy), "wal_bytes_before": wal_bytes, "frames": frames,
+                "checkpointed": checkpointed}
+
+    def _optimize(self, name: str) -> dict:
+        conn = self._connection(name)
+        conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+        if sqlite3.sqlite_version_info >= (3, 46, 0):
+            # 0x10000: consider every table, not just those this connection queried
+            conn.execute("PRAGMA optimize(0x10002)").fetchall()
+        else:
+            # Older PRAGMA optimize only looks at tables this connection has
+            # queried, which is none; a sampled ANALYZE does the same job
+            conn.execute("ANALYZE")
+        return {"analyzed": True}
+
+    def run_once(self):
+        """Run every task that is due (and, if it needs it, whose database is quiet)"""
+        quiet = {name: self._is_quiet(name) for name in self._databases}
+        for task in self.tasks:
+            now = time.time()
+            if now - task.last_run < task.every:
+                continue
+            if task.quiet_only and not quiet.get(task.database):
+                continue
+            task.last_run = now
+            if self.elect and not self.elect(task.name, task.every):
+                continue
+            started = time.perf_counter()
+            try:
+                task.last_result = task.run()
+                task.last_error = None
+            except Exception as e:
+                task.last_error = str(e)
+                logger.error(f"❌ Maintenance task {task.name} failed: {e}")
+            task.last_seconds = time.perf_counter() - started
+            task.runs += 1
+
+    def _loop(self):
+        try:
+            while not self._stop.wait(self.tick):
+                try:
+                    self.run_once()
+                except Exception as e:
+                    logger.error(f"❌ Maintenance pass failed: {e}")
+        finally:
+            for conn in self._probes.values():
+                conn.close()
+            self._probes.clear()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def storage(self) -> dict:
+        """File and WAL sizes of every database, and the last result of each task"""
+        databases = {}
+        for name, store in self._databases.items():
+            path = store.db_path
+            conn = sqlite3.connect(path, timeout=1.0)
+            try:
+                page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+                page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+                free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+            finally:
+                conn.close()
+            databases[name] = {
+                "file_bytes": file_size(path),
+                "wal_bytes": file_size(path + "-wal"),
+                "page_size": page_size,
+                "page_count": page_count,
+                "free_pages": free_pages,
+                "free_bytes": free_pages * page_size,
+                "auto_vacuum": AUTO_VACUUM_MODES.get(auto_vacuum, str(auto_vacuum)),
+            }
+        tasks = {
+            task.name: {
+                "every_seconds": task.every,
+                "runs_here": task.runs,
+                "last_run": task.last_run if task.runs else None,
+                "last_seconds": round(task.last_seconds, 3) if task.last_seconds is not None else None,
+                "last_result": task.last_result,
+                "last_error": task.last_error,
+            }
+            for task in self.tasks
+        }
+        return {"pid": os.getpid(), "databases": databases, "tasks": tasks}
@@ -0,0 +1,101 @@
+import base64
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # Optional; zlib with the same dictionary is the fallback
+    zstandard = None
+
+# First byte of every sealed plaintext says how it was compressed. Ids are
+# stored with the data, so an existing codec or its dictionary must never
+# change; new ones get a new id.
+CODEC_RAW = 0
+CODEC_DEFLATE_V1 = 1
+CODEC_ZSTD_V1 = 2
+
+# Preset dictionary shared by every message. Chat messages are short, so
+# on their own they barely compress; seeding the compressor with phrases the
+# assistant and users keep repeating is what makes it pay off. It is built
+# from fixed text only, never from user data, because it ships in the clear.
+DICTIONARY_V1 = " ".join([
+    "Thank you for your question. I understand you're seeking medical information.",
+    "I recommend consulting with a qualified healthcare professional for accurate medical advice and diagnosis.",
+    "This is not a substitute for professional medical advice, diagnosis, or treatment.",
+    "Please seek immediate medical attention if your symptoms worsen.",
+    "Based on the image provided, the findings are consistent with",
+    "Possible causes include infection, inflammation, trauma or a chronic condition.",
+    "Common symptoms include pain, swelling, fever, fatigue, nausea, headache, dizziness and shortness of breath.",
+    "Treatment options depend on the underlying cause and may include medication, rest and follow-up.",
+    "chest x-ray, CT scan, MRI, ultrasound, blood test, biopsy, histopathology, radiology report",
+    "lesion, nodule, opacity, fracture, effusion, consolidation, tumor, benign, malignant, tissue",
+    "Tıbbi tavsiye için lütfen bir sağlık uzmanına danışın. Belirtileriniz nelerdir?",
+    "ağrı, ateş, baş ağrısı, öksürük, nefes darlığı, bulantı, yorgunluk, tedavi, teşhis",
+    "What are the symptoms? How long have you had this? Is it serious? What should I do?",
+]).encode()
+
+ZSTD_LEVEL = 10
+DEFLATE_LEVEL = 9
+
+_zstd_dict = zstandard.ZstdCompressionDict(
+    DICTIONARY_V1, dict_type=zstandard.DICT_TYPE_RAWCONTENT
+) if zstandard else None
+
+
+def compress(data: bytes) -> bytes:
+    """Compress with the best available codec; falls back to raw if it doesn't help"""
+    if zstandard is not None:
+        codec = CODEC_ZSTD_V1
+        body = zstandard.ZstdCompressor(
+            level=ZSTD_LEVEL, dict_data=_zstd_dict, write_checksum=False, write_dict_id=False
+        ).compress(data)
+    else:
+        codec = CODEC_DEFLATE_V1
+        # Raw deflate: Fernet already authenticates, no need for zlib's header and checksum
+        compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -15, zdict=DICTIONARY_V1)
+        body = compressor.compress(data) + compressor.flush()
+    if len(body) >= len(data):
+        return bytes([CODEC_RAW]) + data
+    return bytes([codec]) + body
+
+
+def decompress(payload: bytes) -> bytes:
+    """Undo `compress`; raises ValueError for a codec this process can't read"""
+    codec, body = payload[0], payload[1:]
+    if codec == CODEC_RAW:
+        return body
+    if codec == CODEC_DEFLATE_V1:
+        try:
+            decompressor = zlib.decompressobj(-15, zdict=DICTIONARY_V1)
+            return decompressor.decompress(body) + decompressor.flush()
+        except zlib.error as e:
+            raise ValueError(f"Corrupt deflate payload: {e}")
+    if codec == CODEC_ZSTD_V1:
+        if zstandard is None:
+            raise ValueError("Message was compressed with zstd, which is not installed")
+        try:
+            return zstandard.ZstdDecompressor(dict_data=_zstd_dict).decompress(body)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Corrupt zstd payload: {e}")
+    raise ValueError(f"Unknown message codec {codec}")
+
+
+def seal(keyring, text: str) -> tuple:
+    """Compress then encrypt text for storage; returns (key_id, BLOB).
+
+    The BLOB is the binary Fernet token: base64 is only needed in transit,
+    so storing the decoded bytes saves a quarter of every row.
+    """
+    key_id, token = keyring.encrypt(compress(text.encode()))
+    return key_id, base64.urlsafe_b64decode(token)
+
+
+def unseal(keyring, stored, key_id: int = None) -> str:
+    """Read back a stored message.
+
+    Rows written before compression hold base64 Fernet TEXT over the raw
+    plaintext; newer rows hold a BLOB from `seal`. Raises InvalidToken if no
+    key opens it and ValueError if it can't be decompressed.
+    """
+    if isinstance(stored, str):
+        return keyring.decrypt(stored, key_id).decode()
+    return decompress(keyring.decrypt(base64.urlsafe_b64encode(stored), key_id)).decode()
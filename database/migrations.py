@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Migration:
+    """One ordered schema change, with an optional resumable data backfill.
+
+    `apply(c)` runs once, inside a single short write transaction, and must
+    only do cheap work (DDL, renames, ADD COLUMN). Anything proportional to
+    table size goes in `backfill(c, cursor, batch_size)`, which processes one
+    batch and returns `(next_cursor, rows)`; returning a `None` cursor marks
+    the backfill finished. The cursor is persisted after every batch, so a
+    restart resumes where the last batch stopped.
+    """
+
+    def __init__(self, version: int, name: str,
+                 apply: Optional[Callable] = None,
+                 backfill: Optional[Callable[..., Tuple[Optional[str], int]]] = None,
+                 on_complete: Optional[Callable] = None):
+        self.version = version
+        self.name = name
+        self.apply = apply
+        self.backfill = backfill
+        self.on_complete = on_complete
+
+
+class MigrationRunner:
+    """Applies migrations to one SQLite database and drives their backfills"""
+
+    def __init__(self, get_connection: Callable, migrations: List[Migration], label: str):
+        self.get_connection = get_connection
+        self.migrations = sorted(migrations, key=lambda m: m.version)
+        self.label = label
+        self._backfill_thread = None
+
+    def _ensure_version_table(self, c):
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL,
+            backfill_cursor TEXT,
+            backfill_done INTEGER NOT NULL DEFAULT 1
+        )''')
+
+    def current_version(self) -> int:
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            self._ensure_version_table(c)
+            c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            return c.fetchone()[0]
+        finally:
+            conn.close()
+
+    def run(self) -> int:
+        """Apply every migration newer than the recorded version; returns how many ran"""
+        applied = 0
+        for migration in self.migrations:
+            conn = self.get_connection()
+            try:
+                c = conn.cursor()
+                # Re-check under the write lock: another worker may have just applied it
+                c.execute("BEGIN IMMEDIATE")
+                self._ensure_version_table(c)
+                c.execute("SELECT 1 FROM schema_version WHERE version = ?", (migration.version,))
+                if c.fetchone():
+                    conn.rollback()
+                    continue
+
+                if migration.apply:
+                    migration.apply(c)
+                c.execute('''
+                INSERT INTO schema_version (version, name, applied_at, backfill_done)
+                VALUES (?, ?, ?, ?)
+                ''', (migration.version, migration.name, datetime.utcnow().isoformat(),
+                      0 if migration.backfill else 1))
+                conn.commit()
+                applied += 1
+                logger.info(f"🔄 {self.label}: applied migration {migration.version} ({migration.name})")
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+        return applied
+
+    def pending_backfills(self) -> List[int]:
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            self._ensure_version_table(c)
+            c.execute("SELECT version FROM schema_version WHERE backfill_done = 0 ORDER BY version")
+            return [row[0] for row in c.fetchall()]
+        finally:
+            conn.close()
+
+    def run_backfill_batch(self, migration: Migration, batch_size: int) -> Tuple[bool, int]:
+        """Run one batch in its own write transaction; returns (finished, rows)"""
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            c.execute(
+                "SELECT backfill_cursor, backfill_done FROM schema_version WHERE version = ?",
+                (migration.version,)
+            )
+            cursor, done = c.fetchone()
+            if done:
+                conn.rollback()
+                return True, 0
+
+            next_cursor, rows = migration.backfill(c, cursor, batch_size)
+            c.execute(
+                "UPDATE schema_version SET backfill_cursor = ?, backfill_done = ? WHERE version = ?",
+                (next_cursor, 1 if next_cursor is None else 0, migration.version)
+            )
+            conn.commit()
+            return next_cursor is None, rows
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def run_backfills(self, batch_size: int = 500, pause: float = 0.05):
+        """Drive every unfinished backfill to completion, one short batch at a time"""
+        by_version = {m.version: m for m in self.migrations}
+        for version in self.pending_backfills():
+            migration = by_version.get(version)
+            if migration is None or migration.backfill is None:
+                continue
+
+            started = time.time()
+            total = 0
+            try:
+                while True:
+                    finished, rows = self.run_backfill_batch(migration, batch_size)
+                    total += rows
+                    if finished:
+                        break
+                    # Let live requests take the write lock between batches
+                    time.sleep(pause)
+            except Exception as e:
+                logger.error(f"❌ {self.label}: backfill {version} ({migration.name}) stopped, "
+                             f"will resume on next start: {e}")
+                return
+
+            if migration.on_complete:
+                migration.on_complete()
+            elapsed = max(time.time() - started, 1e-6)
+            logger.info(f"✅ {self.label}: backfill {version} ({migration.name}) done, "
+                        f"{total} rows in {elapsed:.1f}s ({total / elapsed:.0f} rows/s)")
+
+    def start_backfills(self, batch_size: int = 500, pause: float = 0.05) -> bool:
+        """Run pending backfills on a daemon thread; returns False if there are none"""
+        if not self.pending_backfills():
+            return False
+        self._backfill_thread = threading.Thread(
+            target=self.run_backfills, args=(batch_size, pause), daemon=True
+        )
+        self._backfill_thread.start()
+        return True
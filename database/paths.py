@@ -0,0 +1,42 @@
+import logging
+import os
+from functools import lru_cache
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_data_dir() -> Path:
+    """Resolve the persistent data directory once per process.
+
+    Every database file lives here, so the probing below runs a single time
+    no matter how many stores ask for it.
+    """
+    # Try multiple persistent locations in order of preference
+    possible_paths = [
+        os.getenv("DATABASE_PATH"),      # Explicit override (set on Render)
+        "/opt/render/project/src/data",  # Render persistent storage
+        "/tmp/data",                     # Fallback for development
+        "./data",                        # Local fallback
+    ]
+    
+    for path in filter(None, possible_paths):
+        try:
+            data_dir = Path(path)
+            data_dir.mkdir(parents=True, exist_ok=True)
+            
+            # Test if we can write to this directory
+            test_file = data_dir / f"test_write_{os.getpid()}.tmp"
+            test_file.write_text("test")
+            test_file.unlink()
+            
+            logger.info(f"✅ Using persistent data directory: {data_dir.absolute()}")
+            return data_dir
+            
+        except Exception as e:
+            logger.error(f"❌ Cannot use path {path}: {e}")
+    
+    # Ultimate fallback - current directory
+    logger.warning(f"⚠️  Using fallback data directory: {Path('.').absolute()}")
+    return Path(".")
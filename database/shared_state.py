@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from database.paths import get_data_dir
+
+logger = logging.getLogger(__name__)
+
+
+class SharedState:
+    """Key/value store shared by every worker process.
+
+    Uvicorn/gunicorn workers do not share memory, so anything that must be
+    consistent across them (rate limits, quotas, cache versions) lives here.
+    A small SQLite file stands in for Redis; the method names mirror the
+    Redis commands they replace so a Redis client can be dropped in later
+    without touching callers.
+    """
+
+    def __init__(self, db_path: Optional[str] = None):
+        self._db_path = db_path
+        self._local = threading.local()
+
+    @property
+    def db_path(self) -> str:
+        if self._db_path is None:
+            self._db_path = str(get_data_dir() / "radiglow_shared.db")
+        return self._db_path
+
+    def get_connection(self):
+        """Return this thread's connection, reopening it after a fork"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            # Autocommit mode: every statement is its own short transaction
+            # unless we explicitly BEGIN, so the writer lock is never held
+            # across an await point.
+            conn = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def init_db(self):
+        conn = self.get_connection()
+        # Keys expire constantly; the maintenance purge deletes them and
+        # incremental vacuum gives their pages back
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS shared_state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL
+            ) WITHOUT ROWID
+        ''')
+        logger.info(f"✅ Shared state store ready: {self.db_path}")
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self.get_connection().execute(
+            "SELECT value, expires_at FROM shared_state WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires_at = time.time() + ttl if ttl else None
+        self.get_connection().execute(
+            "INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), expires_at)
+        )
+
+    def delete(self, key: str):
+        self.get_connection().execute("DELETE FROM shared_state WHERE key = ?", (key,))
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """Atomically add `amount` to an integer counter and return the new value.
+
+        The TTL is only applied when the counter is created (or has expired),
+        like INCR followed by EXPIRE NX in Redis. Without one, an expired
+        counter keeps its old expiry, so it is still purged.
+        """
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        conn = self.get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute('''
+                INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    value = CASE WHEN expires_at IS NOT NULL AND expires_at <= ?
+                                 THEN excluded.value
+                                 ELSE CAST(value AS INTEGER) + excluded.value END,
+                    expires_at = CASE WHEN expires_at IS NOT NULL AND expires_at <= ?
+                                      THEN COALESCE(excluded.expires_at, expires_at)
+                                      ELSE expires_at END
+            ''', (key, amount, expires_at, now, now))
+            value = conn.execute(
+                "SELECT value FROM shared_state WHERE key = ?", (key,)
+            ).fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return int(value)
+
+    def take_token(self, key: str, rate: float, capacity: float, cost: float = 1.0) -> float:
+        """Take `cost` tokens from a token bucket every worker shares.
+
+        The bucket refills at `rate` tokens per second up to `capacity` and
+        starts full. Returns 0 if the tokens were taken, otherwise the
+        seconds until they would be; a refused take spends nothing. The key
+        expires once the bucket would be full again.
+        """
+        now = time.time()
+        conn = self.get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value, expires_at FROM shared_state WHERE key = ?", (key,)
+            ).fetchone()
+            tokens, stamp = capacity, now
+            if row is not None and (row[1] is None or row[1] > now):
+                tokens, stamp = json.loads(row[0])
+            tokens = min(capacity, tokens + (now - stamp) * rate)
+            wait = 0.0 if tokens >= cost else (cost - tokens) / rate
+            if not wait:
+                tokens -= cost
+            conn.execute(
+                "INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps([tokens, now]), now + (capacity - tokens) / rate)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def expire(self, key: str, ttl: float):
+        self.get_connection().execute(
+            "UPDATE shared_state SET expires_at = ? WHERE key = ?", (time.time() + ttl, key)
+        )
+
+    def purge_expired(self) -> int:
+        """Drop expired keys; returns how many were removed"""
+        cursor = self.get_connection().execute(
+            "DELETE FROM shared_state WHERE expires_at IS NOT NULL AND expires_at <= ?",
+            (time.time(),)
+        )
+        return cursor.rowcount
@@ -0,0 +1,229 @@
+import copy
+import logging
+import time
+from typing import NamedTuple, Optional, Sequence
+
+import torch
+from PIL import Image
+from transformers import DynamicCache, StoppingCriteria, StoppingCriteriaList
+
+from speculative import generate as assisted_generate
+
+logger = logging.getLogger(__name__)
+
+# Stand-in for the user's question when rendering the template once
+_TEXT_PLACEHOLDER = "\x00QUESTION\x00"
+
+
+def build_messages(text: str, image, system_prompt: str = ""):
+    """Chat messages in the format expected by MedGemma"""
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": [{"type": "text", "text": system_prompt}]})
+    messages.append(
+        {
+            "role": "user",
+            "content": [
+                {"type": "image", "image": image},
+                {"type": "text", "text": text}
+            ]
+        }
+    )
+    return messages
+
+
+class GenerationResult(NamedTuple):
+    text: str
+    tokens_generated: int
+    # "eos", "stop_sequence", "max_tokens" or "deadline"
+    stop_reason: str
+    # From tokenizing the prompt to the first new token, and to the last
+    first_token_seconds: Optional[float] = None
+    generation_seconds: Optional[float] = None
+
+
+class StopControl(StoppingCriteria):
+    """Ends generation once the wall-clock deadline passes or a stop sequence appears.
+
+    Checked after every decoding step, so a deadline costs at most one
+    step of overrun and the tokens generated so far are kept. Only the text
+    added since the last check (plus enough overlap to catch a sequence
+    split across steps) is decoded. The first check also marks when the
+    first new token arrived.
+    """
+
+    def __init__(self, tokenizer, prompt_length: int, stop: Sequence[str] = (),
+                 deadline: Optional[float] = None, started: Optional[float] = None):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stop = [s for s in stop if s]
+        self.deadline = deadline
+        # A token is at least one character, so this many tokens always covers a sequence
+        self.overlap = max((len(s) for s in self.stop), default=0)
+        self.checked = prompt_length
+        self.reason: Optional[str] = None
+        self.started = started if started is not None else time.perf_counter()
+        self.first_token_at: Optional[float] = None
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.reason = "deadline"
+            return True
+        if self.stop:
+            start = max(self.prompt_length, self.checked - self.overlap)
+            self.checked = input_ids.shape[-1]
+            tail = self.tokenizer.decode(input_ids[0, start:], skip_special_tokens=True)
+            if any(s in tail for s in self.stop):
+                self.reason = "stop_sequence"
+                return True
+        return False
+
+    def finish(self, processor, outputs, max_new_tokens: int) -> GenerationResult:
+        """Decode the new tokens, cut at the first stop sequence and say why generation ended"""
+        finished = time.perf_counter()
+        new_tokens = outputs[0][self.prompt_length:]
+        text = processor.decode(new_tokens, skip_special_tokens=True)
+        reason = self.reason
+        cuts = [text.find(s) for s in self.stop if s in text]
+        if cuts:
+            text = text[:min(cuts)]
+        if reason is None:
+            reason = "max_tokens" if len(new_tokens) >= max_new_tokens else "eos"
+        first_token = self.first_token_at - self.started if self.first_token_at is not None else None
+        return GenerationResult(text.strip(), len(new_tokens), reason, first_token, finished - self.started)
+
+
+def _generation_kwargs(processor, max_new_tokens: int, control: StopControl):
+    # Greedy decoding: deterministic and avoids sampling errors
+    return {
+        "max_new_tokens": max_new_tokens,
+        "do_sample": False,
+        "pad_token_id": processor.tokenizer.pad_token_id,
+        "eos_token_id": processor.tokenizer.eos_token_id,
+        "use_cache": True,
+        "stopping_criteria": StoppingCriteriaList([control]),
+    }
+
+
+def generate_response(model, processor, device: str, text: str, image, max_new_tokens: int,
+                      system_prompt: str = "", draft=None, stop: Sequence[str] = (),
+                      deadline: Optional[float] = None) -> GenerationResult:
+    """Apply the chat template, generate greedily and decode only the new tokens"""
+    started = time.perf_counter()
+    inputs = processor.apply_chat_template(
+        build_messages(text, image, system_prompt),
+        add_generation_prompt=True,
+        tokenize=True,
+        return_dict=True,
+        return_tensors="pt",
+    )
+    if device == "cuda":
+        inputs = inputs.to(model.device)
+    control = StopControl(processor.tokenizer, inputs["input_ids"].shape[-1], stop, deadline, started)
+
+    with torch.no_grad():
+        if device == "cuda":
+            torch.cuda.empty_cache()
+        outputs = assisted_generate(model, inputs, _generation_kwargs(processor, max_new_tokens, control), draft)
+
+    return control.finish(processor, outputs, max_new_tokens)
+
+
+class PromptCache:
+    """Reuses the parts of every prompt that never change.
+
+    The chat template is rendered once with a placeholder question, so a
+    request only tokenizes its own text and image. Everything before the
+    image (BOS, turn markers and the system prompt) is identical across
+    requests, so its KV cache is computed once and each request prefills
+    from a copy of it, paying only for the image and question tokens.
+    """
+
+    def __init__(self, model, processor, device: str, system_prompt: str = "", draft=None):
+        self.model = model
+        self.processor = processor
+        self.device = device
+        self.draft = draft
+
+        placeholder_image = Image.new("RGB", (1, 1))
+        rendered = processor.apply_chat_template(
+            build_messages(_TEXT_PLACEHOLDER, placeholder_image, system_prompt),
+            add_generation_prompt=True,
+            tokenize=False,
+        )
+        self.head, self.tail = rendered.split(_TEXT_PLACEHOLDER)
+
+        self.prefix_ids = None
+        self.prefix_kv = None
+        image_marker = getattr(processor, "boi_token", None)
+        if image_marker and image_marker in self.head:
+            prefix_text = self.head[:self.head.index(image_marker)]
+            self.prefix_ids = processor.tokenizer(
+                prefix_text, add_special_tokens=False, return_tensors="pt"
+            ).input_ids.to(model.device)
+            self.prefix_kv = DynamicCache()
+            with torch.no_grad():
+                model(input_ids=self.prefix_ids, past_key_values=self.prefix_kv, use_cache=True)
+            logger.info(f"✅ Prefix KV cache ready ({self.prefix_ids.shape[-1]} tokens)")
+        else:
+            logger.warning("⚠️ Processor has no image marker in the template, prefix KV cache disabled")
+
+    def tokenize(self, text: str, image):
+        # The rendered template already carries BOS
+        inputs = self.processor(
+            text=self.head + text + self.tail,
+            images=[image],
+            add_special_tokens=False,
+            return_tensors="pt",
+        )
+        return inputs.to(self.model.device)
+
+    def _prefill(self, inputs):
+        """Prefill everything but the last prompt token on top of a copy of
+        the prefix cache; returns the cache, or None if the prefix differs"""
+        input_ids = inputs["input_ids"]
+        start = self.prefix_ids.shape[-1]
+        end = input_ids.shape[-1] - 1
+        if end <= start or not torch.equal(input_ids[0, :start], self.prefix_ids[0]):
+            return None
+
+        cache = copy.deepcopy(self.prefix_kv)
+        prefill = {
+            "input_ids": input_ids[:, start:end],
+            "attention_mask": inputs["attention_mask"][:, :end],
+            "pixel_values": inputs["pixel_values"],
+            "past_key_values": cache,
+            "cache_position": torch.arange(start, end, device=input_ids.device),
+            "use_cache": True,
+        }
+        if "token_type_ids" in inputs:
+            # Image tokens attend to each other bidirectionally
+            prefill["token_type_ids"] = inputs["token_type_ids"][:, start:end]
+        self.model(**prefill)
+        return cache
+
+    def generate(self, text: str, image, max_new_tokens: int, stop: Sequence[str] = (),
+                 deadline: Optional[float] = None) -> GenerationResult:
+        started = time.perf_counter()
+        inputs = self.tokenize(text, image)
+        control = StopControl(self.processor.tokenizer, inputs["input_ids"].shape[-1], stop, deadline, started)
+        kwargs = _generation_kwargs(self.processor, max_new_tokens, control)
+
+        with torch.no_grad():
+            if self.device == "cuda":
+                torch.cuda.empty_cache()
+            cache = self._prefill(inputs) if self.prefix_kv is not None else None
+            if cache is not None:
+                # The image is already in the cache; generate() only runs
+                # the last prompt token and then decodes
+                outputs = assisted_generate(self.model, {
+                    "input_ids": inputs["input_ids"],
+                    "attention_mask": inputs["attention_mask"],
+                    "past_key_values": cache,
+                }, kwargs, self.draft)
+            else:
+                outputs = assisted_generate(self.model, inputs, kwargs, self.draft)
+
+        return control.finish(self.processor, outputs, max_new_tokens)
@@ -1,29 +1,50 @@
-from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Form, Header
+from dotenv import load_dotenv
+load_dotenv()  # Before structured_logging reads the LOG_* settings
+from structured_logging import setup_logging, logging_stats
+setup_logging("inference")
+
+from fastapi import FastAPI, Depends, HTTPException, status, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from transformers import AutoProcessor, AutoModelForImageTextToText
 import torch
 import os
-from dotenv import load_dotenv
+import asyncio
+import hmac
+import json
+import time
 from datetime import datetime, timezone
 import logging
 from typing import Optional
 from PIL import Image
 import io
+from functools import partial
+from model_loader import load_model as load_weights, warm_up
+from generation import generate_response, GenerationResult, PromptCache
+from worker_pool import WorkerPool
+from speculative import load_draft_model, DRAFT_TOKENS
+from upload_guard import read_image_upload, UploadMetrics, BodySizeLimitMiddleware, MAX_UPLOAD_BYTES
 
-# Load environment variables
-load_dotenv()
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Configuration
 API_KEY = os.getenv("API_KEY", "your-api-key")
-MODEL_NAME = os.getenv("MODEL_NAME", "churchylol/medgemma-4b-it-merged)
+MODEL_NAME = os.getenv("MODEL_NAME", "churchylol/medgemma-4b-it-merged")
 HF_TOKEN = os.getenv("HF_TOKEN")
-
-print(f"🔑 Loaded API Key: {API_KEY[:20]}...{API_KEY[-10:]}")  # Debug line
+# Forked inference processes on CPU nodes; 1 keeps inference in this process
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", "1"))
+# torch intra-op threads per worker; defaults to the worker's core count
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", "0")) or None
+# Optional system prompt placed before every question
+SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT", "")
+# Reuse the rendered template and the KV cache of the constant prompt prefix
+PREFIX_CACHE = os.getenv("PREFIX_CACHE", "1") == "1"
+# Upper bound on max_new_tokens (the CPU fallback uses at most 50); the
+# effective value is echoed in every response
+MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS", "100"))
+# Kept back from a request's X-Deadline for decoding and sending the reply
+DEADLINE_MARGIN_SECONDS = 0.5
+MAX_STOP_SEQUENCES = 4
+MAX_STOP_LENGTH = 64
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -41,110 +62,216 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Oversized bodies are refused before they are read
+upload_metrics = UploadMetrics()
+app.add_middleware(BodySizeLimitMiddleware, metrics=upload_metrics)
+
 # Response model
 class InferenceResponse(BaseModel):
     response: str
     model: str
     timestamp: str
+    tokens_generated: Optional[int] = None
+    # "eos", "stop_sequence", "max_tokens" or "deadline" (partial output)
+    stop_reason: Optional[str] = None
+    max_new_tokens: Optional[int] = None
+    # Measured inside generation, so queueing and upload time are excluded
+    first_token_ms: Optional[float] = None
+    generation_ms: Optional[float] = None
 
 # Global variables
 model = None
 processor = None
 device = None
+model_state = "starting"  # starting -> loading -> warming_up -> ready | failed
+load_task = None
+worker_pool = None
+prompt_cache = None
+draft = None  # SpeculativeDecoder when DRAFT_MODEL_NAME is set
 
 def verify_api_key(x_api_key: str = Header(..., alias="X-API-Key")):
-    """Verify API key from header"""
-    logger.info(f"🔍 Received API Key: {x_api_key[:20] if x_api_key else 'None'}...{x_api_key[-10:] if x_api_key and len(x_api_key) > 10 else ''}")
-    logger.info(f"🔍 Expected API Key: {API_KEY[:20]}...{API_KEY[-10:]}")
-    
-    if x_api_key != API_KEY:
-        logger.error(f"❌ API Key mismatch!")
+    """Verify API key from header (no part of either key is ever logged)"""
+    if not hmac.compare_digest(x_api_key.encode(), API_KEY.encode()):
+        logger.warning("⚠️ Invalid API key", extra={"event": "auth.invalid_key"})
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid API key"
         )
-    
-    logger.info("✅ API Key validated successfully")
     return x_api_key
 
-def load_model():
-    """Load the MedGemma model and processor"""
-    global model, processor, device
-    
+def run_generation(text: str, pil_image, max_new_tokens: int, stop: tuple = (),
+                   deadline: Optional[float] = None) -> GenerationResult:
+    if prompt_cache is not None:
+        return prompt_cache.generate(text, pil_image, max_new_tokens, stop, deadline)
+    return generate_response(model, processor, device, text, pil_image, max_new_tokens, SYSTEM_PROMPT, draft,
+                             stop, deadline)
+
+def generate_from_bytes(text: str, image_data: bytes, max_new_tokens: int, stop: tuple = (),
+                        deadline: Optional[float] = None):
+    """Inference worker entry point; runs in a forked process.
+
+    Returns the generation result plus this call's speculative decoding
+    counters, which the parent folds into its own totals. The deadline is
+    wall-clock time, so it means the same thing in every process.
+    """
+    pil_image = Image.open(io.BytesIO(image_data)).convert('RGB')
+    result = run_generation(text, pil_image, max_new_tokens, stop, deadline)
+    return result, draft.stats.last() if draft else None
+
+def milliseconds(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+def parse_stop_sequences(raw: Optional[str]) -> tuple:
+    """The `stop` form field: a JSON list of strings"""
+    if not raw:
+        return ()
     try:
-        logger.info(f"Loading model: {MODEL_NAME}")
-        
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        logger.info(f"Using device: {device}")
-        
-        auth_token = HF_TOKEN if HF_TOKEN else None
-        
-        # Load processor
-        processor = AutoProcessor.from_pretrained(
-            MODEL_NAME,
-            token=auth_token,
-            trust_remote_code=True
+        stop = json.loads(raw)
+    except ValueError:
+        stop = None
+    if (not isinstance(stop, list) or len(stop) > MAX_STOP_SEQUENCES
+            or not all(isinstance(s, str) and 0 < len(s) <= MAX_STOP_LENGTH for s in stop)):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"stop must be a JSON list of at most {MAX_STOP_SEQUENCES} strings "
+                   f"of 1-{MAX_STOP_LENGTH} characters"
         )
-        logger.info("✅ Processor loaded")
-        
-        # Load model with better error handling
-        model_kwargs = {
-            "token": auth_token,
-            "trust_remote_code": True,
-            "low_cpu_mem_usage": True,
-        }
-        
-        if device == "cuda":
-            model_kwargs.update({
-                "torch_dtype": torch.bfloat16,
-                "device_map": "auto",
-            })
+    return tuple(stop)
+
+def parse_deadline(raw: Optional[str]) -> Optional[float]:
+    """X-Deadline: Unix time (seconds) by which the caller needs the reply"""
+    if not raw:
+        return None
+    try:
+        deadline = float(raw)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="X-Deadline must be a Unix timestamp in seconds"
+        )
+    return deadline - DEADLINE_MARGIN_SECONDS
+
+def load_model(loop=None):
+    """Load the MedGemma model and processor, then warm them up"""
+    global model, processor, device, model_state, worker_pool, prompt_cache, draft
+
+    try:
+        model_state = "loading"
+        use_pool = SERVE_WORKERS > 1 and not torch.cuda.is_available()
+        if use_pool:
+            # Keep the parent single-threaded: an OpenMP pool started
+            # before fork is not usable in the children
+            torch.set_num_threads(1)
+
+        auth_token = HF_TOKEN if HF_TOKEN else None
+        loaded_model, loaded_processor, loaded_device = load_weights(MODEL_NAME, auth_token)
+
+        model_state = "warming_up"
+        # /inference gates on model_state, so publishing early is safe
+        model, processor, device = loaded_model, loaded_processor, loaded_device
+        draft = load_draft_model(model, processor.tokenizer, auth_token)
+        if PREFIX_CACHE:
+            prompt_cache = PromptCache(model, processor, device, SYSTEM_PROMPT, draft)
+
+        if use_pool:
+            # Workers fork from here and inherit the model and prefix cache
+            pool = WorkerPool(
+                generate_from_bytes, SERVE_WORKERS, TORCH_THREADS,
+                warm_up=partial(warm_up, run_generation)
+            )
+            pool.start(loop)
+            worker_pool = pool
         else:
-            model_kwargs["torch_dtype"] = torch.float32
-        
-        model = AutoModelForImageTextToText.from_pretrained(MODEL_NAME, **model_kwargs)
-        
-        if device == "cpu":
-            model = model.to(device)
-        
-        model.eval()
-        logger.info("✅ Model loaded successfully")
-        
+            warm_up(run_generation)
+        model_state = "ready"
+
     except Exception as e:
+        model_state = "failed"
         logger.error(f"❌ Error loading model: {str(e)}")
         raise e
 
 @app.on_event("startup")
 async def startup_event():
-    """Load model on startup"""
-    load_model()
+    """Load the model in the background so liveness checks pass meanwhile"""
+    global load_task
+    load_task = asyncio.create_task(asyncio.to_thread(load_model, asyncio.get_running_loop()))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if worker_pool is not None:
+        worker_pool.stop()
 
 @app.get("/")
 async def root():
-    """Health check endpoint"""
+    """Liveness check: the process is up, whether or not the model is loaded"""
     return {"message": "MedGemma API is running", "status": "healthy"}
 
+@app.get("/ready")
+async def ready():
+    """Readiness check: 200 only once the model is loaded and warmed up"""
+    if model_state != "ready":
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Model {model_state}"
+        )
+    if worker_pool is not None and not worker_pool.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="No inference workers alive"
+        )
+    workers = len([w for w in worker_pool.workers if w.alive]) if worker_pool else 1
+    return {"status": "ready", "model": MODEL_NAME, "device": device, "workers": workers}
+
+@app.get("/stats")
+async def stats(api_key: str = Depends(verify_api_key)):
+    """Speculative decoding and rejected upload counters since startup"""
+    speculative = None
+    if draft is not None:
+        speculative = dict(draft.stats.as_dict(), draft_tokens_per_step=DRAFT_TOKENS)
+    return {"speculative": speculative, "uploads": upload_metrics.snapshot(), "logging": logging_stats()}
+
 @app.post("/inference", response_model=InferenceResponse)
 async def inference(
-    text: str = Form(...),
-    image: UploadFile = File(...),
-    max_new_tokens: Optional[int] = Form(50),
-    api_key: str = Depends(verify_api_key)
+    request: Request,
+    api_key: str = Depends(verify_api_key),
+    x_deadline: Optional[str] = Header(None, alias="X-Deadline")
 ):
     """
     Inference endpoint - requires BOTH text and image + valid API key
     
-    Args:
+    Multipart form fields:
         text: Required text input/question
         image: Required image file
-        max_new_tokens: Maximum tokens to generate (default: 50)
+        max_new_tokens: Maximum tokens to generate (default: 50, capped at MAX_NEW_TOKENS)
+        stop: Optional JSON list of stop sequences; the reply is cut before the first one
+    
+    With an X-Deadline header (Unix time in seconds) generation stops when
+    the budget is spent and the partial reply is returned with
+    stop_reason "deadline"; a request whose deadline has already passed
+    gets 504 without running the model.
+    
+    The form is parsed as it streams in, after the API key check; oversized
+    or non-image uploads are rejected without reading the rest of the body.
     """
-    if model is None or processor is None:
+    if model_state != "ready":
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Model not loaded"
+            detail=f"Model not loaded ({model_state})"
         )
+    deadline = parse_deadline(x_deadline)
+    started = time.perf_counter()
     
+    upload = await read_image_upload(request, "image", MAX_UPLOAD_BYTES, upload_metrics)
+    stop = parse_stop_sequences(upload.fields.get("stop"))
+    text = upload.fields.get("text", "")
+    try:
+        max_new_tokens = int(upload.fields.get("max_new_tokens") or 50)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="max_new_tokens must be an integer"
+        )
+
     try:
         # Validate text input
         text = text.strip()
@@ -156,9 +283,9 @@ async def inference(
         
         # Process image (required)
         try:
-            image_data = await image.read()
+            image_data = bytes(upload.file_data)
             pil_image = Image.open(io.BytesIO(image_data)).convert('RGB')
-            logger.info("✅ Image processed")
+            logger.debug("Image processed")
         except Exception as e:
             logger.error(f"Error processing image: {str(e)}")
             raise HTTPException(
@@ -166,64 +293,26 @@ async def inference(
                 detail=f"Invalid image format: {str(e)}"
             )
         
-        # Create messages in the format expected by MedGemma
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image", "image": pil_image},
-                    {"type": "text", "text": text}
-                ]
-            }
-        ]
+        # Use conservative parameters to avoid CUDA errors
+        max_new_tokens = max(1, min(max_new_tokens, MAX_NEW_TOKENS))
         
-        # Apply chat template and tokenize
-        try:
-            inputs = processor.apply_chat_template(
-                messages,
-                add_generation_prompt=True,
-                tokenize=True,
-                return_dict=True,
-                return_tensors="pt",
-            )
-            
-            # Move to device with error handling
-            if device == "cuda":
-                try:
-                    inputs = inputs.to(model.device)
-                except Exception as e:
-                    logger.error(f"CUDA error moving inputs: {str(e)}")
-                    # Fallback to CPU
-                    device_cpu = "cpu"
-                    model_cpu = model.cpu()
-                    inputs = inputs.to("cpu")
-                    logger.info("Fallback to CPU processing")
-                    
-        except Exception as e:
-            logger.error(f"Error in chat template: {str(e)}")
+        if deadline is not None and deadline <= time.time():
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Template processing failed: {str(e)}"
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail="Deadline passed before generation started"
             )
-        
+
         # Generate response with error handling
         try:
-            with torch.no_grad():
-                # Clear CUDA cache if using GPU
-                if device == "cuda":
-                    torch.cuda.empty_cache()
-                
-                # Use conservative parameters to avoid CUDA errors
-                generation_kwargs = {
-                    "max_new_tokens": min(max_new_tokens, 100),
-                    "do_sample": False,  # Use greedy decoding to avoid sampling errors
-                    "pad_token_id": processor.tokenizer.pad_token_id,
-                    "eos_token_id": processor.tokenizer.eos_token_id,
-                    "use_cache": True,
-                }
-                
-                outputs = model.generate(**inputs, **generation_kwargs)
-                
+            if worker_pool is not None:
+                result, call_stats = await worker_pool.submit(text, image_data, max_new_tokens, stop, deadline)
+                if call_stats:
+                    draft.stats.merge(call_stats)
+            else:
+                # generate() holds the GIL only between kernels; keep the loop
+                # free for health checks while it runs
+                result = await asyncio.to_thread(run_generation, text, pil_image, max_new_tokens, stop, deadline)
+
         except RuntimeError as e:
             if "CUDA" in str(e):
                 logger.error(f"CUDA error during generation: {str(e)}")
@@ -231,20 +320,16 @@ async def inference(
                 try:
                     logger.info("Attempting CPU fallback...")
                     model_cpu = model.cpu()
-                    inputs_cpu = {k: v.cpu() for k, v in inputs.items()}
-                    
-                    with torch.no_grad():
-                        outputs = model_cpu.generate(
-                            **inputs_cpu,
-                            max_new_tokens=min(max_new_tokens, 50),
-                            do_sample=False,
-                            pad_token_id=processor.tokenizer.pad_token_id,
-                        )
-                    
+                    max_new_tokens = min(max_new_tokens, 50)
+                    result = await asyncio.to_thread(
+                        generate_response, model_cpu, processor, "cpu", text, pil_image,
+                        max_new_tokens, SYSTEM_PROMPT, None, stop, deadline
+                    )
+
                     # Move model back to GPU for next request
                     if torch.cuda.is_available():
                         model.cuda()
-                        
+
                 except Exception as cpu_e:
                     logger.error(f"CPU fallback also failed: {str(cpu_e)}")
                     raise HTTPException(
@@ -256,25 +341,31 @@ async def inference(
                     status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                     detail=f"Generation failed: {str(e)}"
                 )
-        
-        # Decode only the new tokens (response)
-        try:
-            response_text = processor.decode(
-                outputs[0][inputs["input_ids"].shape[-1]:], 
-                skip_special_tokens=True
-            ).strip()
-        except Exception as e:
-            logger.error(f"Decoding error: {str(e)}")
-            response_text = "I processed your request but had trouble generating a response. Please try again."
+
+        logger.info("✅ Inference done", extra={
+            "event": "inference",
+            "seconds": round(time.perf_counter() - started, 3),
+            "first_token_ms": milliseconds(result.first_token_seconds),
+            "image_bytes": len(image_data),
+            "max_new_tokens": max_new_tokens,
+            "tokens_generated": result.tokens_generated,
+            "stop_reason": result.stop_reason,
+        })
         
         # Ensure we have a response
+        response_text = result.text
         if not response_text or len(response_text) < 3:
             response_text = "I analyzed your image and question, but couldn't generate a detailed response. Please try rephrasing your question."
         
         return InferenceResponse(
             response=response_text,
             model=MODEL_NAME,
-            timestamp=datetime.now(timezone.utc).isoformat()
+            timestamp=datetime.now(timezone.utc).isoformat(),
+            tokens_generated=result.tokens_generated,
+            stop_reason=result.stop_reason,
+            max_new_tokens=max_new_tokens,
+            first_token_ms=milliseconds(result.first_token_seconds),
+            generation_ms=milliseconds(result.generation_seconds)
         )
         
     except HTTPException:
@@ -292,4 +383,8 @@ if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8001"))
     
-    uvicorn.run(app, host=host, port=port)
+    # Outlast the web tier's pooled connections (60s idle there) so it is
+    # always the client that closes an idle one, never a request in flight
+    keep_alive = int(os.getenv("KEEP_ALIVE_SECONDS", "75"))
+    
+    uvicorn.run(app, host=host, port=port, timeout_keep_alive=keep_alive)
@@ -0,0 +1,136 @@
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+logger = logging.getLogger(__name__)
+
+# Small causal LM that drafts tokens for the main model to verify; empty disables
+DRAFT_MODEL_NAME = os.getenv("DRAFT_MODEL_NAME", "")
+# Tokens drafted per verification step (transformers adapts it from here)
+DRAFT_TOKENS = int(os.getenv("DRAFT_TOKENS", "5"))
+
+
+class SpeculativeStats:
+    """Acceptance counters for assisted generation.
+
+    Every forward pass of the main model verifies the drafted tokens and
+    emits one token of its own, so `generated - steps` drafted tokens were
+    accepted. Passes are counted with forward hooks, per thread, so calls
+    running concurrently in different threads don't mix their numbers.
+    """
+
+    FIELDS = ("requests", "generated", "drafted", "accepted", "steps")
+
+    def __init__(self):
+        self.totals = dict.fromkeys(self.FIELDS, 0)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def attach(self, target, draft):
+        target.register_forward_hook(lambda *_: self._count("steps"))
+        draft.register_forward_hook(lambda *_: self._count("drafted"))
+
+    def _count(self, field: str):
+        current = getattr(self._local, "current", None)
+        if current is not None:
+            current[field] += 1
+
+    def begin(self):
+        self._local.current = dict.fromkeys(self.FIELDS, 0)
+
+    def end(self, generated: int) -> Dict[str, int]:
+        """Close the current call's counters, fold them into the totals and return them"""
+        current = self._local.current
+        self._local.current = None
+        current["requests"] = 1
+        current["generated"] = generated
+        current["accepted"] = max(generated - current["steps"], 0)
+        self._local.last = current
+        self.merge(current)
+        return current
+
+    def last(self) -> Optional[Dict[str, int]]:
+        """Counters of the most recent call made by this thread"""
+        return getattr(self._local, "last", None)
+
+    def merge(self, counts: Dict[str, int]):
+        with self._lock:
+            for field in self.FIELDS:
+                self.totals[field] += counts.get(field, 0)
+
+    def reset(self):
+        with self._lock:
+            self.totals = dict.fromkeys(self.FIELDS, 0)
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            totals = dict(self.totals)
+        totals["acceptance_rate"] = round(totals["accepted"] / totals["drafted"], 3) if totals["drafted"] else None
+        totals["tokens_per_step"] = round(totals["generated"] / totals["steps"], 2) if totals["steps"] else None
+        return totals
+
+
+class SpeculativeDecoder:
+    """A loaded draft model plus the generate() arguments that enable it"""
+
+    def __init__(self, draft_model, target_tokenizer, draft_tokenizer=None,
+                 draft_tokens: int = DRAFT_TOKENS):
+        self.draft_model = draft_model
+        self.draft_model.generation_config.num_assistant_tokens = draft_tokens
+        self.target_tokenizer = target_tokenizer
+        self.draft_tokenizer = draft_tokenizer
+        self.stats = SpeculativeStats()
+
+    def generate_kwargs(self) -> Dict[str, Any]:
+        kwargs = {"assistant_model": self.draft_model}
+        if self.draft_tokenizer is not None:
+            # Different vocabularies: transformers re-tokenizes the draft's
+            # text into the main model's ids (universal assisted decoding,
+            # transformers 4.46+)
+            kwargs["tokenizer"] = self.target_tokenizer
+            kwargs["assistant_tokenizer"] = self.draft_tokenizer
+        return kwargs
+
+
+def load_draft_model(target_model, target_tokenizer, token: Optional[str] = None,
+                     model_name: str = DRAFT_MODEL_NAME) -> Optional[SpeculativeDecoder]:
+    """Load the draft model named by DRAFT_MODEL_NAME, or return None if unset"""
+    if not model_name:
+        return None
+
+    draft_tokenizer = AutoTokenizer.from_pretrained(model_name, token=token)
+    draft_model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        token=token,
+        use_safetensors=True,
+        low_cpu_mem_usage=True,
+        # Draft and main model must agree on the logits dtype they compare
+        torch_dtype=next(target_model.parameters()).dtype,
+    ).to(target_model.device)
+    draft_model.eval()
+
+    same_vocab = draft_tokenizer.get_vocab() == target_tokenizer.get_vocab()
+    decoder = SpeculativeDecoder(draft_model, target_tokenizer, None if same_vocab else draft_tokenizer)
+    decoder.stats.attach(target_model, draft_model)
+    logger.info(f"✅ Draft model loaded: {model_name} ({DRAFT_TOKENS} tokens per step"
+                f"{'' if same_vocab else ', cross-vocabulary'})")
+    return decoder
+
+
+def generate(model, inputs: Dict[str, Any], generation_kwargs: Dict[str, Any],
+             speculative: Optional[SpeculativeDecoder] = None):
+    """model.generate(), assisted by the draft model when one is configured"""
+    if speculative is None:
+        return model.generate(**inputs, **generation_kwargs)
+
+    outputs = None
+    speculative.stats.begin()
+    try:
+        outputs = model.generate(**inputs, **generation_kwargs, **speculative.generate_kwargs())
+        return outputs
+    finally:
+        generated = outputs.shape[-1] - inputs["input_ids"].shape[-1] if outputs is not None else 0
+        speculative.stats.end(generated)
@@ -0,0 +1,204 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def split_cores(workers: int) -> List[List[int]]:
+    """Split the CPUs this process may run on into `workers` contiguous groups"""
+    cores = sorted(os.sched_getaffinity(0))
+    workers = max(1, min(workers, len(cores)))
+    size, extra = divmod(len(cores), workers)
+    groups, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+def _configure_threads(cores: List[int], threads: Optional[int]):
+    os.sched_setaffinity(0, cores)
+    threads = threads or len(cores)
+    # Must happen before the first parallel op in this process
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(threads)
+    try:
+        # One request at a time per worker, so inter-op parallelism only
+        # oversubscribes the cores already used by intra-op threads
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+
+def _worker_main(index: int, cores: List[int], threads: Optional[int], conn,
+                 handler: Callable, warm_up: Optional[Callable]):
+    """Body of a forked worker: pin, warm up, then serve requests in order"""
+    _configure_threads(cores, threads)
+    try:
+        if warm_up:
+            warm_up()
+        conn.send((None, True, os.getpid()))
+    except Exception as e:
+        conn.send((None, False, f"warm-up failed: {e}"))
+        return
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        request_id, args = message
+        try:
+            conn.send((request_id, True, handler(*args)))
+        except Exception as e:
+            conn.send((request_id, False, f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+    def __init__(self, index: int, cores: List[int], process, conn):
+        self.index = index
+        self.cores = cores
+        self.process = process
+        self.conn = conn
+        self.outstanding = 0
+        self.alive = True
+        self.send_lock = threading.Lock()
+
+
+class WorkerPool:
+    """Fork-based pool of inference processes, one per core group.
+
+    The parent loads the model once and forks; the children inherit the
+    weights copy-on-write, and since inference never writes to them the
+    pages stay shared. Each child is pinned to its own cores with a matching
+    torch thread count, which scales better on CPU than one process running
+    every core through a single `generate` call. Requests go to the worker
+    with the fewest outstanding requests.
+    """
+
+    def __init__(self, handler: Callable[..., Any], workers: int,
+                 threads_per_worker: Optional[int] = None,
+                 warm_up: Optional[Callable[[], None]] = None):
+        self.handler = handler
+        self.workers_requested = workers
+        self.threads_per_worker = threads_per_worker
+        self.warm_up = warm_up
+        self.workers: List[_Worker] = []
+        self._futures = {}
+        self._ids = itertools.count()
+        self._loop = None
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.workers) and any(w.alive for w in self.workers)
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """Fork the workers and wait until each has warmed up.
+
+        Blocking; call it from a thread. `loop` is the event loop that
+        `submit` will be awaited on.
+        """
+        self._loop = loop
+        context = multiprocessing.get_context("fork")
+        for index, cores in enumerate(split_cores(self.workers_requested)):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_worker_main,
+                args=(index, cores, self.threads_per_worker, child_conn, self.handler, self.warm_up),
+                name=f"inference-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self.workers.append(_Worker(index, cores, process, parent_conn))
+
+        for worker in self.workers:
+            _, ok, detail = worker.conn.recv()
+            if not ok:
+                self.stop()
+                raise RuntimeError(f"Inference worker {worker.index} {detail}")
+            logger.info(f"✅ Inference worker {worker.index} ready (pid {detail}, cores {worker.cores})")
+            threading.Thread(target=self._read_results, args=(worker,), daemon=True).start()
+
+    def _read_results(self, worker: _Worker):
+        while True:
+            try:
+                request_id, ok, value = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+            self._resolve(worker, request_id, ok, value)
+
+        worker.alive = False
+        logger.error(f"❌ Inference worker {worker.index} exited (code {worker.process.exitcode})")
+        for request_id, (owner, _) in list(self._futures.items()):
+            if owner is worker:
+                self._resolve(worker, request_id, False, "Inference worker exited")
+
+    def _resolve(self, worker: _Worker, request_id: int, ok: bool, value):
+        entry = self._futures.pop(request_id, None)
+        if entry is None:
+            return
+        future = entry[1]
+
+        def settle():
+            worker.outstanding -= 1
+            if future.done():
+                return
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(value))
+
+        self._loop.call_soon_threadsafe(settle)
+
+    async def submit(self, *args) -> Any:
+        """Run `handler(*args)` on the least busy worker and return its result"""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        candidates = [w for w in self.workers if w.alive]
+        if not candidates:
+            raise RuntimeError("No inference workers available")
+        worker = min(candidates, key=lambda w: w.outstanding)
+
+        request_id = next(self._ids)
+        future = self._loop.create_future()
+        self._futures[request_id] = (worker, future)
+        worker.outstanding += 1
+
+        def send():
+            with worker.send_lock:
+                worker.conn.send((request_id, args))
+
+        try:
+            # Images can exceed the pipe buffer, so don't block the loop on send
+            await asyncio.to_thread(send)
+        except Exception:
+            self._futures.pop(request_id, None)
+            worker.outstanding -= 1
+            raise
+        return await future
+
+    def stop(self):
+        for worker in self.workers:
+            try:
+                with worker.send_lock:
+                    worker.conn.send(None)
+            except (OSError, BrokenPipeError):
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        self.workers = []
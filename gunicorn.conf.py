@@ -0,0 +1,26 @@
+# Gunicorn configuration for running several uvicorn workers behind one port.
+# Start with: gunicorn main:app -c gunicorn.conf.py
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# One worker per core by default; Render sets WEB_CONCURRENCY per instance type
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Image analysis can wait 90+ seconds on the MedGemma node
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+# Addresses allowed to set X-Forwarded-For/-Proto, so the app sees https and
+# the client rather than the proxy. Render's proxy has no fixed address and
+# is the only way in, so render.yaml sets "*". Rate limits and guest quotas
+# take the client from the header themselves (TRUSTED_PROXY_HOPS in
+# rate_limit.py), since with "*" uvicorn trusts its leftmost, client-written entry.
+forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+# Each worker imports the app itself so no SQLite connection or thread
+# created at import time is ever shared across a fork.
+preload_app = False
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+from urllib.parse import urljoin
+
+import httpx
+
+try:
+    import h2  # noqa: F401  (httpx needs it for HTTP/2)
+except ImportError:
+    h2 = None
+
+logger = logging.getLogger(__name__)
+
+# Idle pooled connections are kept this long; the inference node keeps its
+# side open longer (KEEP_ALIVE_SECONDS there), so the client always closes first
+KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("MEDICAL_API_KEEPALIVE_SECONDS", "60"))
+# The health probe doubles as the keep-warm ping, so it runs well inside the expiry
+PROBE_INTERVAL_SECONDS = float(os.getenv("MEDICAL_API_PROBE_SECONDS", "30"))
+MAX_CONNECTIONS = int(os.getenv("MEDICAL_API_MAX_CONNECTIONS", "8"))
+# HTTP/2 is negotiated over TLS (ALPN), so it needs an https URL; plain
+# http and HTTP/1.1-only servers keep using HTTP/1.1
+HTTP2 = os.getenv("MEDICAL_API_HTTP2", "1") == "1"
+
+CONNECT_TIMEOUT_SECONDS = 10
+READ_TIMEOUT_SECONDS = 90
+
+
+class Timing:
+    """Running totals for one phase of a request"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.last: Optional[float] = None
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self) -> Dict[str, Any]:
+        def ms(seconds):
+            return round(seconds * 1000, 1) if seconds is not None else None
+        return {"count": self.count, "avg_ms": ms(self.total / self.count) if self.count else None,
+                "last_ms": ms(self.last), "max_ms": ms(self.max)}
+
+
+class _RequestTrace:
+    """httpcore trace hook: stamps when the connection, headers and body arrive"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.connect_started: Optional[float] = None
+        self.connected: Optional[float] = None
+        self.request_sent: Optional[float] = None
+        self.headers_received: Optional[float] = None
+        self.http_version: Optional[str] = None
+
+    async def __call__(self, event: str, info: dict):
+        now = time.perf_counter()
+        if event == "connection.connect_tcp.started":
+            self.connect_started = now
+        elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            self.connected = now
+        elif event.endswith(".send_request_headers.started") and self.request_sent is None:
+            self.request_sent = now
+            self.http_version = "HTTP/2" if event.startswith("http2") else "HTTP/1.1"
+        elif event.endswith(".receive_response_headers.complete"):
+            self.headers_received = now
+
+
+class InferenceTransport:
+    """Pooled, kept-alive HTTP connections to the inference node.
+
+    One `httpx.AsyncClient` per worker process carries every call, so only
+    the first request (or the first after the pool went idle) pays for TCP
+    and TLS. A background probe hits the node's liveness endpoint (`/`)
+    every PROBE_INTERVAL_SECONDS; that keeps a connection warm and records
+    whether the node is reachable. Each request is timed in three parts:
+    connect (zero on a reused connection), time to first byte after the
+    request is sent, and reading the body.
+    """
+
+    def __init__(self, url: str, api_key: Optional[str], http2: bool = HTTP2):
+        self.url = url
+        self.health_url = urljoin(url, "/")
+        self.api_key = api_key
+        self.http2 = http2 and h2 is not None
+        if http2 and h2 is None:
+            logger.warning("⚠️ h2 not installed, inference transport uses HTTP/1.1")
+        self._client: Optional[httpx.AsyncClient] = None
+        self._probe_task: Optional[asyncio.Task] = None
+        self.connect = Timing()
+        self.ttfb = Timing()
+        self.body = Timing()
+        self.requests = 0
+        self.new_connections = 0
+        self.errors = 0
+        self.http_versions: Dict[str, int] = {}
+        self.healthy: Optional[bool] = None
+        self.last_probe: Optional[float] = None
+        self.probe_latency: Optional[float] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                headers={"X-API-Key": self.api_key or "", "User-Agent": "RadiGlow-Frontend/1.0"},
+                timeout=httpx.Timeout(READ_TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS),
+                limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                    max_keepalive_connections=MAX_CONNECTIONS,
+                                    keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS),
+            )
+        return self._client
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request on a pooled connection and read the whole body, timing each phase"""
+        trace = _RequestTrace()
+        self.requests += 1
+        try:
+            async with self.client.stream(method, url, extensions={"trace": trace}, **kwargs) as response:
+                await response.aread()
+        except httpx.HTTPError:
+            self.errors += 1
+            raise
+        done = time.perf_counter()
+
+        if trace.connect_started is not None:
+            self.new_connections += 1
+            self.connect.add((trace.connected or trace.connect_started) - trace.connect_started)
+        else:
+            self.connect.add(0.0)
+        if trace.request_sent is not None and trace.headers_received is not None:
+            self.ttfb.add(trace.headers_received - trace.request_sent)
+            self.body.add(done - trace.headers_received)
+        version = trace.http_version or response.http_version
+        self.http_versions[version] = self.http_versions.get(version, 0) + 1
+        return response
+
+    async def post(self, **kwargs) -> httpx.Response:
+        return await self.request("POST", self.url, **kwargs)
+
+    async def probe(self) -> bool:
+        """GET the node's liveness endpoint; also opens or refreshes a pooled connection"""
+        started = time.perf_counter()
+        try:
+            response = await self.client.get(self.health_url, timeout=CONNECT_TIMEOUT_SECONDS)
+            self.healthy = response.status_code == 200
+        except httpx.HTTPError as e:
+            if self.healthy is not False:
+                logger.warning(f"⚠️ Inference node health probe failed: {e}")
+            self.healthy = False
+        self.last_probe = time.time()
+        self.probe_latency = time.perf_counter() - started
+        return self.healthy
+
+    async def _probe_loop(self):
+        while True:
+            await self.probe()
+            await asyncio.sleep(PROBE_INTERVAL_SECONDS)
+
+    def start(self):
+        """Warm the pool and keep probing in the background (call from the event loop)"""
+        if self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def close(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            self._probe_task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "http2_enabled": self.http2,
+            "http_versions": self.http_versions,
+            "requests": self.requests,
+            "errors": self.errors,
+            "new_connections": self.new_connections,
+            "reused_connections": self.requests - self.errors - self.new_connections,
+            "connect": self.connect.as_dict(),
+            "ttfb": self.ttfb.as_dict(),
+            "body": self.body.as_dict(),
+            "healthy": self.healthy,
+            "last_probe": self.last_probe,
+            "probe_latency_ms": round(self.probe_latency * 1000, 1) if self.probe_latency is not None else None,
+        }
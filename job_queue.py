@@ -0,0 +1,303 @@
+import asyncio
+import base64
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+from typing import Optional, Dict, Any, Callable, Awaitable
+from database.ids import new_id
+from database.paths import get_data_dir
+
+logger = logging.getLogger(__name__)
+
+# Job states: pending -> queued -> running -> done | failed
+TERMINAL_STATES = ("done", "failed")
+
+# A job is created pending and submitted right after the user's message is
+# stored; one still pending after this long lost its request (the worker
+# died in between) and only holds on to its image
+PENDING_TIMEOUT_SECONDS = 600
+
+class JobQueue:
+    """Persistent queue for slow image analysis jobs.
+
+    Jobs live in a SQLite table so they survive restarts and can be claimed
+    by any worker process. The table is in the chats database and created
+    by its migrations, so ChatDB.init_db runs before `start`. Each process runs a bounded pool of asyncio
+    workers; a claimed job holds a lease, and jobs whose lease expires
+    (their worker died) are picked up again.
+
+    Claiming is weighted fair queuing across users: each job gets a virtual
+    finish tag when submitted, `max(head of queue, user's last tag) + 1/weight`,
+    and workers take the lowest tag. A user with fifty queued uploads is
+    interleaved with everyone else instead of blocking them, and a user
+    already running `max_concurrent` jobs is skipped until one finishes.
+    """
+
+    def __init__(self, handler: Callable[[Dict[str, Any]], Awaitable[None]], db_path: Optional[str] = None,
+                 concurrency: int = 2, lease_seconds: int = 300, max_attempts: int = 3,
+                 poll_interval: float = 1.0, total_capacity: Optional[int] = None):
+        self._db_path = db_path
+        # Jobs running at once across all processes, for wait estimates
+        self.total_capacity = total_capacity or concurrency
+        self.handler = handler
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.worker_id = f"{os.getpid()}-{base64.urlsafe_b64encode(os.urandom(6)).decode()}"
+        self._tasks = []
+        self._wakeup = None
+
+    @property
+    def db_path(self) -> str:
+        # Jobs live next to the chats they answer
+        if self._db_path is None:
+            self._db_path = str(get_data_dir() / "radiglow_chats.db")
+        return self._db_path
+
+    def get_connection(self):
+        conn = sqlite3.connect(self.db_path, timeout=30.0)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _row_to_job(self, row) -> Dict[str, Any]:
+        return {
+            "job_id": row["id"],
+            "user_id": row["user_id"],
+            "chat_id": row["chat_id"],
+            "status": row["status"],
+            "error": row["error"],
+            "attempts": row["attempts"],
+            "created_at": datetime.utcfromtimestamp(row["created_at"]).isoformat(),
+            "finished_at": datetime.utcfromtimestamp(row["finished_at"]).isoformat() if row["finished_at"] else None,
+        }
+
+    def find_by_idempotency_key(self, user_id: str, idempotency_key: str) -> Optional[Dict[str, Any]]:
+        conn = self.get_connection()
+        row = conn.execute(
+            "SELECT * FROM inference_jobs WHERE user_id = ? AND idempotency_key = ?",
+            (user_id, idempotency_key)
+        ).fetchone()
+        conn.close()
+        return self._row_to_job(row) if row else None
+
+    def create(self, user_id: str, chat_id: str, prompt: str, image: bytes,
+               idempotency_key: Optional[str] = None, weight: float = 1.0, max_concurrent: int = 1):
+        """Insert a job in the `pending` state; returns (job, created).
+
+        Pending jobs are invisible to workers until `submit` is called, so the
+        caller can write the user's message first and keep history ordered.
+        A retried request with the same idempotency key gets the original job.
+        `weight` and `max_concurrent` are the user's fair-share settings.
+        """
+        job_id = new_id()
+        conn = self.get_connection()
+        try:
+            conn.execute('''
+                INSERT INTO inference_jobs (id, user_id, chat_id, idempotency_key, status, prompt, image, created_at,
+                                            weight, max_concurrent)
+                VALUES (?, ?, ?, ?, 'pending', ?, ?, ?, ?, ?)
+            ''', (job_id, user_id, chat_id, idempotency_key, prompt, image, time.time(),
+                  max(weight, 0.01), max(max_concurrent, 1)))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.close()
+            return self.find_by_idempotency_key(user_id, idempotency_key), False
+        conn.close()
+        return self.get(job_id), True
+
+    def submit(self, job_id: str):
+        """Make a pending job visible to workers, stamped with its fair-share tag"""
+        conn = self.get_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            job = conn.execute(
+                "SELECT user_id, weight FROM inference_jobs WHERE id = ? AND status = 'pending'",
+                (job_id,)
+            ).fetchone()
+            if job is None:
+                conn.rollback()
+                return
+            # Virtual time is the head of the queue; a user's tags
+            # continue from their own backlog, so heavy users fall behind
+            head, backlog = conn.execute('''
+                SELECT
+                    (SELECT MIN(fair_tag) FROM inference_jobs WHERE status = 'queued'),
+                    (SELECT MAX(fair_tag) FROM inference_jobs
+                     WHERE user_id = ? AND status IN ('queued', 'running'))
+            ''', (job["user_id"],)).fetchone()
+            fair_tag = max(head or 0, backlog or 0) + 1 / job["weight"]
+            conn.execute(
+                "UPDATE inference_jobs SET status = 'queued', fair_tag = ? WHERE id = ?",
+                (fair_tag, job_id)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def get(self, job_id: str, user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        conn = self.get_connection()
+        try:
+            row = conn.execute("SELECT * FROM inference_jobs WHERE id = ?", (job_id,)).fetchone()
+            if not row or (user_id is not None and row["user_id"] != user_id):
+                return None
+            job = self._row_to_job(row)
+            if row["status"] == "queued":
+                job.update(self._queue_position(conn, row))
+            return job
+        finally:
+            conn.close()
+
+    def _queue_position(self, conn, row) -> Dict[str, Any]:
+        """1-based place in the claim order, and a rough wait estimate"""
+        ahead = conn.execute('''
+            SELECT COUNT(*) FROM inference_jobs
+            WHERE status = 'queued'
+              AND (fair_tag < ? OR (fair_tag = ? AND created_at < ?))
+        ''', (row["fair_tag"], row["fair_tag"], row["created_at"])).fetchone()[0]
+        running = conn.execute("SELECT COUNT(*) FROM inference_jobs WHERE status = 'running'").fetchone()[0]
+        average = conn.execute('''
+            SELECT AVG(finished_at - started_at) FROM (
+                SELECT finished_at, started_at FROM inference_jobs
+                WHERE status = 'done' AND started_at IS NOT NULL
+                ORDER BY created_at DESC LIMIT 20
+            )
+        ''').fetchone()[0]
+        estimate = None
+        if average is not None:
+            # Everything ahead of us plus what's running, spread over the workers
+            estimate = round((ahead + running + 1) * average / self.total_capacity)
+        return {"queue_position": ahead + 1, "estimated_wait_seconds": estimate}
+
+    async def wait_for(self, job_id: str, user_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Long-poll a job until it finishes or `timeout` seconds pass"""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id, user_id)
+            if job is None or job["status"] in TERMINAL_STATES or time.monotonic() >= deadline:
+                return job
+            # Completions may happen in another worker process, so poll the table
+            await asyncio.sleep(min(self.poll_interval, max(deadline - time.monotonic(), 0)))
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """Atomically lease the oldest runnable job for this process"""
+        now = time.time()
+        conn = self.get_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # Lowest fair-share tag among users still under their concurrency limit
+            row = conn.execute('''
+                SELECT j.* FROM inference_jobs j
+                WHERE (j.status = 'queued' OR (j.status = 'running' AND j.lease_expires_at < ?))
+                  AND (SELECT COUNT(*) FROM inference_jobs r
+                       WHERE r.user_id = j.user_id AND r.status = 'running'
+                         AND r.lease_expires_at >= ?) < j.max_concurrent
+                ORDER BY j.fair_tag, j.created_at
+                LIMIT 1
+            ''', (now, now)).fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+
+            if row["attempts"] >= self.max_attempts:
+                conn.execute('''
+                    UPDATE inference_jobs
+                    SET status = 'failed', error = 'Gave up after repeated worker failures',
+                        prompt = NULL, image = NULL, finished_at = ?
+                    WHERE id = ?
+                ''', (now, row["id"]))
+                conn.commit()
+                logger.error(f"❌ Job {row['id']} abandoned after {row['attempts']} attempts")
+                return None
+
+            conn.execute('''
+                UPDATE inference_jobs
+                SET status = 'running', claimed_by = ?, lease_expires_at = ?, attempts = attempts + 1,
+                    started_at = ?
+                WHERE id = ?
+            ''', (self.worker_id, now + self.lease_seconds, now, row["id"]))
+            conn.commit()
+        finally:
+            conn.close()
+
+        job = self._row_to_job(row)
+        job["prompt"] = row["prompt"]
+        job["image"] = row["image"]
+        return job
+
+    def _finish(self, job_id: str, status: str, error: Optional[str] = None):
+        # Drop the prompt and image as soon as they are no longer needed
+        conn = self.get_connection()
+        conn.execute('''
+            UPDATE inference_jobs
+            SET status = ?, error = ?, prompt = NULL, image = NULL, finished_at = ?, lease_expires_at = NULL
+            WHERE id = ? AND claimed_by = ?
+        ''', (status, error, time.time(), job_id, self.worker_id))
+        conn.commit()
+        conn.close()
+
+    async def _worker(self, number: int):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"❌ Job worker {number} claim error: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            started = time.perf_counter()
+            try:
+                await self.handler(job)
+                self._finish(job["job_id"], "done")
+                logger.info("✅ Job done", extra={
+                    "event": "job.done", "job_id": job["job_id"], "worker": number,
+                    "attempt": job["attempts"] + 1, "seconds": round(time.perf_counter() - started, 3)
+                })
+            except asyncio.CancelledError:
+                # Shutting down: leave the lease to expire so another worker retries
+                raise
+            except Exception as e:
+                logger.error(f"❌ Job {job['job_id']} failed: {e}", extra={"event": "job.failed", "job_id": job["job_id"]})
+                self._finish(job["job_id"], "failed", str(e))
+
+    def reap_pending(self) -> int:
+        """Fail jobs left pending longer than PENDING_TIMEOUT_SECONDS and drop their images"""
+        now = time.time()
+        conn = self.get_connection()
+        try:
+            reaped = conn.execute('''
+                UPDATE inference_jobs
+                SET status = 'failed', error = 'Upload was interrupted', prompt = NULL, image = NULL,
+                    finished_at = ?
+                WHERE status = 'pending' AND created_at < ?
+            ''', (now, now - PENDING_TIMEOUT_SECONDS)).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        if reaped:
+            logger.warning(f"⚠️ Failed {reaped} jobs stuck in pending")
+        return reaped
+
+    async def start(self):
+        self.reap_pending()
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self.concurrency)]
+        logger.info(f"✅ Job queue started with {self.concurrency} workers ({self.worker_id})")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -1,21 +1,76 @@
+from dotenv import load_dotenv
+load_dotenv()  # Before structured_logging reads the LOG_* settings
+from structured_logging import setup_logging, logging_stats
+# Ahead of the other imports: the database modules log while being imported.
+# Per-message and per-login events are sampled; warnings and errors never are.
+# httpx would add a line for every inference node call and health probe.
+setup_logging("web", sample={"chat.message_added": 20, "auth.login": 10, "guest.usage": 10},
+              levels={"httpx": "WARNING"})
+
 from database.database import db  # For users and guest usage
-from database.chat_db import ChatDB  # For encrypted chats
-from api_client import medical_api_client  # New API client
-from fastapi import FastAPI, HTTPException, Depends, Response, Request, File, UploadFile
+from database.chat_db import ChatDB, EXPORT_FORMAT_VERSION  # For encrypted chats
+from database.keyring import UserKeyring
+from database.ids import new_id, now_ms, ms_to_iso
+from database.key_rotation import KeyRotation  # Re-encrypts chats after a key change
+from database.maintenance import MaintenanceScheduler  # Vacuum, checkpoints, archiving
+from database.shared_state import SharedState  # Shared across worker processes
+from api_client import medical_api_client, GENERATION_POLICIES  # New API client
+from job_queue import JobQueue  # Background image analysis
+from upload_guard import read_image_upload, UploadMetrics, BodySizeLimitMiddleware, MAX_UPLOAD_BYTES
+from rate_limit import RateLimit, RateLimiter, RateLimitMiddleware, VerifiedTokens, client_address
+from page_cache import PageCache  # HTML entry points, preloaded and gzipped
+from fastapi import FastAPI, HTTPException, Depends, Response, Request, Header, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import HTMLResponse, FileResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, List
 import jwt
+import hmac
+import json
 import os
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 import uuid
 import bcrypt
 import aiofiles
+import asyncio
+import logging
+import math
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Startup and shutdown; the only place the databases are initialized"""
+    db.init_db()  # User authentication database
+    chat_db.init_db()  # Encrypted chat database
+    shared_state.init_db()
+    pages.load()
+    if key_rotation.start():
+        logger.info(f"🔄 Re-encrypting chat messages to key {key_rotation.target_key_id} in background")
+    maintenance.start()
+    await job_queue.start()
+    
+    # Import and configure the Gemini SDK off the event loop so the first
+    # text message doesn't pay for it, without holding up startup
+    gemini_warm_up = asyncio.create_task(asyncio.to_thread(medical_api_client.warm_up))
+    # Open a connection to the inference node now, not on the first image
+    if medical_api_client.transport is not None:
+        medical_api_client.transport.start()
+    
+    yield
+    
+    gemini_warm_up.cancel()
+    if medical_api_client.transport is not None:
+        await medical_api_client.transport.close()
+    maintenance.stop()
+    key_rotation.stop()
+    await job_queue.stop()
 
-app = FastAPI(title="RadiGlow API", description="Medical AI Chat Platform")
+app = FastAPI(title="RadiGlow API", description="Medical AI Chat Platform", lifespan=lifespan)
 
 # FIXED: Custom StaticFiles class to disable caching
 class NoCacheStaticFiles(StaticFiles):
@@ -42,15 +97,124 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize both databases
-db.init_db()  # User authentication database
+# Both databases are created lazily and initialized once in lifespan()
 chat_db = ChatDB()  # Encrypted chat database
 
+def chat_key_material(user_id: str) -> Optional[str]:
+    """What a user's chat keys are derived from (see ChatDB.get_user_key callers)"""
+    user = db.get_user_by_id(int(user_id))
+    return user["email"] if user else None
+
+# Moves messages still under an older chat key version to the current one
+key_rotation = KeyRotation(chat_db, chat_key_material)
+
+# Cross-worker state (rate limits, quotas, cache versions)
+shared_state = SharedState()
+
+# How often cold chats are moved to the archive tier (ARCHIVE_AFTER_DAYS sets "cold")
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", str(6 * 3600)))
+
+def archive_cold_chats() -> int:
+    """Pack inactive chats into chat_archive, one page of candidates at a time"""
+    total = 0
+    cursor = None
+    while True:
+        archived, cursor = chat_db.archive_cold_chats(chat_key_material, after=cursor)
+        total += archived
+        if cursor is None:
+            break
+    if total:
+        logger.info(f"📦 Archived {total} inactive chats")
+    return total
+
+# Deleted-chat tombstones older than TOMBSTONE_RETENTION_DAYS are dropped this often
+TOMBSTONE_PRUNE_INTERVAL_SECONDS = 24 * 3600
+
+def prune_tombstones() -> int:
+    pruned = chat_db.prune_tombstones()
+    if pruned:
+        logger.info(f"🧹 Pruned {pruned} chat tombstones")
+    return pruned
+
+# Database upkeep; each due task runs in one worker per interval
+maintenance = MaintenanceScheduler(
+    elect=lambda name, ttl: shared_state.incr(f"maintenance:{name}", ttl=ttl) == 1
+)
+maintenance.add_database("chats", chat_db)
+maintenance.add_database("users", db)
+# Expired rate-limit buckets, quota counters and election keys are deleted
+# before each vacuum of the shared store
+maintenance.add_database("shared", shared_state, purge=shared_state.purge_expired)
+maintenance.add_task("archive", archive_cold_chats, ARCHIVE_INTERVAL_SECONDS)
+maintenance.add_task("tombstones", prune_tombstones, TOMBSTONE_PRUNE_INTERVAL_SECONDS)
+
+# Chat archive import streams its body, so it gets a higher ceiling than
+# other routes; a single record (one message) is still bounded
+MAX_IMPORT_BYTES = int(os.getenv("MAX_IMPORT_BYTES", str(256 * 1024 * 1024)))
+MAX_IMPORT_LINE_BYTES = 1024 * 1024
+IMPORT_BATCH_SIZE = 500
+
+# Oversized bodies are refused before they are read, on every route
+upload_metrics = UploadMetrics(shared_state)
+app.add_middleware(BodySizeLimitMiddleware, metrics=upload_metrics,
+                   path_limits={"/api/user/import": MAX_IMPORT_BYTES})
+
+def token_subject(token: str):
+    """(subject, expiry) of a valid JWT for the rate limiter, else None"""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except jwt.PyJWTError:
+        return None
+    if not payload.get("sub") or not payload.get("exp"):
+        return None
+    return payload["sub"], payload["exp"]
+
+# Shared by the rate limiter and the /chat page, so a token's signature is
+# checked once per worker
+verified_tokens = VerifiedTokens(token_subject)
+
+# Accounts are never deleted, so once a token's subject has been found in
+# the users table it need not be looked up again. Per worker, and bounded.
+MAX_KNOWN_USERS = 10_000
+known_users = set()
+
+pages = PageCache("static", ["index.html", "chat.html"])
+
+# Text replies go to the model, so a socket "send" frame spends from the same bucket
+chat_send_limit = RateLimit("POST", "/api/chat/send", per_minute=20, burst=5, key="user")
+
+# Requests per client and route. bcrypt makes login and register expensive,
+# so their buckets are shared across workers; everything else is per worker.
+rate_limiter = RateLimiter([
+    RateLimit("POST", "/api/login", per_minute=10, burst=5, shared=True),
+    RateLimit("POST", "/api/register", per_minute=5, burst=3, shared=True),
+    chat_send_limit,
+    RateLimit("POST", "/api/chat/upload", per_minute=6, burst=3, key="user"),
+    RateLimit("POST", "/api/chat/guest", per_minute=10, burst=3),
+    RateLimit("POST", "/api/user/import", per_minute=2, burst=2, key="user", shared=True),
+    RateLimit("GET", "/api/user/export", per_minute=4, burst=2, key="user"),
+    RateLimit("GET", "/ws/chat", per_minute=20, burst=10, key="user"),
+    RateLimit("*", "/api/*", per_minute=300, burst=60, key="user"),
+], subject=verified_tokens, shared_state=shared_state)
+
+# Added last, so it runs first: refused requests never reach the body limit or routing
+app.add_middleware(RateLimitMiddleware, limiter=rate_limiter)
+
 # Security
 SECRET_KEY = "your-secret-key-change-this-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24  # 30 days
 
+# Operational endpoints (/api/metrics/*) answer only requests carrying this
+# value in X-Metrics-Token; without it set they are not served at all
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+def verify_metrics_token(x_metrics_token: Optional[str] = Header(None, alias="X-Metrics-Token")):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_metrics_token or not hmac.compare_digest(x_metrics_token.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
 # Add the missing security instance
 security = HTTPBearer()
 
@@ -71,6 +235,9 @@ class ChatMessage(BaseModel):
 class GuestMessage(BaseModel):
     message: str
 
+class DeleteChatsRequest(BaseModel):
+    chat_ids: List[str]
+
 # Helper functions
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -95,25 +262,29 @@ def get_current_user_from_cookie(request: Request):
 
 # Routes
 @app.get("/", response_class=HTMLResponse)
-async def read_index():
-    return FileResponse('static/index.html')
+async def read_index(request: Request):
+    return pages.response("index.html", request)
 
 @app.get("/chat", response_class=HTMLResponse)
 async def read_chat(request: Request):
     token = request.cookies.get('token')
-    if not token:
+    email = verified_tokens.subject(token) if token else None
+    if not email:
         return RedirectResponse(url='/', status_code=302)
     
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if not email or not db.get_user_by_email(email):
+    if email not in known_users:
+        try:
+            user = await asyncio.to_thread(db.get_user_by_email, email)
+        except Exception as e:
+            logger.error(f"❌ Auth error: {e}")
             return RedirectResponse(url='/', status_code=302)
-    except Exception as e:
-        print(f"Auth error: {e}")
-        return RedirectResponse(url='/', status_code=302)
+        if not user:
+            return RedirectResponse(url='/', status_code=302)
+        if len(known_users) >= MAX_KNOWN_USERS:
+            known_users.clear()
+        known_users.add(email)
     
-    return FileResponse('static/chat.html')
+    return pages.response("chat.html", request)
 
 @app.post("/api/register")
 async def register(user: UserRegister, response: Response):
@@ -158,15 +329,126 @@ async def login(user: UserLogin, response: Response):
     }
 
 @app.get("/api/user/chats")
-async def get_user_chats(request: Request):
+async def get_user_chats(request: Request, response: Response, since: Optional[int] = None):
+    """The user's chat list, or with `since` only what changed after that version.
+    
+    The full list carries its version in X-Chats-Version; a `since` reply
+    is {"version", "reset", "changed", "deleted"}.
+    """
     current_user = get_current_user_from_cookie(request)
     user = db.get_user_by_email(current_user)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    chats = chat_db.get_user_chats(str(user["id"]))
+    if since is not None:
+        return chat_db.get_user_chat_changes(str(user["id"]), since)
+    
+    version, chats = chat_db.get_user_chats_versioned(str(user["id"]))
+    response.headers["X-Chats-Version"] = str(version)
     return chats
 
+@app.get("/api/user/export")
+async def export_user_chats(request: Request):
+    """Stream all of the user's chats, decrypted, as newline-delimited JSON"""
+    current_user = get_current_user_from_cookie(request)
+    user = db.get_user_by_email(current_user)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    user_id = str(user["id"])
+    user_key = chat_db.get_user_key(user_id, user["email"])
+    filename = f"radiglow-chats-{datetime.utcnow().strftime('%Y%m%d')}.ndjson"
+    return StreamingResponse(
+        chat_db.export_user_chats(user_id, user_key),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+async def read_ndjson(request: Request):
+    """Yield (line number, record) from a streamed NDJSON body without buffering it"""
+    buffer = bytearray()
+    line_no = 0
+    
+    def parse(line: bytes):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        if not isinstance(record, dict):
+            raise HTTPException(status_code=400, detail=f"Line {line_no} is not a JSON object")
+        return record
+    
+    async for chunk in request.stream():
+        buffer += chunk
+        while True:
+            end = buffer.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(buffer[:end]).strip()
+            del buffer[:end + 1]
+            line_no += 1
+            if line:
+                yield line_no, parse(line)
+        if len(buffer) > MAX_IMPORT_LINE_BYTES:
+            raise HTTPException(status_code=413, detail=f"Line {line_no + 1} is too long")
+    
+    if buffer.strip():
+        line_no += 1
+        yield line_no, parse(bytes(buffer).strip())
+
+@app.post("/api/user/import")
+async def import_user_chats(request: Request):
+    """Import an archive produced by /api/user/export as new chats.
+    
+    Records are written in batches as the body streams in; if the archive
+    turns out to be malformed part way, the batches before it stay imported
+    and the error reports how far it got.
+    """
+    current_user = get_current_user_from_cookie(request)
+    user = db.get_user_by_email(current_user)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    user_id = str(user["id"])
+    user_key = chat_db.get_user_key(user_id, user["email"])
+    importer = chat_db.import_chats(user_id, user_key)
+    header = None
+    batch = []
+    
+    try:
+        async for line_no, record in read_ndjson(request):
+            if header is None:
+                header = record
+                if (record.get("type") != "archive" or not isinstance(record.get("version"), int)
+                        or record["version"] > EXPORT_FORMAT_VERSION):
+                    raise HTTPException(status_code=400, detail="Not a RadiGlow chat archive or unsupported version")
+            batch.append(record)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await asyncio.to_thread(importer.write, batch)
+                batch = []
+        if header is None:
+            raise HTTPException(status_code=400, detail="Empty archive")
+        await asyncio.to_thread(importer.write, batch)
+    except HTTPException as e:
+        raise HTTPException(status_code=e.status_code, detail={"error": e.detail, "imported": importer.summary()})
+    
+    return importer.summary()
+
+@app.get("/api/chat/search")
+async def search_chats(q: str, request: Request, limit: int = 20):
+    """Search the user's chat history through the blind token index"""
+    current_user = get_current_user_from_cookie(request)
+    user = db.get_user_by_email(current_user)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    user_id = str(user["id"])
+    user_key = chat_db.get_user_key(user_id, user["email"])
+    # The first search builds the user's index, which decrypts their history
+    results = await asyncio.to_thread(chat_db.search_messages, user_id, user_key, q, limit=max(1, min(limit, 50)))
+    
+    return {"query": q, "results": results}
+
 @app.get("/api/chat/{chat_id}")
 async def get_chat(chat_id: str, request: Request):
     try:
@@ -185,16 +467,18 @@ async def get_chat(chat_id: str, request: Request):
             "messages": chat_history
         }
     except Exception as e:
-        print(f"Get chat error: {e}")
+        logger.error(f"Get chat error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/chat/guest")
 async def guest_chat(message: GuestMessage, request: Request):
-    client_ip = request.client.host
+    client_ip = client_address(request.scope)
     current_date = datetime.now().strftime("%Y-%m-%d")
     
-    current_usage = db.get_guest_usage(client_ip, current_date)
-    if current_usage >= 3:
+    # Reserve the slot before doing any work: with several workers a
+    # separate check-then-increment lets concurrent requests all pass.
+    usage_count = db.increment_guest_usage(client_ip, current_date)
+    if usage_count > 3:
         raise HTTPException(
             status_code=429,
             detail={
@@ -206,17 +490,19 @@ async def guest_chat(message: GuestMessage, request: Request):
         )
 
     try:
-        usage_count = db.increment_guest_usage(client_ip, current_date)
-        
         # Use the medical API client for guest messages (text-only, will use Gemini)
-        api_response = await medical_api_client.process_message(message.message, max_tokens=500)
+        api_response = await medical_api_client.process_message(
+            message.message, user_id=f"guest:{client_ip}", policy=GENERATION_POLICIES["guest"]
+        )
 
         return {
             "message": message.message,
             "response": api_response['response'],
             "remaining": max(3 - usage_count, 0),
             "total": 3,
-            "model": api_response.get('model', 'AI Assistant')
+            "model": api_response.get('model', 'AI Assistant'),
+            "stop_reason": api_response.get('stop_reason'),
+            "tokens_generated": api_response.get('tokens_generated')
         }
     except Exception as e:
         raise HTTPException(
@@ -248,7 +534,9 @@ async def send_message(message: ChatMessage, request: Request):
         chat_db.add_message(chat_id, message.message, "user", user_id, user_key)
         
         # Use the medical API client to generate response (text-only, will use Gemini)
-        api_response = await medical_api_client.process_message(message.message, max_tokens=500)
+        api_response = await medical_api_client.process_message(
+            message.message, user_id=user_id, policy=GENERATION_POLICIES["chat"]
+        )
         
         # Add AI response
         chat_db.add_message(chat_id, api_response['response'], "assistant", user_id, user_key)
@@ -261,104 +549,362 @@ async def send_message(message: ChatMessage, request: Request):
             "title": message.message[:30] + "..." if len(message.message) > 30 else message.message,
             "messages": chat_history,
             "created_at": datetime.now().isoformat(),
-            "is_new_chat": is_new_chat
+            "is_new_chat": is_new_chat,
+            "stop_reason": api_response.get('stop_reason'),
+            "tokens_generated": api_response.get('tokens_generated')
         }
 
     except Exception as e:
-        print(f"Send message error: {e}")
+        logger.error(f"Send message error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/chat/upload")
-async def upload_image(file: UploadFile = File(...), text: str = "", chat_id: str = "", request: Request = None):
-    """Handle image upload for medical analysis - treat exactly like text messages"""
+# Open /ws/chat connections in this worker process
+ws_connections = 0
+
+def chat_title(message: str) -> str:
+    return message[:30] + "..." if len(message) > 30 else message
+
+def same_origin(websocket: WebSocket) -> bool:
+    """Whether a socket handshake comes from a page on this host.
+    
+    CORS doesn't cover WebSockets and the cookie is sent cross-site, so a
+    browser's Origin must name the host the request was sent to. Clients
+    that send no Origin aren't browsers and have to hold the cookie anyway.
+    """
+    origin = websocket.headers.get("origin")
+    if origin is None:
+        return True
+    return urlsplit(origin).netloc.lower() == websocket.headers.get("host", "").lower()
+
+@app.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket):
+    """Text chat over one long-lived connection.
+    
+    The user is authenticated and their key derived once, when the socket
+    opens. Client frames are JSON with a `type` and an optional `ref` that
+    is echoed back on every reply:
+      {"type": "send", "message": ..., "chat_id": ...}  -> chat_updated,
+          message (the user's), token..., done (the assistant's message)
+      {"type": "history", "chat_id": ...}               -> history
+      {"type": "chats"}                                 -> chats
+      {"type": "ping"}                                  -> pong
+    Failures come back as {"type": "error", "detail": ...}; the socket
+    stays open. A "send" over the rate limit also carries `retry_after`.
+    Authentication failures close it with code 4401.
+    """
+    global ws_connections
+    if not same_origin(websocket):
+        logger.warning("⚠️ WebSocket from another origin refused", extra={"event": "ws.cross_origin"})
+        await websocket.close(code=1008)  # Before accept: the handshake gets a 403
+        return
+    await websocket.accept()
+    try:
+        current_user = get_current_user_from_cookie(websocket)
+    except HTTPException:
+        await websocket.close(code=4401)
+        return
+    user = await asyncio.to_thread(db.get_user_by_email, current_user)
+    if not user:
+        await websocket.close(code=4401)
+        return
+    
+    user_id = str(user["id"])
+    user_key = await asyncio.to_thread(chat_db.get_user_key, user_id, user["email"])
+    ws_connections += 1
+    try:
+        await websocket.send_json({"type": "ready"})
+        while True:
+            ref = None
+            try:
+                frame = json.loads(await websocket.receive_text())
+                if not isinstance(frame, dict):
+                    raise ValueError("Frames must be JSON objects")
+                ref = frame.get("ref")
+                kind = frame.get("type")
+                if kind == "send":
+                    retry_after = await rate_limiter.take(chat_send_limit, f"user:{current_user}")
+                    if retry_after:
+                        await websocket.send_json({"type": "error", "ref": ref, "detail": "Too many requests",
+                                                   "retry_after": math.ceil(retry_after)})
+                    else:
+                        await socket_send_message(websocket, ref, user_id, user_key, frame)
+                elif kind == "history":
+                    chat_id = str(frame.get("chat_id") or "")
+                    if not await asyncio.to_thread(chat_db.is_chat_owner, chat_id, user_id):
+                        raise ValueError("Chat not found")
+                    messages = await asyncio.to_thread(chat_db.get_chat_history, chat_id, user_key)
+                    await websocket.send_json({"type": "history", "ref": ref, "chat_id": chat_id, "messages": messages})
+                elif kind == "chats":
+                    chats = await asyncio.to_thread(chat_db.get_user_chats, user_id)
+                    await websocket.send_json({"type": "chats", "ref": ref, "chats": chats})
+                elif kind == "ping":
+                    await websocket.send_json({"type": "pong", "ref": ref})
+                else:
+                    raise ValueError(f"Unknown frame type: {kind}")
+            except ValueError as e:  # Includes malformed JSON
+                await websocket.send_json({"type": "error", "ref": ref, "detail": str(e)})
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                logger.error(f"❌ WebSocket chat error: {e}")
+                await websocket.send_json({"type": "error", "ref": ref, "detail": "Internal error"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        ws_connections -= 1
+
+async def socket_send_message(websocket: WebSocket, ref, user_id: str, user_key: UserKeyring, frame: dict):
+    """/ws/chat "send": store the message, stream the reply, store the reply"""
+    text = frame.get("message")
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError("Message is empty")
+    
+    chat_id = frame.get("chat_id")
+    is_new_chat = not chat_id
+    if is_new_chat:
+        chat_id = await asyncio.to_thread(chat_db.create_chat, user_id, chat_title(text))
+    elif not await asyncio.to_thread(chat_db.is_chat_owner, chat_id, user_id):
+        raise ValueError("Chat not found")
+    
+    await asyncio.to_thread(chat_db.add_message, chat_id, text, "user", user_id, user_key)
+    # Same format as stored messages read back through ms_to_iso
+    now = ms_to_iso(now_ms())
+    chat = {"id": chat_id, "updated_at": now}
+    if is_new_chat:
+        chat.update(title=chat_title(text), created_at=now)
+    await websocket.send_json({"type": "chat_updated", "ref": ref, "chat": chat, "is_new_chat": is_new_chat})
+    await websocket.send_json({
+        "type": "message", "ref": ref, "chat_id": chat_id,
+        "message": {"sender": "user", "content": text, "created_at": now}
+    })
+    
+    parts = []
+    async for chunk in medical_api_client.stream_message(text, policy=GENERATION_POLICIES["chat"]):
+        parts.append(chunk)
+        await websocket.send_json({"type": "token", "ref": ref, "chat_id": chat_id, "text": chunk})
+    
+    reply = "".join(parts)
+    await asyncio.to_thread(chat_db.add_message, chat_id, reply, "assistant", user_id, user_key)
+    await websocket.send_json({
+        "type": "done", "ref": ref, "chat_id": chat_id,
+        "message": {"sender": "assistant", "content": reply, "created_at": ms_to_iso(now_ms())}
+    })
+
+async def run_analysis_job(job: dict):
+    """Job queue handler: run the image analysis and store the assistant reply"""
+    user = db.get_user_by_id(int(job["user_id"]))
+    if not user:
+        raise Exception("User no longer exists")
+    
+    user_key = chat_db.get_user_key(job["user_id"], user["email"])
+    api_response = await medical_api_client.process_message(
+        job["prompt"],
+        image_data=job["image"],
+        user_id=job["user_id"],
+        policy=GENERATION_POLICIES["image"]
+    )
+    
+    ai_message_id = chat_db.add_message(job["chat_id"], api_response['response'], "assistant", job["user_id"], user_key)
+    logger.debug(f"Added AI response ID: {ai_message_id} to chat: {job['chat_id']}")
+
+# Image analysis runs in the background; rows live next to the chats they answer
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+job_queue = JobQueue(
+    run_analysis_job,
+    concurrency=JOB_WORKERS,
+    total_capacity=JOB_WORKERS * int(os.getenv("WEB_CONCURRENCY", "1"))
+)
+
+def reserve_hourly_job(user_id: str, limit: int):
+    """Count one image job against the user's hourly quota, or raise 429
+    
+    The counter lives in shared state so every worker sees the same total.
+    Callers release the reservation if the job is never created.
+    """
+    now = datetime.utcnow()
+    key = f"quota:jobs:{user_id}:{now.strftime('%Y%m%d%H')}"
+    used = shared_state.incr(key, ttl=3600)
+    if used > limit:
+        shared_state.incr(key, -1, ttl=3600)
+        retry_after = 3600 - (now.minute * 60 + now.second)
+        raise HTTPException(
+            status_code=429,
+            detail=f"Hourly image analysis limit reached ({limit}/hour)",
+            headers={"Retry-After": str(retry_after)}
+        )
+    return key
+
+@app.post("/api/chat/upload", status_code=202)
+async def upload_image(
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Queue an image for medical analysis and return the job id immediately
+    
+    The user message is stored right away; the assistant reply is written
+    by the job queue and picked up through /api/chat/jobs/{job_id}.
+    The multipart body (`file`, `text`, `chat_id`) is parsed as it streams
+    in, after authentication and the quota check, so bad uploads are cut off early.
+    """
     try:
         current_user = get_current_user_from_cookie(request)
         user = db.get_user_by_email(current_user)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        # Validate file type
-        if not file.content_type.startswith('image/'):
-            raise HTTPException(status_code=400, detail="File must be an image")
-        
-        # Read image data
-        image_data = await file.read()
-        
         user_id = str(user["id"])
         user_key = chat_db.get_user_key(user_id, user["email"])
         
-        # CRITICAL FIX: Handle chat continuation EXACTLY like text messages
-        if chat_id and chat_id.strip() and chat_id != "null" and chat_id != "undefined":
-            # Continue existing chat - this is the key fix
-            existing_chat_id = chat_id.strip()
-            try:
-                # IMPORTANT: Verify the chat exists and belongs to this user
-                existing_messages = chat_db.get_chat_history(existing_chat_id, user_key)
-                print(f"✅ CONTINUING existing chat: {existing_chat_id} with {len(existing_messages)} existing messages")
+        # A retried upload returns the job the first attempt created
+        if idempotency_key:
+            existing_job = job_queue.find_by_idempotency_key(user_id, idempotency_key)
+            if existing_job:
+                logger.info(f"♻️ Duplicate upload, returning job {existing_job['job_id']}")
+                return job_response(existing_job, user_key, is_new_chat=False)
+
+        limits = db.get_user_limits(user["id"])
+        quota_key = reserve_hourly_job(user_id, limits["jobs_per_hour"])
+        created = False
+        try:
+            # Size and magic bytes are checked while the body streams in
+            upload = await read_image_upload(request, "file", MAX_UPLOAD_BYTES, upload_metrics)
+            image_data = bytes(upload.file_data)
+            text = upload.fields.get("text", "")
+            chat_id = upload.fields.get("chat_id", "")
+            filename = upload.filename
+            
+            # CRITICAL FIX: Handle chat continuation EXACTLY like text messages
+            if chat_id and chat_id.strip() and chat_id != "null" and chat_id != "undefined":
+                # Continue existing chat - verify it belongs to this user
+                chat_id_to_use = chat_id.strip()
+                if not chat_db.is_chat_owner(chat_id_to_use, user_id):
+                    logger.error(f"❌ Chat verification failed for {chat_id_to_use}")
+                    raise HTTPException(status_code=404, detail="Chat not found or access denied")
                 is_new_chat = False
-                
-                # Make sure we're using the EXACT same chat ID
-                chat_id_to_use = existing_chat_id
-                
-            except Exception as e:
-                print(f"❌ Chat verification failed for {existing_chat_id}: {e}")
-                raise HTTPException(status_code=404, detail="Chat not found or access denied")
-        else:
-            # Create new chat only if no valid chat_id provided
-            if text.strip():
-                title = text[:30] + "..." if len(text) > 30 else text
+                logger.debug(f"Continuing existing chat: {chat_id_to_use}")
             else:
-                title = f"Image Analysis - {file.filename}"
-            chat_id_to_use = chat_db.create_chat(user_id, title)
-            is_new_chat = True
-            print(f"✅ CREATED new chat: {chat_id_to_use}")
+                # New chat: the id is reserved now, but the chat is only
+                # created once the job exists, so a rejected or duplicate
+                # upload leaves nothing behind in the sidebar
+                chat_id_to_use = new_id()
+                is_new_chat = True
+            
+            api_prompt = text.strip() if text.strip() else "Please analyze this medical image and provide detailed insights."
+            job, created = job_queue.create(
+                user_id, chat_id_to_use, api_prompt, image_data, idempotency_key,
+                weight=limits["scheduler_weight"],
+                max_concurrent=limits["max_concurrent_jobs"]
+            )
+            if not created:
+                # Lost a race with a concurrent retry of the same upload
+                return job_response(job, user_key, is_new_chat=False)
+            
+            if is_new_chat:
+                if text.strip():
+                    title = text[:30] + "..." if len(text) > 30 else text
+                else:
+                    title = f"Image Analysis - {filename}"
+                chat_db.create_chat(user_id, title, chat_id=chat_id_to_use)
+                logger.debug(f"Created new chat: {chat_id_to_use}")
+        finally:
+            if not created:
+                # Rejected or duplicate uploads don't count against the quota
+                shared_state.incr(quota_key, -1, ttl=3600)
         
         # FIXED: Show user's actual input, not default message
         if text.strip():
             user_message = text.strip()
-            print(f"✅ Using user's EXACT text: '{user_message}'")
         else:
-            user_message = f"Uploaded image: {file.filename}"
-            print(f"✅ Using image upload message: '{user_message}'")
+            user_message = f"Uploaded image: {filename}"
         
-        # Add user message to the chat (using the SAME chat ID)
+        # Store the user message before the job becomes visible so it sorts first
         message_id = chat_db.add_message(chat_id_to_use, user_message, "user", user_id, user_key)
-        print(f"✅ Added user message ID: {message_id} to chat: {chat_id_to_use}")
-        
-        # Process image with medical API
-        api_prompt = text.strip() if text.strip() else "Please analyze this medical image and provide detailed insights."
-        api_response = await medical_api_client.process_message(
-            api_prompt,
-            image_data=image_data,
-            max_tokens=500  # ⬅️ INCREASED from 200 to 500 for detailed analysis
-        )
-        
-        # Add AI response to the SAME chat
-        ai_message_id = chat_db.add_message(chat_id_to_use, api_response['response'], "assistant", user_id, user_key)
-        print(f"✅ Added AI response ID: {ai_message_id} to chat: {chat_id_to_use}")
+        logger.debug(f"Added user message ID: {message_id} to chat: {chat_id_to_use}")
+        job_queue.submit(job["job_id"])
         
-        # Get complete chat history INCLUDING all previous messages
-        chat_history = chat_db.get_chat_history(chat_id_to_use, user_key)
-        print(f"✅ Final chat {chat_id_to_use} has {len(chat_history)} total messages")
-        
-        # CRITICAL: Return the EXACT same format as text messages
-        return {
-            "id": chat_id_to_use,  # Use the same chat ID that was passed in
-            "title": text[:30] + "..." if text and len(text) > 30 else f"Image Analysis - {file.filename}",
-            "messages": chat_history,  # ALL messages including previous ones
-            "created_at": datetime.now().isoformat(),
-            "is_new_chat": is_new_chat
-        }
+        # Re-read for the queue position assigned on submit
+        response = job_response(job_queue.get(job["job_id"]), user_key, is_new_chat=is_new_chat)
+        response["title"] = text[:30] + "..." if text and len(text) > 30 else f"Image Analysis - {filename}"
+        return response
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ Image upload error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ Image upload error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def job_response(job: dict, user_key: UserKeyring, is_new_chat: bool = False) -> dict:
+    """Job status in the same shape as chat responses, plus the job fields"""
+    return {
+        "id": job["chat_id"],
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "error": job["error"],
+        "messages": chat_db.get_chat_history(job["chat_id"], user_key),
+        "created_at": job["created_at"],
+        "is_new_chat": is_new_chat,
+        # Only set while queued; lets the UI show "3rd in line, ~40s"
+        "queue_position": job.get("queue_position"),
+        "estimated_wait_seconds": job.get("estimated_wait_seconds")
+    }
+
+@app.get("/api/chat/jobs/{job_id}")
+async def get_job_status(job_id: str, request: Request, wait: float = 0):
+    """Job status; with ?wait=N the request long-polls up to N seconds for completion"""
+    current_user = get_current_user_from_cookie(request)
+    user = db.get_user_by_email(current_user)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    user_id = str(user["id"])
+    job = await job_queue.wait_for(job_id, user_id, timeout=max(0, min(wait, 30)))
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    user_key = chat_db.get_user_key(user_id, user["email"])
+    return job_response(job, user_key)
+
+@app.get("/api/metrics/uploads", dependencies=[Depends(verify_metrics_token)])
+async def get_upload_metrics():
+    """Rejected upload counts and bytes, summed across workers"""
+    return upload_metrics.snapshot()
+
+@app.get("/api/metrics/ws", dependencies=[Depends(verify_metrics_token)])
+async def get_ws_metrics():
+    """Open chat WebSockets in the worker that answers"""
+    return {"pid": os.getpid(), "connections": ws_connections}
+
+@app.get("/api/metrics/key-rotation", dependencies=[Depends(verify_metrics_token)])
+async def get_key_rotation_progress():
+    """Progress and throughput of the chat message re-encryption"""
+    return await asyncio.to_thread(key_rotation.progress)
+
+@app.get("/api/metrics/inference", dependencies=[Depends(verify_metrics_token)])
+async def get_inference_metrics():
+    """Upstream inference calls started and requests coalesced onto them, and the
+    inference node connection pool (reuse, connect/TTFB/body timings, health), per worker"""
+    transport = medical_api_client.transport
+    return {"pid": os.getpid(), **medical_api_client.inflight.snapshot(),
+            "transport": transport.snapshot() if transport is not None else None}
+
+@app.get("/api/metrics/rate-limits", dependencies=[Depends(verify_metrics_token)])
+async def get_rate_limit_metrics():
+    """Allowed and refused requests per route in the worker that answers"""
+    return rate_limiter.snapshot()
+
+@app.get("/api/metrics/logging", dependencies=[Depends(verify_metrics_token)])
+async def get_logging_metrics():
+    """Log records waiting for the writer, dropped or sampled out in the worker that answers"""
+    return logging_stats()
+
+@app.get("/api/metrics/storage", dependencies=[Depends(verify_metrics_token)])
+async def get_storage_metrics():
+    """Database and WAL file sizes, free pages and the last maintenance runs"""
+    return await asyncio.to_thread(maintenance.storage)
+
 @app.get("/api/guest/usage")
 async def get_guest_usage(request: Request):
-    client_ip = request.client.host
+    client_ip = client_address(request.scope)
     current_date = datetime.now().strftime("%Y-%m-%d")
     usage_count = db.get_guest_usage(client_ip, current_date)
     remaining = max(3 - usage_count, 0)
@@ -368,6 +914,28 @@ async def get_guest_usage(request: Request):
         "can_use": remaining > 0
     }
 
+@app.post("/api/user/chats/delete")
+async def delete_user_chats(body: DeleteChatsRequest, request: Request):
+    """Delete several chats at once; ids that aren't the user's are skipped"""
+    current_user = get_current_user_from_cookie(request)
+    user = db.get_user_by_email(current_user)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    deleted = await asyncio.to_thread(chat_db.delete_chats, str(user["id"]), body.chat_ids)
+    return {"deleted": deleted}
+
+@app.delete("/api/user/chats")
+async def delete_all_user_chats(request: Request):
+    """Delete every chat the user has"""
+    current_user = get_current_user_from_cookie(request)
+    user = db.get_user_by_email(current_user)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    deleted = await asyncio.to_thread(chat_db.delete_chats, str(user["id"]))
+    return {"deleted": deleted}
+
 @app.delete("/api/chat/{chat_id}")
 async def delete_chat(chat_id: str, request: Request):
     try:
@@ -383,7 +951,7 @@ async def delete_chat(chat_id: str, request: Request):
         
         return {"message": "Chat deleted successfully"}
     except Exception as e:
-        print(f"Delete chat error: {e}")
+        logger.error(f"Delete chat error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+import gzip
+import hashlib
+import os
+from typing import Dict, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+# Check the files' mtime on every request and reload edited pages; for
+# development, where static/ is edited while the server runs
+PAGE_CACHE_RELOAD = os.getenv("PAGE_CACHE_RELOAD", "0") == "1"
+# Pages are compressed once, so the slowest level costs nothing per request
+GZIP_LEVEL = 9
+
+
+class CachedPage:
+    """One HTML file held in memory, as is and gzipped, with an ETag per encoding"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.load()
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            self.body = f.read()
+        self.mtime = os.stat(self.path).st_mtime_ns
+        # mtime=0 keeps the compressed bytes, and so the ETag, identical
+        # across workers and restarts
+        self.gzipped = gzip.compress(self.body, GZIP_LEVEL, mtime=0)
+        digest = hashlib.sha256(self.body).hexdigest()[:16]
+        self.etag = f'"{digest}"'
+        self.gzip_etag = f'"{digest}-gz"'
+
+    def stale(self) -> bool:
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime
+        except OSError:
+            return False
+
+
+def _accepts_gzip(request: Request) -> bool:
+    for coding in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() == "gzip":
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    return float(params[2:]) > 0
+                except ValueError:
+                    pass
+            return True
+    return False
+
+
+class PageCache:
+    """Serves the HTML entry points from memory.
+
+    Each page is read and gzipped once, in `load()`. A request picks the
+    gzip or plain copy from Accept-Encoding and gets 304 when its
+    If-None-Match already names that copy. Pages are sent with
+    `Cache-Control: no-cache`, so browsers revalidate on every navigation
+    and pick up a deploy immediately, but an unchanged page costs a 304.
+    """
+
+    def __init__(self, directory: str, names):
+        self.directory = directory
+        self.names = list(names)
+        self.pages: Dict[str, CachedPage] = {}
+
+    def load(self):
+        self.pages = {name: CachedPage(os.path.join(self.directory, name)) for name in self.names}
+
+    def page(self, name: str) -> CachedPage:
+        page = self.pages.get(name)
+        if page is None:
+            page = self.pages[name] = CachedPage(os.path.join(self.directory, name))
+        elif PAGE_CACHE_RELOAD and page.stale():
+            page.load()
+        return page
+
+    def response(self, name: str, request: Request) -> Response:
+        page = self.page(name)
+        if _accepts_gzip(request):
+            etag, body, extra = page.gzip_etag, page.gzipped, {"content-encoding": "gzip"}
+        else:
+            etag, body, extra = page.etag, page.body, {}
+        headers = {"etag": etag, "cache-control": "no-cache", "vary": "Accept-Encoding"}
+
+        if_none_match: Optional[str] = request.headers.get("if-none-match")
+        if if_none_match:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if etag in tags or "*" in tags:
+                return Response(status_code=304, headers=headers)
+
+        headers.update(extra)
+        return Response(body, media_type="text/html", headers=headers)
@@ -0,0 +1,228 @@
+import asyncio
+import math
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Buckets kept per worker before idle (full) ones are dropped
+MAX_BUCKETS = 100_000
+# Verified tokens remembered per worker, so a request costs a dict lookup
+# rather than a signature check
+MAX_CACHED_TOKENS = 10_000
+# Proxies in front of the app that append to X-Forwarded-For (1 on Render).
+# The client is the address the outermost of them saw; anything further left
+# in the header came from the client and is ignored. 0 uses the socket peer.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+
+
+class RateLimit:
+    """A token bucket for one route: `per_minute` sustained, `burst` at once.
+
+    `key` is "ip" or "user"; user limits fall back to the client IP when
+    the request carries no valid token. `shared` buckets live in the shared
+    state store, so the limit holds across all workers at the cost of a
+    SQLite write per request; the others are per worker and in memory.
+    A path ending in "*" matches by prefix.
+    """
+
+    def __init__(self, method: str, path: str, per_minute: float, burst: int,
+                 key: str = "ip", shared: bool = False):
+        if key not in ("ip", "user"):
+            raise ValueError(f"Unknown rate limit key {key!r}")
+        self.method = method
+        self.path = path
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.key = key
+        self.shared = shared
+        self.name = f"{method} {path}"
+        self.allowed = 0
+        self.limited = 0
+
+
+class VerifiedTokens:
+    """Remembers what `verify(token)` said about each token: (subject,
+    expiry) or None. A token's signature is then checked once per worker;
+    expiry is still compared on every lookup."""
+
+    def __init__(self, verify: Callable[[str], Optional[Tuple[str, float]]],
+                 max_size: int = MAX_CACHED_TOKENS):
+        self.verify = verify
+        self.max_size = max_size
+        self._tokens: Dict[str, Optional[Tuple[str, float]]] = {}
+
+    def subject(self, token: str) -> Optional[str]:
+        cached = self._tokens.get(token, False)
+        if cached is False:
+            if len(self._tokens) >= self.max_size:
+                self._tokens.clear()
+            cached = self._tokens[token] = self.verify(token)
+        if cached is None or cached[1] <= time.time():
+            return None
+        return cached[0]
+
+
+class RateLimiter:
+    """Route lookup, buckets and counters, shared by the middleware and the
+    WebSocket handler (whose frames never pass through HTTP middleware)"""
+
+    def __init__(self, limits: List[RateLimit], subject, shared_state=None):
+        self.limits = limits
+        # token -> (subject, expiry) or None; a VerifiedTokens can be shared
+        # with other code that authenticates from the same tokens
+        self.tokens = subject if isinstance(subject, VerifiedTokens) else VerifiedTokens(subject)
+        self.shared_state = shared_state
+        self._exact: Dict[Tuple[str, str], RateLimit] = {}
+        self._prefixes: List[RateLimit] = []
+        for limit in limits:
+            if limit.path.endswith("*"):
+                self._prefixes.append(limit)
+            else:
+                self._exact[(limit.method, limit.path)] = limit
+        # Longest prefix wins
+        self._prefixes.sort(key=lambda limit: len(limit.path), reverse=True)
+        self._buckets: Dict[tuple, list] = {}
+
+    def match(self, method: str, path: str) -> Optional[RateLimit]:
+        limit = self._exact.get((method, path))
+        if limit is not None:
+            return limit
+        for limit in self._prefixes:
+            if limit.method in (method, "*") and path.startswith(limit.path[:-1]):
+                return limit
+        return None
+
+    def client_key(self, limit: RateLimit, client_ip: str, token: Optional[str]) -> str:
+        if limit.key == "user" and token:
+            subject = self.tokens.subject(token)
+            if subject is not None:
+                return f"user:{subject}"
+        return f"ip:{client_ip}"
+
+    def _prune(self, now: float):
+        """Drop buckets that have refilled completely; they hold no state"""
+        for key, (tokens, stamp) in list(self._buckets.items()):
+            limit = key[0]
+            if tokens + (now - stamp) * limit.rate >= limit.burst:
+                del self._buckets[key]
+        if len(self._buckets) >= MAX_BUCKETS:
+            self._buckets.clear()
+
+    def _take_local(self, limit: RateLimit, client: str) -> float:
+        now = time.monotonic()
+        key = (limit, client)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                self._prune(now)
+            self._buckets[key] = [limit.burst - 1, now]
+            return 0.0
+        tokens = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        bucket[0] = tokens
+        return (1 - tokens) / limit.rate
+
+    async def take(self, limit: RateLimit, client: str) -> float:
+        """Spend one token; returns 0 if allowed, else seconds until one is available"""
+        if limit.shared and self.shared_state is not None:
+            retry_after = await asyncio.to_thread(
+                self.shared_state.take_token, f"ratelimit:{limit.name}:{client}", limit.rate, limit.burst
+            )
+        else:
+            retry_after = self._take_local(limit, client)
+        if retry_after:
+            limit.limited += 1
+        else:
+            limit.allowed += 1
+        return retry_after
+
+    def snapshot(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "buckets": len(self._buckets),
+            "routes": {
+                limit.name: {
+                    "per_minute": round(limit.rate * 60, 2),
+                    "burst": limit.burst,
+                    "key": limit.key,
+                    "shared": limit.shared,
+                    "allowed": limit.allowed,
+                    "limited": limit.limited,
+                }
+                for limit in self.limits
+            },
+        }
+
+
+def client_address(scope, hops: int = TRUSTED_PROXY_HOPS) -> str:
+    """The client's IP: from X-Forwarded-For as written by the trusted proxies, else the peer"""
+    if hops > 0:
+        for name, value in scope.get("headers", ()):
+            if name == b"x-forwarded-for":
+                addresses = [a.strip() for a in value.decode("latin-1").split(",") if a.strip()]
+                if len(addresses) >= hops:
+                    return addresses[-hops]
+                break
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def request_token(headers) -> Optional[str]:
+    """The JWT from the `token` cookie or an `Authorization: Bearer` header"""
+    for name, value in headers:
+        if name == b"cookie":
+            for part in value.decode("latin-1").split(";"):
+                part = part.strip()
+                if part.startswith("token="):
+                    return part[6:]
+        elif name == b"authorization":
+            scheme, _, credentials = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer" and credentials:
+                return credentials.strip()
+    return None
+
+
+class RateLimitMiddleware:
+    """Answer 429 with Retry-After once a client's bucket for a route is empty.
+
+    Runs before routing and body parsing, so a refused request costs a dict
+    lookup and a little arithmetic. WebSocket handshakes are limited too,
+    and refused by closing before accept.
+    """
+
+    def __init__(self, app, limiter: RateLimiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def _reject(self, send, retry_after: float):
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [(b"content-type", b"application/json"),
+                        (b"retry-after", str(math.ceil(retry_after)).encode())],
+        })
+        await send({"type": "http.response.body", "body": b'{"detail":"Too many requests"}'})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        method = scope.get("method", "GET")
+        limit = self.limiter.match(method, scope["path"])
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        client_ip = client_address(scope)
+        token = request_token(scope["headers"]) if limit.key == "user" else None
+        retry_after = await self.limiter.take(limit, self.limiter.client_key(limit, client_ip, token))
+        if not retry_after:
+            await self.app(scope, receive, send)
+        elif scope["type"] == "websocket":
+            await send({"type": "websocket.close", "code": 1008})
+        else:
+            await self._reject(send, retry_after)
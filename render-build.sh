@@ -15,8 +15,10 @@ echo "📦 Dependencies installed"
 python -c "
 from database.database import db
 from database.chat_db import ChatDB
+db.init_db()
 print('✅ Databases initialized')
 chat_db = ChatDB()
+chat_db.init_db()
 print('✅ Chat database initialized')
 "
 
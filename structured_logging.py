@@ -0,0 +1,201 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+# Root level, and per-logger overrides as "name=LEVEL,name=LEVEL"
+# (e.g. "api_client=DEBUG,database.chat_db=WARNING")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# Keep one in N records of an event, as "event=N,event=N"; merged over
+# the defaults the service passes to setup_logging
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+# "json" (one object per line) or "text" for reading in a terminal
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# Records waiting for the writer thread; when it falls this far behind,
+# new records are dropped (and counted) rather than blocking a request
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Attributes every LogRecord has; anything else arrived through `extra=`
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def parse_pairs(spec: str) -> Dict[str, str]:
+    pairs = {}
+    for item in spec.split(","):
+        name, sep, value = item.partition("=")
+        if sep and name.strip():
+            pairs[name.strip()] = value.strip()
+    return pairs
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message and any `extra=` fields"""
+
+    def __init__(self, service: str):
+        super().__init__()
+        self.service = service
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "service": self.service,
+            "pid": record.process,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps the first of every N records of a high-volume event.
+
+    Events are named with `extra={"event": ...}`; kept records carry
+    `sample_rate` so counts can be scaled back up. Warnings and errors
+    are never sampled out.
+    """
+
+    def __init__(self, rates: Dict[str, int]):
+        super().__init__()
+        self.rates = {event: rate for event, rate in rates.items() if rate > 1}
+        self.seen: Dict[str, int] = {}
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, "event", None))
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        seen = self.seen.get(record.event, 0)
+        self.seen[record.event] = seen + 1
+        if seen % rate:
+            self.sampled_out += 1
+            return False
+        record.sample_rate = rate
+        return True
+
+
+class BufferedQueueHandler(QueueHandler):
+    """Hands records to the writer thread; the caller only pays for building the message.
+
+    The message and any traceback are rendered here, while the arguments
+    are still what the caller meant; JSON encoding and the write happen on
+    the writer thread. The queue is a SimpleQueue (no locks on put) held
+    to `max_size` by hand: past it records are dropped, not waited on.
+    """
+
+    def __init__(self, log_queue: queue.SimpleQueue, max_size: int = LOG_QUEUE_SIZE):
+        super().__init__(log_queue)
+        self.max_size = max_size
+        self.dropped = 0
+        self._traceback = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The root logger has no other handler, so the record is updated in
+        # place rather than copied
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._traceback.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+        else:
+            self.queue.put(record)
+
+
+def skip_unused_record_fields():
+    """Stop filling in LogRecord fields no formatter here prints.
+
+    Looking up the calling frame (file, line, function) is the most
+    expensive part of creating a record, and thread and process names cost
+    a lookup each; only the pid is kept. These are the switches the logging
+    docs list under "Optimization"; tracebacks still say where errors were.
+    """
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logMultiprocessing = False
+
+
+_handler: Optional[BufferedQueueHandler] = None
+_listener: Optional[QueueListener] = None
+_sampler: Optional[SamplingFilter] = None
+_formatter: Optional[logging.Formatter] = None
+
+
+def _start_writer():
+    global _listener
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(_formatter)
+    _handler.queue = queue.SimpleQueue()
+    _listener = QueueListener(_handler.queue, output)
+    _listener.start()
+
+
+def _stop_writer():
+    if _listener is not None:
+        _listener.stop()  # Drains what is queued
+
+
+def setup_logging(service: str, sample: Optional[Dict[str, int]] = None,
+                  levels: Optional[Dict[str, str]] = None):
+    """Route every logger through one queue to a background writer on stdout.
+
+    Call once at import time of the service's entry module. Records are
+    JSON lines (LOG_FORMAT=text for a terminal); levels come from
+    LOG_LEVEL and `levels` overridden by LOG_LEVELS, sampling rates from
+    `sample` overridden by LOG_SAMPLE.
+    Forked children get their own queue and writer thread.
+    """
+    global _handler, _sampler, _formatter
+    if _handler is not None:
+        return
+    rates = dict(sample or {})
+    rates.update({event: int(rate) for event, rate in parse_pairs(LOG_SAMPLE).items()})
+    _sampler = SamplingFilter(rates)
+    _handler = BufferedQueueHandler(queue.SimpleQueue())
+    _handler.addFilter(_sampler)
+    _formatter = (
+        JsonFormatter(service) if LOG_FORMAT == "json"
+        else logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(_handler)
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in {**(levels or {}), **parse_pairs(LOG_LEVELS)}.items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    skip_unused_record_fields()
+    _start_writer()
+    atexit.register(_stop_writer)
+    # The writer thread does not survive fork; the child starts its own
+    os.register_at_fork(after_in_child=_start_writer)
+
+
+def logging_stats() -> dict:
+    """Queue depth and records dropped (queue full) or sampled out in this process"""
+    if _handler is None:
+        return {"pid": os.getpid(), "configured": False}
+    return {
+        "pid": os.getpid(),
+        "configured": True,
+        "queued": _handler.queue.qsize(),
+        "dropped": _handler.dropped,
+        "sampled_out": _sampler.sampled_out,
+        "sample_rates": _sampler.rates,
+    }
@@ -0,0 +1,57 @@
+import asyncio
+
+from api_client import MedicalAPIClient
+
+CALLERS = 5
+
+
+def make_client(monkeypatch):
+    """A client whose inference node is a slow stub that counts its calls"""
+    client = MedicalAPIClient()
+    client.medical_api_url = "http://inference.invalid/analyze"
+    client.medical_api_key = "test-key"
+    calls = []
+
+    async def fake_call(text, image_data, policy, deadline):
+        calls.append((text, image_data, policy.max_tokens))
+        await asyncio.sleep(0.05)
+        return {"response": f"answer to {text}", "tokens_generated": 3, "stop_reason": "eos"}
+
+    monkeypatch.setattr(client, "_call_medical_api", fake_call)
+    return client, calls
+
+
+def test_identical_requests_share_one_upstream_call(monkeypatch):
+    client, calls = make_client(monkeypatch)
+
+    async def run():
+        return await asyncio.gather(*[
+            client.process_message("chest pain?", b"image", max_tokens=100, user_id="u1")
+            for _ in range(CALLERS)
+        ])
+
+    results = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert len(results) == CALLERS
+    assert all(result == results[0] for result in results)
+    assert len({id(result) for result in results}) == CALLERS
+    assert client.inflight.snapshot() == {"calls": 1, "coalesced": CALLERS - 1, "in_flight": 0}
+
+
+def test_different_requests_are_not_coalesced(monkeypatch):
+    client, calls = make_client(monkeypatch)
+
+    async def run():
+        return await asyncio.gather(
+            client.process_message("chest pain?", b"image", max_tokens=100, user_id="u1"),
+            client.process_message("chest pain?", b"image", max_tokens=200, user_id="u1"),
+            client.process_message("chest pain?", b"other image", max_tokens=100, user_id="u1"),
+            client.process_message("chest pain?", b"image", max_tokens=100, user_id="u2"),
+        )
+
+    results = asyncio.run(run())
+
+    assert len(calls) == 4
+    assert len(results) == 4
+    assert client.inflight.snapshot() == {"calls": 4, "coalesced": 0, "in_flight": 0}
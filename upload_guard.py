@@ -0,0 +1,287 @@
+import os
+from typing import Dict, Optional
+
+from fastapi import HTTPException, Request
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+
+# Largest image accepted by /api/chat/upload (the frontend enforces the same)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(5 * 1024 * 1024)))
+# Largest body for any request; multipart overhead and text fields on top of the image
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(MAX_UPLOAD_BYTES + 256 * 1024)))
+# Non-file form fields (question text, chat id) are small
+MAX_FIELD_BYTES = 64 * 1024
+
+# (offset, magic, mime type); DICOM keeps its magic after a 128-byte preamble
+IMAGE_SIGNATURES = [
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"BM", "image/bmp"),
+    (0, b"II*\x00", "image/tiff"),
+    (0, b"MM\x00*", "image/tiff"),
+    (128, b"DICM", "application/dicom"),
+]
+SNIFF_BYTES = 132
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Identify an image from its first bytes; None if it isn't one we accept"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for offset, magic, mime_type in IMAGE_SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            return mime_type
+    return None
+
+
+class UploadRejected(HTTPException):
+    """An upload refused before it was fully read; `reason` labels the metric"""
+
+    def __init__(self, status_code: int, detail: str, reason: str):
+        super().__init__(status_code=status_code, detail=detail)
+        self.reason = reason
+        self.recorded = False
+
+
+class UploadMetrics:
+    """Counts of rejected uploads and the bytes they cost, shared by all workers.
+
+    `bytes_read` is what we received before aborting; `bytes_avoided` is
+    what the client declared but we never had to read.
+    """
+
+    REASONS = ("too_large", "not_an_image", "malformed")
+
+    def __init__(self, shared_state):
+        self.shared_state = shared_state
+
+    def record(self, reason: str, bytes_read: int, declared: Optional[int] = None):
+        self.shared_state.incr(f"uploads:rejected:{reason}")
+        self.shared_state.incr("uploads:rejected_bytes_read", bytes_read)
+        if declared and declared > bytes_read:
+            self.shared_state.incr("uploads:rejected_bytes_avoided", declared - bytes_read)
+
+    def snapshot(self) -> Dict[str, int]:
+        counts = {
+            f"rejected_{reason}": self.shared_state.get(f"uploads:rejected:{reason}") or 0
+            for reason in self.REASONS
+        }
+        counts["rejected_bytes_read"] = self.shared_state.get("uploads:rejected_bytes_read") or 0
+        counts["rejected_bytes_avoided"] = self.shared_state.get("uploads:rejected_bytes_avoided") or 0
+        return counts
+
+
+def declared_length(headers) -> Optional[int]:
+    try:
+        return int(headers.get("content-length"))
+    except (TypeError, ValueError):
+        return None
+
+
+class ParsedUpload:
+    def __init__(self):
+        self.fields: Dict[str, str] = {}
+        self.file_data = bytearray()
+        self.filename: Optional[str] = None
+        self.content_type: Optional[str] = None  # sniffed, not client-supplied
+
+
+class _StreamingParser:
+    """Callbacks for python-multipart that keep one image in memory and
+    check its magic bytes as soon as the first SNIFF_BYTES have arrived"""
+
+    def __init__(self, file_field: str, max_bytes: int):
+        self.file_field = file_field
+        self.max_bytes = max_bytes
+        self.upload = ParsedUpload()
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._name = None
+        self._is_file = False
+        self._sniffed = False
+        self._field_data = bytearray()
+
+    def on_part_begin(self):
+        self._disposition = b""
+        self._name = None
+        self._is_file = False
+        self._field_data = bytearray()
+
+    def on_header_field(self, data, start, end):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        if b"name" not in options:
+            raise UploadRejected(400, "Malformed multipart body", "malformed")
+        self._name = options[b"name"].decode("utf-8", "replace")
+        self._is_file = b"filename" in options
+        if self._is_file:
+            if self._name != self.file_field or self.upload.filename is not None:
+                raise UploadRejected(400, "Unexpected file field", "malformed")
+            self.upload.filename = options[b"filename"].decode("utf-8", "replace")
+
+    def on_part_data(self, data, start, end):
+        chunk = data[start:end]
+        if not self._is_file:
+            self._field_data += chunk
+            if len(self._field_data) > MAX_FIELD_BYTES:
+                raise UploadRejected(413, "Form field too large", "too_large")
+            return
+
+        file_data = self.upload.file_data
+        file_data += chunk
+        if len(file_data) > self.max_bytes:
+            raise UploadRejected(
+                413, f"Image too large (max {self.max_bytes // (1024 * 1024)} MB)", "too_large"
+            )
+        if not self._sniffed and len(file_data) >= SNIFF_BYTES:
+            self._sniff()
+
+    def on_part_end(self):
+        if self._is_file:
+            if not self._sniffed:
+                self._sniff()
+        elif self._name is not None:
+            self.upload.fields[self._name] = self._field_data.decode("utf-8", "replace")
+
+    def _sniff(self):
+        self._sniffed = True
+        self.upload.content_type = sniff_image_type(bytes(self.upload.file_data[:SNIFF_BYTES]))
+        if self.upload.content_type is None:
+            raise UploadRejected(415, "File must be an image", "not_an_image")
+
+    def callbacks(self):
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        }
+
+
+async def read_image_upload(request: Request, file_field: str = "file",
+                            max_bytes: int = MAX_UPLOAD_BYTES,
+                            metrics: Optional[UploadMetrics] = None) -> ParsedUpload:
+    """Parse a multipart form while it streams in, with one image in `file_field`.
+
+    Unlike `UploadFile`, nothing is spooled to disk and the body is never
+    read past the point where it can be rejected: an oversized or non-image
+    upload stops after the chunk that gives it away.
+    """
+    declared = declared_length(request.headers)
+    received = 0
+    try:
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise UploadRejected(400, "Expected multipart/form-data", "malformed")
+        if declared is not None and declared > max_bytes + MAX_FIELD_BYTES:
+            raise UploadRejected(
+                413, f"Image too large (max {max_bytes // (1024 * 1024)} MB)", "too_large"
+            )
+
+        handler = _StreamingParser(file_field, max_bytes)
+        parser = MultipartParser(params[b"boundary"], handler.callbacks())
+        try:
+            async for chunk in request.stream():
+                received += len(chunk)
+                parser.write(chunk)
+            parser.finalize()
+        except MultipartParseError:
+            raise UploadRejected(400, "Malformed multipart body", "malformed")
+
+        if handler.upload.filename is None or not handler.upload.file_data:
+            raise UploadRejected(400, "An image file is required", "malformed")
+        return handler.upload
+
+    except UploadRejected as e:
+        if metrics is not None and not e.recorded:
+            metrics.record(e.reason, received, declared)
+            e.recorded = True
+        raise
+
+
+class BodySizeLimitMiddleware:
+    """Refuse any request body over `max_bytes` with 413.
+
+    Bodies with an honest Content-Length are refused before a single byte
+    is read; chunked or lying ones are cut off as soon as they cross the
+    limit.
+    """
+
+    def __init__(self, app, max_bytes: int = MAX_REQUEST_BYTES,
+                 metrics: Optional[UploadMetrics] = None,
+                 path_limits: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        # Routes that stream large bodies themselves (e.g. archive import)
+        self.path_limits = path_limits or {}
+
+    async def _reject(self, send):
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"connection", b"close")],
+        })
+        await send({"type": "http.response.body", "body": b'{"detail":"Request body too large"}'})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        max_bytes = self.path_limits.get(scope["path"], self.max_bytes)
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+        declared = declared_length(headers)
+        if declared is not None and declared > max_bytes:
+            if self.metrics is not None:
+                self.metrics.record("too_large", 0, declared)
+            await self._reject(send)
+            return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    # Routes may turn this into their own 413 response, so
+                    # count it here rather than where it is caught
+                    error = UploadRejected(413, "Request body too large", "too_large")
+                    if self.metrics is not None:
+                        self.metrics.record("too_large", received, declared)
+                        error.recorded = True
+                    raise error
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except UploadRejected:
+            if response_started:
+                raise
+            await self._reject(send)